@@ -0,0 +1,719 @@
+"""
+Нагрузочный тест бота эксперимента
+Прогоняет полный сценарий участника (выбор языка, обсуждение, сообщения,
+истечение таймера, финальное решение, опрос) для 100-1000 одновременных
+синтетических участников. Обновления идут через PerUserUpdateProcessor в
+обработчики PrisonersDilemmaBot, Bot API заменен записывающей заглушкой, а LLM -
+бэкендом с настраиваемой задержкой.
+
+Тест работает на виртуальных часах: когда в event loop нет готовых задач,
+время перематывается к ближайшему таймеру, поэтому 10 минут обсуждения
+проходят за секунды, а реальным остается только время CPU. Задержка event
+loop и задержки обработчиков измеряются по этим часам и показывают именно
+затраты процессора и ожидание в очередях.
+
+Запуск:
+    python -m benchmarks.load_test --participants 100 500 1000 --llm-latency 2
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import selectors
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Config читает окружение при импорте, поэтому значения по умолчанию задаются до импорта бота
+os.environ.setdefault('BOT_TOKEN', '0:load-test')
+os.environ.setdefault('ENCRYPTION_KEY', 'load-test-encryption-key-0123456789')
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+os.environ.setdefault('LOG_FILE', os.path.join(tempfile.gettempdir(), 'load_test_bot.log'))
+
+from telegram import CallbackQuery, Chat, Message, Update, User
+
+import handlers.llm_experiment_handler as llm_experiment_handler
+import utils.llm_analyzer as llm_analyzer
+import utils.llm_backends as llm_backends
+import utils.update_processor as update_processor
+from config.settings import Config
+from main import PrisonersDilemmaBot
+from utils.llm_analyzer import ANALYSIS_INSTRUCTIONS, BATCH_ANALYSIS_INSTRUCTIONS, FLOW_INSTRUCTIONS
+from utils.llm_backends import LLMBackend
+from utils.update_processor import PerUserUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+USER_ID_BASE = 10_000_000
+
+# Период измерения задержки event loop, сек (виртуальных)
+LAG_SAMPLE_INTERVAL = 0.1
+
+# Модули, которые измеряют задержки через time.monotonic(); в прогоне они переводятся на виртуальные часы
+TIMED_MODULES = [llm_analyzer, llm_backends, update_processor]
+
+# Сколько ждать кнопок финального решения сверх длительности обсуждения, сек
+FINAL_DECISION_GRACE = 120
+
+PARTICIPANT_MESSAGES = [
+    "Я думаю, что лучше промолчать, ведь партнер тоже может молчать",
+    "Если я признаюсь, то получу меньший срок, это рационально",
+    "Не уверен, что можно доверять второму заключенному",
+    "I would stay silent, cooperation seems fair",
+    "Why should I trust the other prisoner?",
+    "Мне кажется, риск слишком велик, наверное признаюсь",
+    "What happens if we both confess?",
+    "Хочу подумать еще, ситуация сложная"
+]
+
+# ---------------------------------------------------------------------------
+# Виртуальные часы
+# ---------------------------------------------------------------------------
+
+class _FastForwardSelector(selectors.DefaultSelector):
+    """
+    Селектор, который не ждет таймеров: вместо сна на timeout время
+    перематывается вперед. Ожидание без таймаута (только ввод-вывод или
+    потоки) остается реальным.
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self.skipped = 0.0
+    
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if ready or timeout is None:
+            return ready or super().select(None)
+        if timeout > 0:
+            self.skipped += timeout
+        return []
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """Event loop, у которого простой между задачами не занимает реального времени"""
+    
+    def __init__(self):
+        self._fast_forward = _FastForwardSelector()
+        super().__init__(self._fast_forward)
+    
+    def time(self) -> float:
+        return super().time() + self._fast_forward.skipped
+
+def _virtual_datetime(loop: asyncio.AbstractEventLoop):
+    """Класс datetime, у которого now() идет по часам loop"""
+    wall_start = datetime.now()
+    loop_start = loop.time()
+    
+    class VirtualDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            moment = wall_start + timedelta(seconds=loop.time() - loop_start)
+            return moment.astimezone(tz) if tz else moment
+    
+    return VirtualDatetime
+
+class _VirtualTime:
+    """Замена модуля time, у которой monotonic() идет по часам loop"""
+    
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.monotonic = self.perf_counter = loop.time
+    
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+# ---------------------------------------------------------------------------
+# Заглушки Telegram
+# ---------------------------------------------------------------------------
+
+class FakeBot:
+    """
+    Заглушка Bot API: записывает отправки и правки сообщений и возвращает
+    настоящие объекты Message, чтобы работали их методы (reply_text, delete, ...)
+    """
+    
+    defaults = None
+    
+    def __init__(self, api_latency: float = 0.0):
+        self.api_latency = api_latency
+        self.user = User(id=1, first_name="LoadTestBot", is_bot=True, username="load_test_bot")
+        self.calls = Counter()
+        self.error_messages = Counter()
+        self.sent: Dict[int, int] = Counter()
+        self.edited: Dict[int, int] = Counter()
+        self.keyboards: Dict[int, Message] = {}
+        self._keyboard_events: Dict[int, asyncio.Event] = {}
+        self._message_ids = itertools.count(1)
+    
+    async def _api(self, method: str):
+        self.calls[method] += 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+    
+    def _message(self, chat_id: int, text: str, reply_markup=None, message_id: int = None) -> Message:
+        message = Message(
+            message_id=message_id or next(self._message_ids),
+            date=datetime.now(timezone.utc),
+            chat=Chat(id=chat_id, type=Chat.PRIVATE),
+            from_user=self.user,
+            text=text,
+            reply_markup=reply_markup
+        )
+        message.set_bot(self)
+        return message
+    
+    def _record(self, message: Message):
+        """Запоминает последнюю клавиатуру чата и отмечает сообщения об ошибках"""
+        chat_id = message.chat_id
+        text = message.text or ''
+        if text.startswith('❌') or 'Произошла ошибка' in text:
+            self.error_messages[text.splitlines()[0][:60]] += 1
+        
+        current = self.keyboards.get(chat_id)
+        if message.reply_markup and message.reply_markup.inline_keyboard:
+            self.keyboards[chat_id] = message
+        elif current is not None and current.message_id == message.message_id:
+            del self.keyboards[chat_id]
+        
+        event = self._keyboard_events.get(chat_id)
+        if event:
+            event.set()
+    
+    async def send_message(self, chat_id: int, text: str, reply_markup=None, **kwargs) -> Message:
+        await self._api('send_message')
+        message = self._message(chat_id, text, reply_markup)
+        self.sent[chat_id] += 1
+        self._record(message)
+        return message
+    
+    async def edit_message_text(self, text: str, chat_id: int = None, message_id: int = None,
+                                reply_markup=None, **kwargs) -> Message:
+        await self._api('edit_message_text')
+        message = self._message(chat_id, text, reply_markup, message_id)
+        self.edited[chat_id] += 1
+        self._record(message)
+        return message
+    
+    async def delete_message(self, chat_id: int, message_id: int, **kwargs) -> bool:
+        await self._api('delete_message')
+        return True
+    
+    async def answer_callback_query(self, callback_query_id: str, **kwargs) -> bool:
+        await self._api('answer_callback_query')
+        return True
+    
+    def find_button(self, chat_id: int, prefix: str) -> Optional[tuple]:
+        """Ищет в последней клавиатуре чата кнопки с callback_data на prefix"""
+        message = self.keyboards.get(chat_id)
+        if message is None:
+            return None
+        buttons = [
+            button.callback_data
+            for row in message.reply_markup.inline_keyboard
+            for button in row
+            if button.callback_data and button.callback_data.startswith(prefix)
+        ]
+        return (message, buttons) if buttons else None
+    
+    async def wait_for_keyboard(self, chat_id: int, prefix: str, timeout: float) -> tuple:
+        """Ждет клавиатуру с кнопками prefix; возвращает (сообщение, callback_data кнопок)"""
+        async def wait():
+            while True:
+                found = self.find_button(chat_id, prefix)
+                if found:
+                    return found
+                event = self._keyboard_events.setdefault(chat_id, asyncio.Event())
+                event.clear()
+                await event.wait()
+        
+        try:
+            return await asyncio.wait_for(wait(), timeout)
+        finally:
+            self._keyboard_events.pop(chat_id, None)
+
+class FakeContext:
+    """Контекст обработчика с теми полями, которые использует бот"""
+    
+    def __init__(self, bot: FakeBot, job_queue: 'VirtualJobQueue', job: 'VirtualJob' = None):
+        self.bot = bot
+        self.job_queue = job_queue
+        self.job = job
+        self.args = []
+        self.application = None
+
+class VirtualJob:
+    """Задача очереди с интерфейсом telegram.ext.Job, нужным боту"""
+    
+    def __init__(self, queue: 'VirtualJobQueue', callback, name: str, data, interval: float = None):
+        self.queue = queue
+        self.callback = callback
+        self.name = name
+        self.data = data
+        self.interval = interval
+        self.due = 0.0
+        self.removed = False
+        self.handle: Optional[asyncio.TimerHandle] = None
+    
+    def schedule_removal(self):
+        self.removed = True
+        if self.handle:
+            self.handle.cancel()
+        self.queue.jobs.discard(self)
+
+class VirtualJobQueue:
+    """
+    Очередь задач на таймерах event loop
+    
+    JobQueue из PTB планирует задачи через APScheduler по реальным часам,
+    поэтому таймеры обсуждения не сработали бы на виртуальных часах.
+    """
+    
+    def __init__(self, harness: 'LoadTest'):
+        self.harness = harness
+        self.jobs = set()
+    
+    def _schedule(self, job: VirtualJob, when: float):
+        loop = asyncio.get_running_loop()
+        job.due = when
+        job.handle = loop.call_at(when, self._fire, job)
+    
+    def _fire(self, job: VirtualJob):
+        if job.removed:
+            return
+        due = job.due
+        if job.interval:
+            self._schedule(job, due + job.interval)
+        else:
+            self.jobs.discard(job)
+        self.harness.run_job(job, due)
+    
+    def run_once(self, callback, when: float, data=None, name: str = None, **kwargs) -> VirtualJob:
+        job = VirtualJob(self, callback, name or callback.__name__, data)
+        self.jobs.add(job)
+        self._schedule(job, asyncio.get_running_loop().time() + when)
+        return job
+    
+    def run_repeating(self, callback, interval: float, first: float = None, data=None,
+                      name: str = None, **kwargs) -> VirtualJob:
+        job = VirtualJob(self, callback, name or callback.__name__, data, interval)
+        self.jobs.add(job)
+        self._schedule(job, asyncio.get_running_loop().time() + (interval if first is None else first))
+        return job
+    
+    def get_jobs_by_name(self, name: str) -> tuple:
+        return tuple(job for job in self.jobs if job.name == name)
+    
+    def stop(self):
+        for job in list(self.jobs):
+            job.schedule_removal()
+
+# ---------------------------------------------------------------------------
+# Заглушка LLM
+# ---------------------------------------------------------------------------
+
+class StubLLMBackend(LLMBackend):
+    """
+    Бэкенд без сети: ждет логнормальную задержку и возвращает правдоподобный
+    JSON для анализа, пакетного анализа, анализа потока и ответа
+    """
+    
+    name = 'stub'
+    
+    def __init__(self, latency: float, jitter: float, error_rate: float, rng: random.Random):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = rng
+    
+    def _delay(self) -> float:
+        if self.latency <= 0:
+            return 0.0
+        # Параметры подобраны так, чтобы среднее логнормального распределения было равно latency
+        mu = math.log(self.latency) - self.jitter ** 2 / 2
+        return self.rng.lognormvariate(mu, self.jitter)
+    
+    def _analysis(self) -> Dict:
+        choice = self.rng.choice
+        return {
+            'emotion': choice(['positive', 'negative', 'neutral', 'anxious', 'frustrated', 'cooperative', 'defensive']),
+            'intent': choice(['cooperate', 'defect', 'question', 'complaint', 'confusion', 'agreement', 'disagreement']),
+            'confidence': choice(['high', 'medium', 'low']),
+            'persuasion_resistance': choice(['high', 'medium', 'low']),
+            'key_themes': ['trust', 'risk'],
+            'suggested_response': "Интересная мысль. Что повлияло на ваш выбор?",
+            'nudging_effectiveness': choice(['high', 'medium', 'low']),
+            'risk_of_dropout': choice(['high', 'medium', 'low'])
+        }
+    
+    def _content(self, messages: List[Dict]) -> str:
+        system = messages[0]['content']
+        if BATCH_ANALYSIS_INSTRUCTIONS in system:
+            items = json.loads(messages[-1]['content'])
+            return json.dumps([{'id': item['id'], **self._analysis()} for item in items], ensure_ascii=False)
+        if ANALYSIS_INSTRUCTIONS in system:
+            return json.dumps(self._analysis(), ensure_ascii=False)
+        if FLOW_INSTRUCTIONS in system:
+            return json.dumps({
+                'engagement_level': self.rng.choice(['high', 'medium', 'low']),
+                'conversation_quality': self.rng.choice(['good', 'average', 'poor']),
+                'user_satisfaction': self.rng.choice(['high', 'medium', 'low']),
+                'experiment_progress': self.rng.choice(['on_track', 'struggling', 'off_track']),
+                'recommendations': ['Продолжать стандартный протокол']
+            }, ensure_ascii=False)
+        return json.dumps({'response': "Понимаю вашу позицию. Подумайте, как поступил бы ваш партнер."},
+                          ensure_ascii=False)
+    
+    async def _chat(self, model: str, messages: List[Dict], max_tokens: int,
+                    temperature: float, max_retries: int) -> Optional[Dict]:
+        await asyncio.sleep(self._delay())
+        if self.rng.random() < self.error_rate:
+            return None
+        return {'content': self._content(messages), 'usage': None}
+    
+    async def _health_check(self) -> bool:
+        return True
+
+# ---------------------------------------------------------------------------
+# Сценарий
+# ---------------------------------------------------------------------------
+
+def _percentiles(values: List[float]) -> Dict:
+    if not values:
+        return {'count': 0, 'p50': None, 'p95': None, 'p99': None, 'max': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'count': len(values), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': float(max(values))}
+
+class LoadTest:
+    """Один прогон: N участников проходят эксперимент одновременно"""
+    
+    def __init__(self, args: argparse.Namespace, participants: int, workdir: str):
+        self.args = args
+        self.participants = participants
+        self.workdir = workdir
+        self.rng = random.Random(args.seed)
+        
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.handler_errors = Counter()
+        self.lag_samples: List[float] = []
+        self.mode_time = Counter()
+        self.stuck = Counter()
+        self.completed = 0
+        self.updates = 0
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._job_tasks = set()
+    
+    # --- отправка обновлений ---
+    
+    async def _timed(self, label: str, coroutine, submitted: float):
+        """Выполняет обработчик и записывает задержку от поступления обновления до конца обработки"""
+        loop = asyncio.get_running_loop()
+        try:
+            await coroutine
+        except Exception as e:
+            self.handler_errors[label] += 1
+            logger.error(f"Обработчик {label} завершился ошибкой: {e}")
+        finally:
+            self.latencies[label].append(loop.time() - submitted)
+    
+    async def _submit(self, label: str, update: Update, handler):
+        """Передает обновление через процессор обновлений, как это делает Application"""
+        loop = asyncio.get_running_loop()
+        self.updates += 1
+        update.set_bot(self.bot)
+        coroutine = self._timed(label, handler(update, FakeContext(self.bot, self.job_queue)), loop.time())
+        await self.processor.process_update(update, coroutine)
+    
+    def _user(self, user_id: int) -> User:
+        return User(id=user_id, first_name=f"user{user_id}", is_bot=False, username=f"load{user_id}")
+    
+    async def send_text(self, user_id: int, text: str, label: str):
+        user = self._user(user_id)
+        message = Message(
+            message_id=next(self._message_ids),
+            date=datetime.now(timezone.utc),
+            chat=Chat(id=user_id, type=Chat.PRIVATE),
+            from_user=user,
+            text=text
+        )
+        message.set_bot(self.bot)
+        update = Update(next(self._update_ids), message=message)
+        handler = self.app.start_command if text == '/start' else self.app.handle_message
+        await self._submit(label, update, handler)
+    
+    async def click(self, user_id: int, message: Message, data: str, label: str):
+        query = CallbackQuery(
+            id=str(next(self._update_ids)),
+            from_user=self._user(user_id),
+            chat_instance=str(user_id),
+            data=data,
+            message=message
+        )
+        query.set_bot(self.bot)
+        update = Update(next(self._update_ids), callback_query=query)
+        await self._submit(label, update, self.app.handle_callback)
+    
+    def run_job(self, job: VirtualJob, due: float):
+        """Запускает сработавшую задачу очереди как отдельную задачу event loop"""
+        loop = asyncio.get_running_loop()
+        label = f"job:{job.callback.__name__}"
+        coroutine = job.callback(FakeContext(self.bot, self.job_queue, job))
+        task = loop.create_task(self._timed(label, coroutine, due))
+        self._job_tasks.add(task)
+        task.add_done_callback(self._job_tasks.discard)
+    
+    # --- участник ---
+    
+    async def _think(self, mean: float):
+        await asyncio.sleep(self.rng.expovariate(1 / mean) if mean > 0 else 0)
+    
+    async def _press(self, user_id: int, prefix: str, label: str, timeout: float):
+        """Ждет кнопку с callback_data на prefix и нажимает случайную из них"""
+        message, buttons = await self.bot.wait_for_keyboard(user_id, prefix, timeout)
+        await self._think(self.args.click_time)
+        await self.click(user_id, message, self.rng.choice(buttons), label)
+    
+    async def participant(self, index: int):
+        loop = asyncio.get_running_loop()
+        user_id = USER_ID_BASE + index
+        timeout = self.args.step_timeout
+        discussion = Config.DISCUSSION_TIME_MINUTES * 60
+        stage = 'start'
+        
+        try:
+            await asyncio.sleep(self.rng.uniform(0, self.args.ramp))
+            await self.send_text(user_id, '/start', 'start')
+            
+            stage = 'lang'
+            await self._press(user_id, 'lang_', 'lang', timeout)
+            
+            stage = 'start_discussion'
+            session_started = loop.time()
+            await self._press(user_id, 'start_discussion_', 'start_discussion', timeout)
+            
+            # Сообщения после конца сессии завершили бы эксперимент по другой ветке, поэтому
+            # участник пишет только пока остается запас времени
+            stage = 'message'
+            deadline = session_started + discussion - self.args.message_margin
+            for _ in range(self.args.messages):
+                await self._think(self.args.think_time)
+                if loop.time() >= deadline:
+                    break
+                await self.send_text(user_id, self.rng.choice(PARTICIPANT_MESSAGES), 'message')
+            
+            stage = 'final_decision'
+            await self._press(user_id, 'final_decision_', 'final_decision', discussion + FINAL_DECISION_GRACE)
+            
+            for question in (1, 2, 3):
+                stage = f'survey_q{question}'
+                await self._press(user_id, f'survey_q{question}_', 'survey', timeout)
+            
+            stage = 'survey_text'
+            survey = self.app.survey_handler.survey_sessions.get(user_id)
+            if not survey or not survey.get('waiting_for_text'):
+                raise asyncio.TimeoutError()
+            await self._think(self.args.think_time)
+            await self.send_text(user_id, "Было интересно, спасибо", 'survey_text')
+            
+            stage = 'survey_complete'
+            if user_id in self.app.survey_handler.survey_sessions:
+                raise asyncio.TimeoutError()
+            self.completed += 1
+        except asyncio.TimeoutError:
+            self.stuck[stage] += 1
+    
+    async def _sample_lag(self):
+        """Измеряет задержку event loop и время в каждом режиме деградации"""
+        loop = asyncio.get_running_loop()
+        degradation = self.app.experiment_handler.degradation
+        while True:
+            started = loop.time()
+            await asyncio.sleep(LAG_SAMPLE_INTERVAL)
+            elapsed = loop.time() - started
+            self.lag_samples.append(max(0.0, elapsed - LAG_SAMPLE_INTERVAL))
+            self.mode_time[degradation.mode] += elapsed
+    
+    # --- прогон ---
+    
+    def _setup(self):
+        """Создает бота в отдельном каталоге и подменяет LLM"""
+        os.makedirs(os.path.join(self.workdir, 'data'), exist_ok=True)
+        os.chdir(self.workdir)
+        
+        self.app = PrisonersDilemmaBot()
+        handler = self.app.experiment_handler
+        if not hasattr(handler, 'llm_analyzer'):
+            raise RuntimeError("Нагрузочный тест требует LLM_ENABLED=true")
+        
+        self.llm = StubLLMBackend(self.args.llm_latency, self.args.llm_jitter, self.args.llm_error_rate,
+                                  random.Random(self.args.seed + 1))
+        handler.llm_analyzer.backends = {'stub': self.llm}
+        handler.llm_analyzer.model_routing = {
+            purpose: [('stub', 'stub-model')] for purpose in ('analysis', 'flow', 'response')
+        }
+        
+        self.bot = FakeBot(self.args.api_latency)
+        self.job_queue = VirtualJobQueue(self)
+        self.processor = PerUserUpdateProcessor(
+            concurrency=self.args.concurrency or Config.UPDATE_CONCURRENCY,
+            max_pending=self.args.max_pending or Config.UPDATE_MAX_PENDING
+        )
+    
+    async def run(self) -> Dict:
+        loop = asyncio.get_running_loop()
+        random.seed(self.args.seed)
+        self._setup()
+        
+        original_datetime = llm_experiment_handler.datetime
+        llm_experiment_handler.datetime = _virtual_datetime(loop)
+        for module in TIMED_MODULES:
+            module.time = _VirtualTime(loop)
+        degradation = self.app.experiment_handler.degradation
+        if Config.DEGRADATION_ENABLED and not self.args.no_degradation:
+            degradation.start()
+        sampler = loop.create_task(self._sample_lag())
+        
+        wall_started = time.perf_counter()
+        cpu_started = time.process_time()
+        started = loop.time()
+        try:
+            await self.processor.initialize()
+            await asyncio.gather(*(self.participant(i) for i in range(self.participants)))
+            virtual_seconds = loop.time() - started
+            wall_seconds = time.perf_counter() - wall_started
+            cpu_seconds = time.process_time() - cpu_started
+        finally:
+            self.job_queue.stop()
+            if self._job_tasks:
+                await asyncio.gather(*self._job_tasks, return_exceptions=True)
+            sampler.cancel()
+            await degradation.stop()
+            await self.processor.shutdown()
+            llm_experiment_handler.datetime = original_datetime
+            for module in TIMED_MODULES:
+                module.time = time
+        
+        return self._report(virtual_seconds, wall_seconds, cpu_seconds)
+    
+    def _report(self, virtual_seconds: float, wall_seconds: float, cpu_seconds: float) -> Dict:
+        return {
+            'participants': self.participants,
+            'completed': self.completed,
+            'stuck': dict(self.stuck),
+            'virtual_seconds': virtual_seconds,
+            'wall_seconds': wall_seconds,
+            'cpu_seconds': cpu_seconds,
+            'updates': self.updates,
+            'throughput': {
+                'updates_per_virtual_second': self.updates / virtual_seconds if virtual_seconds else 0.0,
+                'updates_per_cpu_second': self.updates / cpu_seconds if cpu_seconds else 0.0
+            },
+            'handlers': {label: {**_percentiles(values), 'errors': self.handler_errors[label]}
+                         for label, values in sorted(self.latencies.items())},
+            'loop_lag': _percentiles(self.lag_samples),
+            'bot_api': dict(self.bot.calls),
+            'error_messages': dict(self.bot.error_messages),
+            'llm': self.llm.stats.get_stats(),
+            'processor': self.processor.get_stats(),
+            'degradation_mode_seconds': dict(self.mode_time)
+        }
+
+# ---------------------------------------------------------------------------
+# Запуск
+# ---------------------------------------------------------------------------
+
+def _ms(value: Optional[float]) -> str:
+    return f"{value * 1000:9.1f}" if value is not None else f"{'-':>9}"
+
+def print_report(report: Dict):
+    print(f"\n=== {report['participants']} участников ===")
+    print(f"Завершили: {report['completed']}/{report['participants']}"
+          + (f", застряли: {report['stuck']}" if report['stuck'] else ''))
+    print(f"Виртуальное время: {report['virtual_seconds']:.0f}с, реальное: {report['wall_seconds']:.1f}с, "
+          f"CPU: {report['cpu_seconds']:.1f}с")
+    print(f"Обновлений: {report['updates']}, "
+          f"{report['throughput']['updates_per_virtual_second']:.1f}/с виртуальных, "
+          f"{report['throughput']['updates_per_cpu_second']:.0f}/с CPU")
+    
+    print(f"\n{'Обработчик (мс)':<32}{'n':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'ошибок':>8}")
+    for label, stats in report['handlers'].items():
+        print(f"{label:<32}{stats['count']:>7}{_ms(stats['p50'])}{_ms(stats['p95'])}"
+              f"{_ms(stats['p99'])}{_ms(stats['max'])}{stats['errors']:>8}")
+    lag = report['loop_lag']
+    print(f"{'задержка event loop':<32}{lag['count']:>7}{_ms(lag['p50'])}{_ms(lag['p95'])}"
+          f"{_ms(lag['p99'])}{_ms(lag['max'])}")
+    
+    llm = report['llm']
+    print(f"\nLLM: {llm['calls']} вызовов, {llm['errors']} ошибок, средняя задержка {llm['avg_latency']:.2f}с")
+    print(f"Bot API: {', '.join(f'{k}={v}' for k, v in sorted(report['bot_api'].items()))}")
+    if report['error_messages']:
+        print(f"Сообщения об ошибках: {report['error_messages']}")
+    processor = report['processor']
+    print(f"Очереди пользователей: max глубина {processor['max_user_depth_seen']}, "
+          f"ожидание слота avg {processor['avg_wait'] * 1000:.1f} мс, max {processor['max_wait'] * 1000:.1f} мс")
+    modes = report['degradation_mode_seconds']
+    if modes:
+        print(f"Режимы обслуживания (с): {', '.join(f'{k}={v:.0f}' for k, v in modes.items())}")
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота эксперимента на виртуальных часах")
+    parser.add_argument('--participants', type=int, nargs='+', default=[100, 500, 1000],
+                        help="Число одновременных участников (несколько значений - несколько прогонов)")
+    parser.add_argument('--ramp', type=float, default=60.0, help="Участники приходят равномерно за столько секунд")
+    parser.add_argument('--messages', type=int, default=5, help="Сообщений от участника за обсуждение")
+    parser.add_argument('--think-time', type=float, default=20.0, help="Среднее время набора сообщения, сек")
+    parser.add_argument('--click-time', type=float, default=3.0, help="Среднее время до нажатия кнопки, сек")
+    parser.add_argument('--message-margin', type=float, default=30.0,
+                        help="Участник не пишет позже чем за столько секунд до конца обсуждения")
+    parser.add_argument('--step-timeout', type=float, default=300.0,
+                        help="Сколько ждать ответа бота на шаге, прежде чем считать участника застрявшим")
+    parser.add_argument('--llm-latency', type=float, default=1.5, help="Средняя задержка LLM, сек")
+    parser.add_argument('--llm-jitter', type=float, default=0.5, help="Сигма логнормальной задержки LLM")
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help="Доля неуспешных вызовов LLM")
+    parser.add_argument('--api-latency', type=float, default=0.05, help="Задержка вызова Bot API, сек")
+    parser.add_argument('--concurrency', type=int, default=None, help="UPDATE_CONCURRENCY для прогона")
+    parser.add_argument('--max-pending', type=int, default=None, help="UPDATE_MAX_PENDING для прогона")
+    parser.add_argument('--no-degradation', action='store_true', help="Не запускать контроллер деградации")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workdir', default=None, help="Каталог для баз прогонов (по умолчанию временный)")
+    parser.add_argument('--json', default=None, help="Сохранить отчеты в JSON файл")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    root = args.workdir or tempfile.mkdtemp(prefix='load_test_')
+    cwd = os.getcwd()
+    
+    reports = []
+    try:
+        for participants in args.participants:
+            workdir = os.path.join(root, f"participants_{participants}")
+            with asyncio.Runner(loop_factory=VirtualClockLoop) as runner:
+                report = runner.run(LoadTest(args, participants, workdir).run())
+            print_report(report)
+            reports.append(report)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+    
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+        print(f"\nОтчет сохранен в {args.json}")
+
+if __name__ == '__main__':
+    main()
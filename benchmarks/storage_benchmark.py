@@ -0,0 +1,494 @@
+"""
+Микробенчмарки хранилища DatabaseManager
+Генерирует синтетические базы с рабочей схемой (таблицы, триггеры счетчиков
+и полей анализа) и настоящим шифрованием на 10k, 100k и 1M сообщений чата,
+затем замеряет основные операции хранилища на каждом размере при разном
+числе одновременных потоков. Результаты пишутся в JSON и сравниваются с
+предыдущим прогоном, чтобы любое изменение хранилища оценивалось по базовой линии.
+
+Запуск:
+    python -m benchmarks.storage_benchmark --sizes 10000 100000 1000000 --output after.json --baseline before.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Config читает окружение при импорте, поэтому значения по умолчанию задаются до импорта модулей бота
+os.environ.setdefault('BOT_TOKEN', '0:storage-benchmark')
+os.environ.setdefault('ENCRYPTION_KEY', 'storage-benchmark-encryption-key-0123')
+
+from config.settings import Config
+from handlers.admin_handler import AdminHandler
+from utils.database import DatabaseManager
+from utils.randomization import ParticipantRandomizer
+
+logger = logging.getLogger(__name__)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+USER_ID_BASE = 20_000_000
+
+# Сколько разных шифротекстов генерировать: Fernet дорог, а размер и стоимость
+# расшифровки у повторяющихся шифротекстов те же, что у уникальных
+CIPHERTEXT_POOL = 1024
+
+# Размер пачки executemany при генерации
+INSERT_BATCH = 10000
+
+MESSAGES = [
+    "Я думаю, что лучше промолчать, ведь партнер тоже может молчать",
+    "Если я признаюсь, то получу меньший срок, это рационально",
+    "Не уверен, что можно доверять второму заключенному",
+    "I would stay silent, cooperation seems fair",
+    "Why should I trust the other prisoner?",
+    "Понимаю вашу позицию. Подумайте, как поступил бы ваш партнер.",
+    "Интересная мысль. Что повлияло на ваш выбор?",
+    "What happens if we both confess?"
+]
+
+ANALYSIS_VALUES = {
+    'emotion': ['positive', 'negative', 'neutral', 'anxious', 'frustrated', 'cooperative', 'defensive'],
+    'intent': ['cooperate', 'defect', 'question', 'complaint', 'confusion', 'agreement', 'disagreement'],
+    'confidence': ['high', 'medium', 'low'],
+    'persuasion_resistance': ['high', 'medium', 'low'],
+    'nudging_effectiveness': ['high', 'medium', 'low'],
+    'risk_of_dropout': ['high', 'medium', 'low']
+}
+
+THEMES = ['trust', 'risk', 'fairness', 'punishment', 'cooperation', 'self_interest']
+
+# ---------------------------------------------------------------------------
+# Генерация данных
+# ---------------------------------------------------------------------------
+
+def _analysis(rng: random.Random) -> Dict:
+    analysis = {field: rng.choice(values) for field, values in ANALYSIS_VALUES.items()}
+    analysis['key_themes'] = rng.sample(THEMES, 2)
+    analysis['suggested_response'] = rng.choice(MESSAGES)
+    analysis['analysis_method'] = 'llm'
+    return analysis
+
+def generate_dataset(path: str, rows: int, messages_per_participant: int, seed: int) -> Dict:
+    """
+    Создает базу с рабочей схемой и rows сообщениями чата
+    
+    Участников rows / messages_per_participant; сообщения участников
+    перемежаются во времени, как при одновременных сессиях. На каждое
+    сообщение участника приходится строка llm_analysis, у завершивших
+    участников есть решение и ответы опроса.
+    
+    Returns:
+        Описание набора: число строк по таблицам и время генерации
+    """
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    db = DatabaseManager(path)
+    randomizer = ParticipantRandomizer()
+    
+    pool = [db._encrypt_data(rng.choice(MESSAGES)) for _ in range(CIPHERTEXT_POOL)]
+    n_participants = max(1, rows // messages_per_participant)
+    base_time = datetime(2025, 1, 1)
+    
+    participants = []
+    seen = set()
+    user_id = USER_ID_BASE
+    while len(participants) < n_participants:
+        user_id += 1
+        # Короткий хеш ID иногда совпадает, а participant_id уникален
+        participant_id = randomizer.generate_participant_id(user_id)
+        if participant_id in seen:
+            continue
+        seen.add(participant_id)
+        start = base_time + timedelta(seconds=len(participants) * 7)
+        decided = rng.random() < 0.8
+        participants.append((
+            participant_id, user_id, rng.choice(['ru', 'en']), rng.choice(['confess', 'silent']),
+            start, start + timedelta(minutes=10) if decided else None,
+            rng.choice(['confess', 'silent']) if decided else None,
+            start + timedelta(minutes=10) if decided else None,
+            messages_per_participant // 2
+        ))
+    
+    with sqlite3.connect(path) as conn:
+        conn.executemany('''
+            INSERT INTO participants (participant_id, telegram_user_id, language, experiment_group,
+                                      start_time, end_time, final_decision, decision_time, total_messages)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', participants)
+        
+        # Сообщения упорядочены по времени: сессии участников пересекаются
+        messages = []
+        analyses = []
+        for index in range(rows):
+            participant = participants[index % n_participants]
+            turn = index // n_participants
+            timestamp = participant[4] + timedelta(seconds=turn * 30)
+            message_type = 'user' if turn % 2 == 0 else 'bot'
+            messages.append((participant[0], message_type, rng.choice(pool), timestamp))
+            if message_type == 'user':
+                analyses.append((
+                    participant[0], rng.choice(MESSAGES), json.dumps(_analysis(rng), ensure_ascii=False),
+                    rng.choice(MESSAGES), timestamp
+                ))
+            if len(messages) >= INSERT_BATCH:
+                conn.executemany('''
+                    INSERT INTO chat_messages (participant_id, message_type, message_content, timestamp)
+                    VALUES (?, ?, ?, ?)
+                ''', messages)
+                messages.clear()
+            if len(analyses) >= INSERT_BATCH:
+                conn.executemany('''
+                    INSERT INTO llm_analysis (participant_id, user_message, analysis_json, bot_response, timestamp)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', analyses)
+                analyses.clear()
+        
+        conn.executemany('''
+            INSERT INTO chat_messages (participant_id, message_type, message_content, timestamp)
+            VALUES (?, ?, ?, ?)
+        ''', messages)
+        conn.executemany('''
+            INSERT INTO llm_analysis (participant_id, user_message, analysis_json, bot_response, timestamp)
+            VALUES (?, ?, ?, ?, ?)
+        ''', analyses)
+        
+        surveys = [
+            (p[0], rng.choice(['yes', 'no']), rng.choice(['helpful', 'manipulative', 'unsure']),
+             rng.randint(1, 5), rng.choice(pool))
+            for p in participants if p[6]
+        ]
+        conn.executemany('''
+            INSERT INTO survey_responses (participant_id, question_1, question_2, question_3, question_4)
+            VALUES (?, ?, ?, ?, ?)
+        ''', surveys)
+        conn.commit()
+        
+        counts = {
+            table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ('participants', 'chat_messages', 'llm_analysis', 'survey_responses')
+        }
+    
+    return {
+        'rows': rows,
+        'tables': counts,
+        'generated_seconds': time.perf_counter() - started,
+        'size_bytes': os.path.getsize(path)
+    }
+
+def prepare_dataset(data_dir: str, rows: int, messages_per_participant: int, seed: int) -> Dict:
+    """Возвращает набор из кеша data_dir или создает его"""
+    path = os.path.join(data_dir, f"storage_{rows}_{messages_per_participant}_{seed}.db")
+    meta_path = f"{path}.json"
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path, encoding='utf-8') as f:
+            return {**json.load(f), 'path': path}
+    
+    if os.path.exists(path):
+        os.remove(path)
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    print(f"Генерация набора на {rows} сообщений...", flush=True)
+    meta = generate_dataset(tmp_path, rows, messages_per_participant, seed)
+    os.replace(tmp_path, path)
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    print(f"  готово за {meta['generated_seconds']:.1f}с, {meta['size_bytes'] / 1024 / 1024:.0f} МБ", flush=True)
+    return {**meta, 'path': path}
+
+# ---------------------------------------------------------------------------
+# Операции
+# ---------------------------------------------------------------------------
+
+class Workload:
+    """Выбирает аргументы операций из существующих в наборе данных"""
+    
+    def __init__(self, db_path: str, seed: int):
+        with sqlite3.connect(db_path) as conn:
+            rows = conn.execute("SELECT participant_id, telegram_user_id FROM participants").fetchall()
+        self.participant_ids = [row[0] for row in rows]
+        self.user_ids = [row[1] for row in rows]
+        self.next_user_id = max(self.user_ids) + 1
+        self.seed = seed
+        self._lock = threading.Lock()
+    
+    def new_user_id(self) -> int:
+        with self._lock:
+            self.next_user_id += 1
+            return self.next_user_id
+
+def _op_save_chat_message(db: DatabaseManager, admin: AdminHandler, workload: Workload, rng: random.Random):
+    db.save_chat_message(rng.choice(workload.participant_ids), 'user', rng.choice(MESSAGES))
+
+def _op_get_chat_transcript(db: DatabaseManager, admin: AdminHandler, workload: Workload, rng: random.Random):
+    db.get_chat_transcript(rng.choice(workload.participant_ids))
+
+def _op_get_experiment_statistics(db: DatabaseManager, admin: AdminHandler, workload: Workload, rng: random.Random):
+    db.get_experiment_statistics()
+
+def _op_log_llm_analysis(db: DatabaseManager, admin: AdminHandler, workload: Workload, rng: random.Random):
+    return db.log_llm_analysis(
+        participant_id=rng.choice(workload.participant_ids),
+        user_message=rng.choice(MESSAGES),
+        analysis=_analysis(rng),
+        bot_response=rng.choice(MESSAGES)
+    )
+
+def _op_check_user_eligibility(db: DatabaseManager, admin: AdminHandler, workload: Workload, rng: random.Random):
+    # Половина запросов от уже участвовавших, половина - от новых пользователей
+    user_id = rng.choice(workload.user_ids) if rng.random() < 0.5 else workload.new_user_id()
+    return admin.check_user_eligibility(user_id)
+
+# Операция возвращает корутину, если метод асинхронный
+OPERATIONS: Dict[str, Callable] = {
+    'save_chat_message': _op_save_chat_message,
+    'get_chat_transcript': _op_get_chat_transcript,
+    'get_experiment_statistics': _op_get_experiment_statistics,
+    'log_llm_analysis': _op_log_llm_analysis,
+    'check_user_eligibility': _op_check_user_eligibility
+}
+
+class _ErrorCounter(logging.Handler):
+    """
+    Считает ошибки, которые DatabaseManager и AdminHandler пишут в лог
+    
+    Методы хранилища перехватывают исключения (например, database is locked),
+    поэтому неудачный вызов виден только по записи уровня ERROR.
+    """
+    
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+        self.messages = Counter()
+        self._lock = threading.Lock()
+    
+    def emit(self, record: logging.LogRecord):
+        with self._lock:
+            self.count += 1
+            self.messages[record.getMessage()[:80]] += 1
+
+def _percentiles(latencies: List[float]) -> Dict:
+    if not latencies:
+        return {'mean': None, 'p50': None, 'p95': None, 'p99': None, 'max': None}
+    values = np.asarray(latencies)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'mean': float(values.mean()), 'p50': float(p50), 'p95': float(p95),
+            'p99': float(p99), 'max': float(values.max())}
+
+def run_case(operation: str, db: DatabaseManager, admin: AdminHandler, workload: Workload,
+             concurrency: int, iterations: int, max_seconds: float, errors: _ErrorCounter) -> Dict:
+    """
+    Выполняет iterations вызовов операции в concurrency потоках
+    
+    У каждого потока свое соединение на вызов (как в DatabaseManager) и свой
+    event loop для асинхронных методов. Прогон останавливается досрочно по
+    max_seconds, чтобы медленные операции на больших наборах не шли часами.
+    """
+    func = OPERATIONS[operation]
+    shares = [iterations // concurrency + (1 if i < iterations % concurrency else 0) for i in range(concurrency)]
+    deadline = time.perf_counter() + max_seconds
+    start_barrier = threading.Barrier(concurrency)
+    
+    def worker(index: int) -> List[float]:
+        rng = random.Random(workload.seed * 1000 + index)
+        loop = asyncio.new_event_loop()
+        latencies = []
+        try:
+            start_barrier.wait()
+            for _ in range(shares[index]):
+                if time.perf_counter() > deadline:
+                    break
+                started = time.perf_counter()
+                result = func(db, admin, workload, rng)
+                if asyncio.iscoroutine(result):
+                    loop.run_until_complete(result)
+                latencies.append(time.perf_counter() - started)
+        finally:
+            loop.close()
+        return latencies
+    
+    errors_before = errors.count
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(worker, range(concurrency)))
+    elapsed = time.perf_counter() - started
+    
+    latencies = [value for result in results for value in result]
+    return {
+        'operation': operation,
+        'concurrency': concurrency,
+        'calls': len(latencies),
+        'errors': errors.count - errors_before,
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        **_percentiles(latencies)
+    }
+
+# ---------------------------------------------------------------------------
+# Отчет и сравнение
+# ---------------------------------------------------------------------------
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _key(result: Dict) -> tuple:
+    return result['operation'], result['rows'], result['concurrency']
+
+def _ms(value: Optional[float]) -> str:
+    return f"{value * 1000:10.2f}" if value is not None else f"{'-':>10}"
+
+def print_results(results: List[Dict], baseline: Dict[tuple, Dict] = None):
+    header = f"{'Операция':<28}{'строк':>9}{'потоков':>8}{'вызовов':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'оп/с':>10}{'ошибок':>7}"
+    if baseline:
+        header += f"{'p50 к базе':>12}{'оп/с к базе':>13}"
+    print(f"\n{header}")
+    for result in results:
+        line = (f"{result['operation']:<28}{result['rows']:>9}{result['concurrency']:>8}{result['calls']:>8}"
+                f"{_ms(result['p50'])}{_ms(result['p95'])}{_ms(result['p99'])}"
+                f"{result['throughput']:>10.1f}{result['errors']:>7}")
+        base = baseline.get(_key(result)) if baseline else None
+        if base and base.get('p50') and result['p50'] is not None and base.get('throughput'):
+            line += f"{result['p50'] / base['p50']:>11.2f}x{result['throughput'] / base['throughput']:>12.2f}x"
+        print(line)
+
+def find_regressions(results: List[Dict], baseline: Dict[tuple, Dict], threshold: float) -> List[Dict]:
+    """Случаи, где p50 вырос больше чем в threshold раз относительно базовой линии"""
+    regressions = []
+    for result in results:
+        base = baseline.get(_key(result))
+        if base and base.get('p50') and result['p50'] is not None and result['p50'] / base['p50'] > threshold:
+            regressions.append({**result, 'baseline_p50': base['p50']})
+    return regressions
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Микробенчмарки хранилища DatabaseManager")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                        help="Размеры наборов в сообщениях чата")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16],
+                        help="Число одновременных потоков")
+    parser.add_argument('--operations', nargs='+', choices=list(OPERATIONS), default=list(OPERATIONS))
+    parser.add_argument('--iterations', type=int, default=200, help="Вызовов на случай (операция, размер, потоки)")
+    parser.add_argument('--max-seconds', type=float, default=15.0, help="Ограничение времени на случай, сек")
+    parser.add_argument('--messages-per-participant', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--data-dir', default=None,
+                        help="Каталог кеша сгенерированных наборов (по умолчанию временный, удаляется)")
+    parser.add_argument('--output', default=None, help="Записать результаты в JSON файл")
+    parser.add_argument('--baseline', default=None, help="JSON предыдущего прогона для сравнения")
+    parser.add_argument('--threshold', type=float, default=1.2, help="Во сколько раз рост p50 считается регрессией")
+    parser.add_argument('--fail-on-regression', action='store_true', help="Код выхода 1 при регрессиях")
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(name)s - %(message)s')
+    errors = _ErrorCounter()
+    for name in ('utils.database', 'handlers.admin_handler'):
+        logging.getLogger(name).addHandler(errors)
+        logging.getLogger(name).propagate = False
+    
+    # Проверка права участия должна доходить до запроса к базе
+    Config.TESTING_MODE = False
+    Config.ALLOW_MULTIPLE_SESSIONS = False
+    
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='storage_benchmark_')
+    os.makedirs(data_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='storage_benchmark_work_')
+    cwd = os.getcwd()
+    
+    datasets = []
+    results = []
+    try:
+        # AdminHandler создает DatabaseManager по относительному пути, поэтому работаем во временном каталоге
+        os.makedirs(os.path.join(work_dir, 'data'))
+        os.chdir(work_dir)
+        for rows in args.sizes:
+            dataset = prepare_dataset(data_dir, rows, args.messages_per_participant, args.seed)
+            datasets.append({key: value for key, value in dataset.items() if key != 'path'})
+            
+            # Записи бенчмарка не должны менять кешированный набор
+            work_path = os.path.join(work_dir, f"work_{rows}.db")
+            shutil.copyfile(dataset['path'], work_path)
+            db = DatabaseManager(work_path)
+            admin = AdminHandler()
+            admin.db = db
+            workload = Workload(work_path, args.seed)
+            
+            for operation in args.operations:
+                for concurrency in args.concurrency:
+                    result = run_case(operation, db, admin, workload, concurrency,
+                                      args.iterations, args.max_seconds, errors)
+                    result['rows'] = rows
+                    results.append(result)
+                    print(f"  {operation} rows={rows} threads={concurrency}: "
+                          f"p50 {_ms(result['p50']).strip()} мс, {result['throughput']:.1f} оп/с", flush=True)
+            os.remove(work_path)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = {_key(result): result for result in json.load(f)['results']}
+    
+    print_results(results, baseline)
+    if errors.messages:
+        print(f"\nОшибки в логах хранилища: {dict(errors.messages)}")
+    
+    report = {
+        'benchmark': 'storage',
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'parameters': {
+            key: value for key, value in vars(args).items()
+            if key not in ('output', 'baseline', 'data_dir', 'fail_on_regression')
+        },
+        'datasets': datasets,
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены в {args.output}")
+    
+    if baseline:
+        regressions = find_regressions(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"Регрессия: {regression['operation']} rows={regression['rows']} threads={regression['concurrency']}: "
+                  f"p50 {regression['p50'] * 1000:.2f} мс против {regression['baseline_p50'] * 1000:.2f} мс")
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
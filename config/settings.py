@@ -15,6 +15,11 @@ class Config:
     WEBHOOK_URL = os.getenv('WEBHOOK_URL')
     WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
     
+    # Метрики Prometheus (/metrics), отдельный порт в режимах polling и webhook
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+    METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+    METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+    
     # База данных
     DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///data/experiment.db')
     
@@ -28,6 +33,18 @@ class Config:
     # Логирование
     LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
     LOG_FILE = os.getenv('LOG_FILE', 'logs/bot.log')
+    # text или json (одна запись - одна строка JSON с trace_id)
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+    # Уровни отдельных модулей: 'httpx=WARNING,utils.database=DEBUG'
+    LOG_LEVELS = os.getenv('LOG_LEVELS', 'httpx=WARNING')
+    # Ротация: size (LOG_MAX_BYTES) или time (LOG_ROTATE_WHEN), старые файлы сжимаются
+    LOG_ROTATION = os.getenv('LOG_ROTATION', 'size')
+    LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+    LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 10))
+    LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', 'midnight')
+    LOG_COMPRESS = os.getenv('LOG_COMPRESS', 'true').lower() == 'true'
+    # Доля записей частых событий (успешные вызовы LLM), попадающих в лог
+    LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.05))
     
     # NLP сервисы
     GOOGLE_TRANSLATE_API_KEY = os.getenv('GOOGLE_TRANSLATE_API_KEY')
@@ -35,10 +52,72 @@ class Config:
     
     # LLM Configuration
     CLOUD_RU_API_KEY = os.getenv('CLOUD_RU_API_KEY', '')
+    # Общая модель; по умолчанию используется как резервная
     LLM_MODEL = os.getenv('LLM_MODEL', 'GigaChat/GigaChat-2-Max')
+    # Модели по назначению: маленькая для классификации и анализа потока, большая для ответов
+    LLM_ANALYSIS_MODEL = os.getenv('LLM_ANALYSIS_MODEL', 't-tech/T-lite-it-1.0')
+    LLM_FLOW_MODEL = os.getenv('LLM_FLOW_MODEL', LLM_ANALYSIS_MODEL)
+    # Ответы участникам - часть экспериментального воздействия: модель не зависит от LLM_MODEL
+    LLM_RESPONSE_MODEL = os.getenv('LLM_RESPONSE_MODEL', 'Qwen/Qwen3-235B-A22B-Instruct-2507')
+    # Резервная модель для анализа и анализа потока, если основная не ответила
+    LLM_FALLBACK_MODEL = os.getenv('LLM_FALLBACK_MODEL', LLM_MODEL)
+    # Резервная модель ответов - только явно: подмена модели меняет воздействие на участника
+    LLM_RESPONSE_FALLBACK_MODEL = os.getenv('LLM_RESPONSE_FALLBACK_MODEL', '')
+    # Сколько секунд не обращаться к модели после сбоя
+    LLM_MODEL_COOLDOWN_SECONDS = int(os.getenv('LLM_MODEL_COOLDOWN_SECONDS', 60))
+    # Бэкенды LLM: cloud_ru, openai (любой OpenAI-совместимый endpoint), local (локальная модель на CPU)
+    LLM_BACKEND = os.getenv('LLM_BACKEND', 'cloud_ru')
+    LLM_ANALYSIS_BACKEND = os.getenv('LLM_ANALYSIS_BACKEND', LLM_BACKEND)
+    LLM_FLOW_BACKEND = os.getenv('LLM_FLOW_BACKEND', LLM_ANALYSIS_BACKEND)
+    LLM_RESPONSE_BACKEND = os.getenv('LLM_RESPONSE_BACKEND', LLM_BACKEND)
+    LLM_FALLBACK_BACKEND = os.getenv('LLM_FALLBACK_BACKEND', LLM_BACKEND)
+    LLM_RESPONSE_FALLBACK_BACKEND = os.getenv('LLM_RESPONSE_FALLBACK_BACKEND', LLM_RESPONSE_BACKEND)
+    LLM_REQUEST_TIMEOUT = int(os.getenv('LLM_REQUEST_TIMEOUT', 30))
+    OPENAI_COMPATIBLE_BASE_URL = os.getenv('OPENAI_COMPATIBLE_BASE_URL', '')
+    OPENAI_COMPATIBLE_API_KEY = os.getenv('OPENAI_COMPATIBLE_API_KEY', '')
+    # Локальная модель GGUF (требуется llama-cpp-python)
+    LOCAL_LLM_MODEL_PATH = os.getenv('LOCAL_LLM_MODEL_PATH', '')
+    LOCAL_LLM_THREADS = int(os.getenv('LOCAL_LLM_THREADS', 2))
+    LOCAL_LLM_CONTEXT_SIZE = int(os.getenv('LOCAL_LLM_CONTEXT_SIZE', 4096))
+    # Микро-батчинг анализа сообщений разных участников
+    LLM_BATCHING_ENABLED = os.getenv('LLM_BATCHING_ENABLED', 'false').lower() == 'true'
+    LLM_BATCH_MAX_SIZE = int(os.getenv('LLM_BATCH_MAX_SIZE', 8))
+    LLM_BATCH_MAX_WAIT_MS = int(os.getenv('LLM_BATCH_MAX_WAIT_MS', 30))
     LLM_ENABLED = os.getenv('LLM_ENABLED', 'true').lower() == 'true'
     LLM_ANALYSIS_ENABLED = os.getenv('LLM_ANALYSIS_ENABLED', 'true').lower() == 'true'
     LLM_SYSTEM_PROMPT = os.getenv('LLM_SYSTEM_PROMPT', 'Ты эксперт по анализу человеческого поведения в экспериментах. Анализируй сообщения и возвращай результат в формате JSON.')
+    # Время жизни кеша префиксов у провайдера (для локальной оценки попаданий)
+    LLM_PREFIX_CACHE_TTL_SECONDS = int(os.getenv('LLM_PREFIX_CACHE_TTL_SECONDS', 300))
+    
+    # Деградация под нагрузкой: full -> no_flow -> heuristic -> template
+    DEGRADATION_ENABLED = os.getenv('DEGRADATION_ENABLED', 'true').lower() == 'true'
+    DEGRADATION_CHECK_INTERVAL = float(os.getenv('DEGRADATION_CHECK_INTERVAL', 5))
+    # Пороги для каждого следующего режима: глубина очереди LLM, задержка event loop (сек), доля ошибок
+    DEGRADATION_QUEUE_THRESHOLDS = [float(x) for x in os.getenv('DEGRADATION_QUEUE_THRESHOLDS', '20,40,80').split(',')]
+    DEGRADATION_LAG_THRESHOLDS = [float(x) for x in os.getenv('DEGRADATION_LAG_THRESHOLDS', '0.25,0.5,1.0').split(',')]
+    DEGRADATION_ERROR_THRESHOLDS = [float(x) for x in os.getenv('DEGRADATION_ERROR_THRESHOLDS', '0.25,0.5,0.8').split(',')]
+    # Сколько спокойных проверок подряд нужно для возврата на режим выше
+    DEGRADATION_RECOVERY_CHECKS = int(os.getenv('DEGRADATION_RECOVERY_CHECKS', 3))
+    
+    # Мониторинг задержки event loop и поиск блокирующих вызовов
+    LOOP_MONITOR_ENABLED = os.getenv('LOOP_MONITOR_ENABLED', 'true').lower() == 'true'
+    LOOP_MONITOR_INTERVAL = float(os.getenv('LOOP_MONITOR_INTERVAL', 0.1))
+    # Задержка, начиная с которой в лог пишется стек заблокировавшего loop кода, сек
+    LOOP_BLOCK_THRESHOLD = float(os.getenv('LOOP_BLOCK_THRESHOLD', 0.1))
+    
+    # Трассировка обновлений в JSONL: доля обычных трасс и порог медленных (сохраняются всегда), сек
+    TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'true').lower() == 'true'
+    TRACE_FILE = os.getenv('TRACE_FILE', 'logs/traces.jsonl')
+    TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0.05))
+    TRACE_SLOW_THRESHOLD = float(os.getenv('TRACE_SLOW_THRESHOLD', 3.0))
+    # Ротация файла трасс по размеру (0 - без ротации); сжатие как у логов (LOG_COMPRESS)
+    TRACE_MAX_BYTES = int(os.getenv('TRACE_MAX_BYTES', 50 * 1024 * 1024))
+    TRACE_BACKUP_COUNT = int(os.getenv('TRACE_BACKUP_COUNT', 5))
+    
+    # Параллельная обработка обновлений (порядок внутри пользователя сохраняется)
+    UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 16))
+    # Сколько обновлений принимать в обработку всего, включая ожидающих своей очереди
+    UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', 256))
     
     # Admin Configuration
     ADMIN_USER_IDS = os.getenv('ADMIN_USER_IDS', '').split(',') if os.getenv('ADMIN_USER_IDS') else []
@@ -69,6 +148,30 @@ class Config:
     # Время обсуждения (в минутах)
     DISCUSSION_TIME_MINUTES = 10
     
+    # Сколько последних реплик разговора хранить в памяти (промпты используют до 6)
+    CONVERSATION_WINDOW = int(os.getenv('CONVERSATION_WINDOW', '6'))
+    
+    @classmethod
+    def get_llm_model_routing(cls) -> dict:
+        """Возвращает цепочки (бэкенд, модель) по назначению вызова: основная, затем резервная"""
+        routing = {
+            'analysis': [(cls.LLM_ANALYSIS_BACKEND, cls.LLM_ANALYSIS_MODEL)],
+            'flow': [(cls.LLM_FLOW_BACKEND, cls.LLM_FLOW_MODEL)],
+            'response': [(cls.LLM_RESPONSE_BACKEND, cls.LLM_RESPONSE_MODEL)]
+        }
+        fallbacks = {
+            'analysis': (cls.LLM_FALLBACK_BACKEND, cls.LLM_FALLBACK_MODEL),
+            'flow': (cls.LLM_FALLBACK_BACKEND, cls.LLM_FALLBACK_MODEL),
+            # Ответы участникам не переходят на LLM_FALLBACK_MODEL: без явной
+            # резервной модели при сбое используется шаблонный ответ
+            'response': (cls.LLM_RESPONSE_FALLBACK_BACKEND, cls.LLM_RESPONSE_FALLBACK_MODEL)
+        }
+        # Резервная модель, совпадающая с основной, не добавляется: повтор того же вызова не поможет
+        for purpose, fallback in fallbacks.items():
+            if fallback[1] and fallback not in routing[purpose]:
+                routing[purpose].append(fallback)
+        return routing
+    
     @classmethod
     def validate(cls):
         """Проверяет корректность конфигурации"""
@@ -97,6 +200,12 @@ class Config:
         if cls.WEBHOOK_PORT < 1 or cls.WEBHOOK_PORT > 65535:
             errors.append("WEBHOOK_PORT должен быть в диапазоне 1-65535")
         
+        if cls.METRICS_ENABLED and not 1 <= cls.METRICS_PORT <= 65535:
+            errors.append("METRICS_PORT должен быть в диапазоне 1-65535")
+        
+        if cls.CONVERSATION_WINDOW < 6:
+            errors.append("CONVERSATION_WINDOW должен быть не меньше 6 (окно истории в промптах)")
+        
         if errors:
             raise ValueError(f"Ошибки конфигурации: {'; '.join(errors)}")
         
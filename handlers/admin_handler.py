@@ -2,22 +2,41 @@
 Админский обработчик для управления экспериментом
 """
 
+import asyncio
 import logging
+import os
 from datetime import datetime
 from typing import Dict, List, Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
 from config.settings import Config
+from utils.admin_jobs import (
+    AdminJobRunner, EXPORT_DIR, TELEGRAM_DOCUMENT_LIMIT, parse_since, run_export, run_report
+)
 from utils.database import DatabaseManager
+from utils.memory import MemoryInspector, format_bytes, format_diff, format_structures, process_rss
+from utils.profiling import SamplingProfiler, format_profile_summary
 
 logger = logging.getLogger(__name__)
 
+EXPORT_FORMATS = ['jsonl', 'parquet']
+
+# Лимит длины сообщения Telegram
+MESSAGE_LIMIT = 4096
+
 class AdminHandler:
     """Обработчик админских функций"""
     
-    def __init__(self):
+    def __init__(self, experiment_handler=None):
         self.db = DatabaseManager()
+        self.experiment_handler = experiment_handler
+        self.jobs = AdminJobRunner()
+        self.timings = None  # HandlerTimings, устанавливается ботом
+        self.loop_monitor = None  # LoopMonitor, устанавливается ботом
+        self.profiler = SamplingProfiler()
+        self.memory = MemoryInspector()
+        self._profile_task = None
         self.admin_user_ids = []
         for uid in Config.ADMIN_USER_IDS:
             if uid.strip():
@@ -28,11 +47,8 @@ class AdminHandler:
         
     def is_admin(self, user_id: int) -> bool:
         """Проверяет, является ли пользователь админом"""
-        logger.info(f"Проверка админских прав для user_id: {user_id}")
-        logger.info(f"Список админов: {self.admin_user_ids}")
-        logger.info(f"Config.ADMIN_USER_IDS: {Config.ADMIN_USER_IDS}")
         result = user_id in self.admin_user_ids
-        logger.info(f"Результат проверки: {result}")
+        logger.debug(f"Проверка админских прав для user_id {user_id}: {result}")
         return result
     
     async def handle_admin_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -55,12 +71,22 @@ class AdminHandler:
             await self._list_active_sessions(update, context)
         elif command == "export":
             await self._export_data(update, context)
+        elif command == "report":
+            await self._send_report(update, context)
         elif command == "toggle_testing":
             await self._toggle_testing_mode(update, context)
         elif command == "prompt":
             await self._manage_system_prompt(update, context)
         elif command == "llm_status":
             await self._show_llm_status(update, context)
+        elif command == "profile":
+            await self._manage_profiler(update, context)
+        elif command == "timings":
+            await self._show_timings(update, context)
+        elif command == "loop":
+            await self._show_loop_lag(update, context)
+        elif command == "memory":
+            await self._manage_memory(update, context)
         else:
             await update.message.reply_text("❌ Неизвестная команда. Используйте /admin help")
     
@@ -72,7 +98,8 @@ class AdminHandler:
 **Основные команды:**
 `/admin stats` - Показать статистику эксперимента
 `/admin list` - Список активных сессий
-`/admin export` - Экспорт данных
+`/admin export [jsonl|parquet] [since]` - Выгрузить таблицы в zip архив
+`/admin report` - Отчет по эксперименту файлом
 
 **Управление пользователями:**
 `/admin reset <user_id>` - Сбросить сессию пользователя
@@ -88,10 +115,24 @@ class AdminHandler:
 • `/admin prompt set <промпт>` - установить новый промпт
 • `/admin prompt reset` - сбросить к умолчанию
 
+**Производительность:**
+• `/admin timings` - время обработчиков по стадиям
+• `/admin timings reset` - сбросить статистику времени
+• `/admin loop` - задержка event loop и блокирующие вызовы
+• `/admin memory` - размеры сессий, историй, опросов и задач
+• `/admin memory snapshot` - запомнить снимок выделений памяти
+• `/admin memory diff` - рост памяти с момента снимка
+• `/admin memory stop` - остановить tracemalloc
+• `/admin profile start [секунды]` - запустить профилировщик
+• `/admin profile stop` - остановить и показать профиль
+
 **Примеры:**
 `/admin reset 123456789` - Сбросить сессию пользователя 123456789
 `/admin stats` - Показать статистику
+`/admin export parquet 7d` - Выгрузить изменения за последние 7 дней
+`/admin export jsonl 2025-01-15` - Выгрузить строки начиная с 15 января (UTC)
 `/admin prompt set Ты помощник по этике` - Установить новый промпт
+`/admin profile start 60` - Снять профиль за 60 секунд
 """
         await update.message.reply_text(help_text, parse_mode='Markdown')
     
@@ -128,6 +169,18 @@ class AdminHandler:
             if 'llm_analyses' in stats:
                 stats_text += f"\n🧠 **LLM анализов:** {stats['llm_analyses']}"
             
+            processor = context.application.update_processor
+            if hasattr(processor, 'get_stats'):
+                updates = processor.get_stats()
+                stats_text += (
+                    f"\n\n⚙️ **Обработка обновлений:**\n"
+                    f"• Выполняется: {updates['running']} из {updates['concurrency']}\n"
+                    f"• Ожидают: {updates['waiting']}\n"
+                    f"• Пользователей с очередью: {updates['users_with_backlog']} "
+                    f"(макс. глубина {updates['max_user_depth']}, за все время {updates['max_user_depth_seen']})\n"
+                    f"• Ожидание: среднее {updates['avg_wait']:.2f}с, макс. {updates['max_wait']:.2f}с"
+                )
+            
             await update.message.reply_text(stats_text)
             
         except Exception as e:
@@ -238,38 +291,99 @@ class AdminHandler:
             await update.message.reply_text("❌ Ошибка при получении списка сессий.")
     
     async def _export_data(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Экспортирует данные эксперимента"""
+        """Выгружает таблицы в zip архив в фоновом процессе и отправляет документом"""
+        args = context.args[1:]
+        fmt = 'jsonl'
+        if args and args[0] in EXPORT_FORMATS:
+            fmt = args.pop(0)
+        
         try:
-            # Получаем статистику
-            stats = self.db.get_experiment_statistics()
-            
-            # Получаем LLM данные
-            llm_data = await self.db.get_llm_analysis_data()
-            
-            export_text = f"""
-📤 **Экспорт данных:**
-
-📊 **Статистика:**
-• Всего участников: {stats.get('total_participants', 0)}
-• Завершили: {stats.get('completed', 0)}
-• LLM анализов: {len(llm_data)}
-
-💾 **Данные сохранены в базе данных**
-• Участники: таблица `participants`
-• LLM анализ: таблица `llm_analysis`
-• Поток разговоров: таблица `conversation_flow`
-• Опросы: таблица `survey_responses`
-
-🔍 **Для получения данных используйте:**
-`/admin stats` - статистика
-`/admin list` - активные сессии
-"""
-            
-            await update.message.reply_text(export_text)
-            
+            since = parse_since(args[0] if args else None)
+        except ValueError as e:
+            await update.message.reply_text(
+                f"❌ {e}\nИспользование: `/admin export [jsonl|parquet] [7d|12h|YYYY-MM-DD]`",
+                parse_mode='Markdown'
+            )
+            return
+        
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        suffix = f"_since_{since[:10]}" if since else ""
+        output_path = os.path.join(EXPORT_DIR, f"experiment_{fmt}{suffix}_{stamp}.zip")
+        
+        await self._start_job(
+            update, context, 'export', f"Экспорт ({fmt})",
+            run_export, self.db.db_path, output_path, fmt, since
+        )
+    
+    async def _send_report(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Строит отчет DataAnalyzer в фоновом процессе и отправляет документом"""
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        output_path = os.path.join(EXPORT_DIR, f"report_{stamp}.zip")
+        await self._start_job(update, context, 'report', "Отчет", run_report, self.db.db_path, output_path)
+    
+    async def _start_job(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                         name: str, title: str, func, *args):
+        """
+        Запускает задачу и сразу возвращается
+        
+        Ожидание задачи в обработчике на все время выгрузки заняло бы слот
+        обработки обновлений и очередь сообщений администратора.
+        """
+        if self.jobs.busy:
+            await update.message.reply_text(f"⏳ Уже выполняется задача: {self.jobs.current_job}. Попробуйте позже.")
+            return
+        
+        progress_message = await update.message.reply_text(f"⏳ {title}: запуск...")
+        context.application.create_task(
+            self._run_job(update, progress_message, name, title, func, *args),
+            update=update
+        )
+    
+    async def _run_job(self, update: Update, progress_message, name: str, title: str, func, *args):
+        """Выполняет задачу в рабочем процессе, показывает прогресс и отправляет файл"""
+        # edit_text возвращает новое сообщение, а progress_message.text не меняется:
+        # последний отправленный текст храним сами, чтобы не слать одинаковые правки
+        last_text = progress_message.text
+        
+        async def on_progress(stage: str, rows: int):
+            nonlocal last_text
+            text = f"⏳ {title}: {stage}" + (f" - {rows} строк" if rows else "...")
+            if text != last_text:
+                await progress_message.edit_text(text)
+                last_text = text
+        
+        try:
+            result = await self.jobs.run(name, func, *args, on_progress=on_progress)
+        except Exception as e:
+            logger.error(f"Ошибка фоновой задачи {name}: {e}")
+            await progress_message.edit_text(f"❌ {title}: ошибка - {e}")
+            return
+        
+        path = result['path']
+        size_mb = result['size'] / (1024 * 1024)
+        rows = "\n".join(f"• {table}: {count}" for table, count in result['rows'].items())
+        
+        if result['size'] > TELEGRAM_DOCUMENT_LIMIT:
+            await progress_message.edit_text(
+                f"⚠️ {title}: архив {size_mb:.1f} МБ больше лимита Telegram, "
+                f"файл сохранен на сервере: {path}"
+            )
+            return
+        
+        try:
+            with open(path, 'rb') as document:
+                await update.message.reply_document(
+                    document=document,
+                    filename=os.path.basename(path),
+                    caption=f"📦 {title}, {size_mb:.1f} МБ" + (f"\n{rows}" if rows else "")
+                )
+            await progress_message.edit_text(f"✅ {title}: готово")
         except Exception as e:
-            logger.error(f"Ошибка при экспорте данных: {e}")
-            await update.message.reply_text("❌ Ошибка при экспорте данных.")
+            logger.error(f"Ошибка отправки файла {path}: {e}")
+            await progress_message.edit_text(f"❌ {title}: не удалось отправить файл, он сохранен на сервере: {path}")
+            return
+        
+        os.remove(path)
     
     async def _toggle_testing_mode(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Переключает режим тестирования"""
@@ -415,18 +529,25 @@ class AdminHandler:
         try:
             from config.settings import Config
             
+            llm_analyzer = getattr(self.experiment_handler, 'llm_analyzer', None)
+            if llm_analyzer:
+                await llm_analyzer.check_backends_health()
+            
             status_text = f"""
 🤖 **Статус LLM:**
 
 **Настройки:**
 • LLM включен: {'✅' if Config.LLM_ENABLED else '❌'}
 • Анализ включен: {'✅' if Config.LLM_ANALYSIS_ENABLED else '❌'}
-• Модель: `{Config.LLM_MODEL}`
+• Модель ответов: `{Config.LLM_RESPONSE_BACKEND}:{Config.LLM_RESPONSE_MODEL}`
+• Модель анализа: `{Config.LLM_ANALYSIS_BACKEND}:{Config.LLM_ANALYSIS_MODEL}`
+• Модель анализа потока: `{Config.LLM_FLOW_BACKEND}:{Config.LLM_FLOW_MODEL}`
+• Резервная модель: `{Config.LLM_FALLBACK_BACKEND}:{Config.LLM_FALLBACK_MODEL}`
 • API ключ: {'✅ Настроен' if Config.CLOUD_RU_API_KEY else '❌ Не настроен'}
 
 **Системный промпт:**
 `{Config.LLM_SYSTEM_PROMPT[:100]}{'...' if len(Config.LLM_SYSTEM_PROMPT) > 100 else ''}`
-
+{self._format_service_mode()}{self._format_llm_metrics()}
 **Команды:**
 • `/admin prompt` - управление системным промптом
 • `/admin llm_status` - показать этот статус
@@ -437,3 +558,215 @@ class AdminHandler:
         except Exception as e:
             logger.error(f"Ошибка при показе статуса LLM: {e}")
             await update.message.reply_text("❌ Произошла ошибка при получении статуса LLM.")
+    
+    def _format_service_mode(self) -> str:
+        """Форматирует текущий режим обслуживания и последние переключения"""
+        degradation = getattr(self.experiment_handler, 'degradation', None)
+        if not degradation:
+            return ""
+        
+        status = degradation.get_status()
+        metrics = status['metrics']
+        
+        text = f"""
+**Режим обслуживания:** `{status['mode']}` с {status['mode_since'][:19]} {'' if status['running'] else '(мониторинг выключен)'}
+"""
+        if metrics:
+            text += (
+                f"• Очередь LLM: {metrics['queue_depth']}, задержка loop: {metrics['loop_lag'] * 1000:.0f} мс, "
+                f"ошибки: {metrics['error_rate'] * 100:.0f}%\n"
+            )
+        
+        for change in self.db.get_service_mode_changes(limit=3):
+            text += f"• {change['timestamp']}: `{change['previous_mode']}` → `{change['new_mode']}`\n"
+        
+        return text
+    
+    def _format_llm_metrics(self) -> str:
+        """Форматирует метрики LLM анализатора для статуса"""
+        llm_analyzer = getattr(self.experiment_handler, 'llm_analyzer', None)
+        if not llm_analyzer:
+            return ""
+        
+        metrics = llm_analyzer.get_metrics()
+        cache = metrics['prefix_cache']
+        
+        backends_text = ""
+        for name, stats in metrics['backends'].items():
+            health = {True: '✅', False: '❌', None: '❔'}[stats['healthy']]
+            backends_text += (
+                f"• `{name}` {health}: {stats['calls']} вызовов, ошибок {stats['errors']}, "
+                f"среднее {stats['avg_latency'] * 1000:.0f} мс\n"
+            )
+        
+        models_text = ""
+        for model, stats in metrics['models'].items():
+            models_text += (
+                f"• `{model}`: {stats['calls']} вызовов, ошибок {stats['errors']}, "
+                f"среднее {stats['avg_latency'] * 1000:.0f} мс, макс {stats['max_latency'] * 1000:.0f} мс\n"
+            )
+        
+        batcher = getattr(self.experiment_handler, 'analysis_batcher', None)
+        if batcher:
+            batch_stats = batcher.get_stats()
+            models_text += (
+                f"\n**Батчинг анализа:** {batch_stats['batches']} пакетов, "
+                f"{batch_stats['items']} сообщений, средний размер {batch_stats['avg_batch_size']:.1f}\n"
+            )
+        
+        return f"""
+**Бэкенды:**
+{backends_text or 'Нет настроенных бэкендов'}
+**Задержка по моделям:**
+{models_text or 'Вызовов пока не было'}
+**Кеш префиксов (оценка):**
+• Запросов: {cache['requests']}
+• Попаданий: {cache['hits']} ({cache['hit_rate'] * 100:.1f}%)
+• Уникальных префиксов: {cache['unique_prefixes']}
+• Закешировано токенов (оценка): {cache['estimated_cached_tokens']}
+• Закешировано токенов (провайдер): {cache['provider_cached_tokens']} из {cache['provider_prompt_tokens']}
+"""
+    
+    async def _show_timings(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Показывает время обработчиков по стадиям или сбрасывает статистику"""
+        if self.timings is None:
+            await update.message.reply_text("❌ Замер времени обработчиков не подключен.")
+            return
+        
+        if len(context.args) > 1 and context.args[1] == "reset":
+            self.timings.reset()
+            await update.message.reply_text("✅ Статистика времени обработчиков сброшена.")
+            return
+        
+        # Без Markdown: имена обработчиков и функций содержат подчеркивания
+        await update.message.reply_text(self.timings.format_summary()[:MESSAGE_LIMIT])
+    
+    async def _show_loop_lag(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Показывает гистограмму задержки event loop и последние блокировки"""
+        if self.loop_monitor is None:
+            await update.message.reply_text("❌ Мониторинг event loop не подключен.")
+            return
+        
+        await update.message.reply_text(self.loop_monitor.format_summary()[:MESSAGE_LIMIT])
+    
+    async def _manage_memory(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Показывает размеры структур в памяти и сравнивает снимки выделений"""
+        action = context.args[1] if len(context.args) > 1 else None
+        
+        try:
+            if action is None:
+                await update.message.reply_text(self._format_memory(context)[:MESSAGE_LIMIT])
+            
+            elif action == "snapshot":
+                # Снимок tracemalloc занимает заметное время, event loop не блокируем
+                result = await asyncio.to_thread(self.memory.take_snapshot)
+                note = (
+                    "\ntracemalloc запущен сейчас: учитываются только выделения после этого момента."
+                    if result['started_now'] else ""
+                )
+                await update.message.reply_text(
+                    f"📸 Снимок памяти сохранен, отслеживается {format_bytes(result['traced'])}.{note}\n"
+                    f"Сравнить: /admin memory diff"
+                )
+            
+            elif action == "diff":
+                if self.memory.snapshot is None:
+                    await update.message.reply_text("❌ Сначала сохраните снимок: /admin memory snapshot")
+                    return
+                diff = await asyncio.to_thread(self.memory.diff)
+                await update.message.reply_text(format_diff(diff)[:MESSAGE_LIMIT])
+            
+            elif action == "stop":
+                self.memory.stop()
+                await update.message.reply_text("✅ tracemalloc остановлен, снимок удален.")
+            
+            else:
+                await update.message.reply_text("❌ Используйте /admin memory [snapshot|diff|stop]")
+        
+        except Exception as e:
+            logger.error(f"Ошибка при анализе памяти: {e}")
+            await update.message.reply_text(f"❌ Ошибка при анализе памяти: {e}")
+    
+    def _format_memory(self, context: ContextTypes.DEFAULT_TYPE) -> str:
+        """Размеры структур обработчиков и задач JobQueue"""
+        handler = self.experiment_handler
+        survey_handler = getattr(handler, 'survey_handler', None)
+        active_sessions = getattr(handler, 'active_sessions', {})
+        
+        sizes = self.memory.structure_sizes({
+            'active_sessions': active_sessions,
+            'conversation_history': getattr(handler, 'conversation_history', None),
+            'survey_sessions': getattr(survey_handler, 'survey_sessions', None)
+        })
+        jobs = self.memory.job_counts(context.application.job_queue, active_users=set(active_sessions))
+        text = format_structures(sizes, jobs, self.memory.stale_sessions(active_sessions), process_rss())
+        
+        if self.memory.snapshot_at:
+            text += f"\n\nСнимок памяти от {self.memory.snapshot_at.strftime('%H:%M:%S')}: /admin memory diff"
+        return text
+    
+    async def _manage_profiler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Запускает и останавливает сэмплирующий профилировщик"""
+        action = context.args[1] if len(context.args) > 1 else None
+        
+        if action == "start":
+            if self.profiler.running:
+                await update.message.reply_text("⏳ Профилирование уже запущено. Используйте /admin profile stop")
+                return
+            
+            seconds = None
+            if len(context.args) > 2:
+                try:
+                    seconds = float(context.args[2])
+                except ValueError:
+                    seconds = 0
+                if not 0 < seconds <= self.profiler.max_seconds:
+                    await update.message.reply_text(
+                        f"❌ Длительность должна быть числом от 1 до {self.profiler.max_seconds:.0f} секунд."
+                    )
+                    return
+            
+            # Обработчик выполняется в потоке event loop, его и профилируем
+            self.profiler.start()
+            if seconds:
+                self._profile_task = context.application.create_task(
+                    self._stop_profiler_after(update, seconds), update=update
+                )
+                await update.message.reply_text(f"🔬 Профилирование запущено на {seconds:.0f}с.")
+            else:
+                await update.message.reply_text(
+                    f"🔬 Профилирование запущено (не дольше {self.profiler.max_seconds:.0f}с). "
+                    f"Остановить: /admin profile stop"
+                )
+        
+        elif action == "stop":
+            if not self.profiler.running:
+                await update.message.reply_text("❌ Профилирование не запущено.")
+                return
+            
+            if self._profile_task:
+                self._profile_task.cancel()
+                self._profile_task = None
+            await self._reply_profile(update)
+        
+        else:
+            await update.message.reply_text("❌ Используйте /admin profile start [секунды] или /admin profile stop")
+    
+    async def _stop_profiler_after(self, update: Update, seconds: float):
+        """Останавливает профилирование через заданное время и отправляет сводку"""
+        await asyncio.sleep(seconds)
+        self._profile_task = None
+        if self.profiler.running:
+            await self._reply_profile(update)
+    
+    async def _reply_profile(self, update: Update):
+        """Останавливает профилировщик и отправляет сводку профиля"""
+        try:
+            # Запись профиля на диск не должна блокировать event loop
+            summary = await asyncio.to_thread(self.profiler.stop)
+        except Exception as e:
+            logger.error(f"Ошибка при остановке профилирования: {e}")
+            await update.message.reply_text(f"❌ Не удалось сохранить профиль: {e}")
+            return
+        
+        await update.message.reply_text(format_profile_summary(summary)[:MESSAGE_LIMIT])
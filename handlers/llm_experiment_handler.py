@@ -5,7 +5,7 @@
 import asyncio
 import logging
 import random
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Dict, Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
@@ -14,6 +14,10 @@ from utils.database import DatabaseManager
 from utils.randomization import ParticipantRandomizer
 from utils.multilingual import MultilingualManager
 from utils.llm_analyzer import LLMAnalyzer
+from utils.llm_batcher import AnalysisBatcher
+from utils.degradation import DegradationController
+from utils.session import ConversationHistory, ExperimentSession, Turn
+from utils.tracing import set_attributes
 from handlers.survey_handler import SurveyHandler
 from handlers.admin_handler import AdminHandler
 from config.nudging_texts import CONFESS_NUDGING_TEXTS, SILENT_NUDGING_TEXTS
@@ -29,13 +33,16 @@ class LLMExperimentHandler:
         self.randomizer = ParticipantRandomizer()
         self.multilingual = MultilingualManager()
         self.llm_analyzer = LLMAnalyzer()
+        self.analysis_batcher = AnalysisBatcher(self.llm_analyzer) if Config.LLM_BATCHING_ENABLED else None
+        # Мониторинг запускается из main после старта event loop
+        self.degradation = DegradationController(self.llm_analyzer, self.db, self.analysis_batcher)
         self.survey_handler = survey_handler  # Используем переданный экземпляр
         self.admin_handler = AdminHandler()
         # Используем прямые импорты текстов
         self.confess_texts = CONFESS_NUDGING_TEXTS
         self.silent_texts = SILENT_NUDGING_TEXTS
         
-        # Активные сессии
+        # Активные сессии (ExperimentSession) и последние реплики разговоров (ConversationHistory)
         self.active_sessions = {}
         self.conversation_history = {}
         
@@ -106,21 +113,10 @@ class LLMExperimentHandler:
             group = self.randomizer.assign_group(participant_id)
             
             # Создаем сессию
-            session_data = {
-                'participant_id': participant_id,
-                'user_id': user_id,
-                'username': username,
-                'group': group,
-                'language': language,
-                'start_time': datetime.now(),
-                'end_time': datetime.now() + timedelta(minutes=Config.DISCUSSION_TIME_MINUTES),
-                'message_count': 0,
-                'last_activity': datetime.now(),
-                'conversation_messages': []
-            }
+            session_data = ExperimentSession(participant_id, user_id, username, group, language)
             
             self.active_sessions[user_id] = session_data
-            self.conversation_history[user_id] = []
+            self.conversation_history[user_id] = ConversationHistory()
             
             # Записываем в базу данных (или обновляем существующего)
             try:
@@ -198,12 +194,18 @@ class LLMExperimentHandler:
             return
         
         session_data = self.active_sessions[user_id]
-        language = session_data['language']
+        language = session_data.language
         
         try:
             # Обновляем время начала обсуждения
-            session_data['discussion_start_time'] = datetime.now()
-            session_data['discussion_end_time'] = datetime.now() + timedelta(minutes=Config.DISCUSSION_TIME_MINUTES)
+            discussion_start = session_data.start_discussion()
+            
+            await self.db.init_participant_features(
+                participant_id=session_data.participant_id,
+                experiment_group=session_data.group,
+                language=language,
+                discussion_start=discussion_start
+            )
             
             # Отправляем сообщение о начале обсуждения
             if language == 'ru':
@@ -232,7 +234,7 @@ class LLMExperimentHandler:
             
             # Сохраняем message_id для обновления счетчика времени
             if message:
-                session_data['timer_message_id'] = message.message_id
+                session_data.timer_message_id = message.message_id
             
             # Отправляем автоматический первый вопрос с небольшой задержкой
             await asyncio.sleep(2)  # 2 секунды задержки
@@ -268,11 +270,12 @@ class LLMExperimentHandler:
             except Exception as e2:
                 logger.warning(f"Не удалось отредактировать сообщение об ошибке: {e2}")
     
-    async def _send_opening_question(self, context: ContextTypes.DEFAULT_TYPE, user_id: int, session_data: Dict):
+    async def _send_opening_question(self, context: ContextTypes.DEFAULT_TYPE, user_id: int,
+                                     session_data: ExperimentSession):
         """Отправляет автоматический первый вопрос участнику"""
         try:
-            language = session_data['language']
-            experiment_group = session_data['group']
+            language = session_data.language
+            experiment_group = session_data.group
             
             # Выбираем тексты в зависимости от группы
             if experiment_group == 'confess':
@@ -291,7 +294,7 @@ class LLMExperimentHandler:
             )
             
             # Сохраняем вопрос в базе данных
-            self.db.save_chat_message(session_data['participant_id'], 'bot', opening_question)
+            self.db.save_chat_message(session_data.participant_id, 'bot', opening_question)
             
             logger.info(f"Отправлен открывающий вопрос пользователю {user_id}: {opening_question}")
             
@@ -307,26 +310,25 @@ class LLMExperimentHandler:
         
         session_data = self.active_sessions[user_id]
         
-        if 'discussion_start_time' not in session_data:
+        if not session_data.discussion_started:
             return
         
         try:
-            # Вычисляем оставшееся время
-            elapsed = datetime.now() - session_data['discussion_start_time']
-            remaining = timedelta(minutes=Config.DISCUSSION_TIME_MINUTES) - elapsed
+            # Вычисляем оставшееся время, сек
+            remaining = Config.DISCUSSION_TIME_MINUTES * 60 - session_data.discussion_elapsed()
             
-            if remaining.total_seconds() <= 0:
+            if remaining <= 0:
                 # Время истекло, завершаем обсуждение
                 await self._end_experiment_timer(context)
                 return
             
             # Форматируем время
-            minutes = int(remaining.total_seconds() // 60)
-            seconds = int(remaining.total_seconds() % 60)
+            minutes = int(remaining // 60)
+            seconds = int(remaining % 60)
             time_str = f"{minutes}:{seconds:02d}"
             
             # Обновляем сообщение с новым временем
-            if session_data['language'] == 'ru':
+            if session_data.language == 'ru':
                 discussion_text = (
                     "🎯 **Обсуждение началось!**\n\n"
                     "Теперь у вас есть 10 минут, чтобы поделиться своими мыслями о дилемме заключенного. "
@@ -348,10 +350,10 @@ class LLMExperimentHandler:
             try:
                 # Находим последнее сообщение с таймером и обновляем его
                 # Для этого нужно сохранить message_id в session_data
-                if 'timer_message_id' in session_data:
+                if session_data.timer_message_id is not None:
                     await context.bot.edit_message_text(
                         chat_id=user_id,
-                        message_id=session_data['timer_message_id'],
+                        message_id=session_data.timer_message_id,
                         text=discussion_text,
                         parse_mode='Markdown',
                         reply_markup=reply_markup
@@ -376,8 +378,8 @@ class LLMExperimentHandler:
         session_data = self.active_sessions[user_id]
         
         # Проверяем, началось ли обсуждение
-        if 'discussion_start_time' not in session_data:
-            if session_data['language'] == 'ru':
+        if not session_data.discussion_started:
+            if session_data.language == 'ru':
                 await update.message.reply_text(
                     "Пожалуйста, сначала нажмите кнопку 'Начать обсуждение' в предыдущем сообщении."
                 )
@@ -395,46 +397,62 @@ class LLMExperimentHandler:
                 return
             
             # Проверяем, не истекло ли время
-            if datetime.now() > session_data['end_time']:
+            if session_data.expired:
                 await self._end_experiment(update, context, user_id)
                 return
             
             # Обновляем счетчик сообщений
-            session_data['message_count'] += 1
-            session_data['last_activity'] = datetime.now()
-            
-            # Добавляем сообщение в историю
-            self.conversation_history[user_id].append({
-                'text': user_message,
-                'timestamp': datetime.now(),
-                'sender': 'user'
-            })
+            session_data.touch()
+            received_at = datetime.now()
+            history = self.conversation_history[user_id]
             
             # Показываем сообщение о подготовке ответа
             typing_message = await update.message.reply_text("Пишу ответ...")
             
+            # Режим фиксируется на весь ход, чтобы в базе он соответствовал обработке
+            service_mode = self.degradation.mode
+            set_attributes(
+                participant_id=session_data.participant_id,
+                group=session_data.group,
+                message_count=session_data.message_count,
+                service_mode=service_mode
+            )
+            
             # Анализируем сообщение с помощью LLM
             context_for_analysis = {
-                'group': session_data['group'],
-                'time_elapsed': (datetime.now() - session_data['start_time']).total_seconds() / 60,
-                'message_count': session_data['message_count'],
-                'language': session_data['language']
+                'group': session_data.group,
+                'time_elapsed': session_data.elapsed_minutes(),
+                'message_count': session_data.message_count,
+                'language': session_data.language
             }
             
-            analysis = self.llm_analyzer.analyze_message(user_message, context_for_analysis)
+            if not self.degradation.allows_llm_analysis(service_mode):
+                analysis = self.llm_analyzer.heuristic_analysis(user_message)
+            elif self.analysis_batcher:
+                analysis = await self.analysis_batcher.analyze(user_message, context_for_analysis)
+            else:
+                analysis = await self.llm_analyzer.analyze_message(user_message, context_for_analysis)
+            set_attributes(analysis_method=analysis.get('analysis_method'))
             
             # Генерируем персонализированный ответ с учетом истории разговора
-            if self.llm_analyzer.api_key and analysis.get('analysis_method') != 'basic':
-                bot_response = self.llm_analyzer.generate_personalized_response(
-                    user_message, analysis, context_for_analysis, 
-                    self.conversation_history.get(user_id, [])
+            if not self.degradation.allows_llm_response(service_mode):
+                bot_response = self._get_standard_response(
+                    session_data.group,
+                    session_data.language,
+                    analysis
+                )
+            elif self.llm_analyzer.has_backend('response') and analysis.get('analysis_method') != 'basic':
+                # Текущее сообщение идет последним, как ожидает LLMAnalyzer
+                bot_response = await self.llm_analyzer.generate_personalized_response(
+                    user_message, analysis, context_for_analysis,
+                    list(history) + [Turn('user', user_message)]
                 )
             else:
                 # Используем разнообразные ответы из анализа
                 bot_response = analysis.get('suggested_response', 
                     self._get_standard_response(
-                        session_data['group'], 
-                        session_data['language'],
+                        session_data.group, 
+                        session_data.language,
                         analysis
                     )
                 )
@@ -443,41 +461,46 @@ class LLMExperimentHandler:
             await typing_message.delete()
             await update.message.reply_text(bot_response)
             
-            # Добавляем ответ бота в историю
-            self.conversation_history[user_id].append({
-                'text': bot_response,
-                'timestamp': datetime.now(),
-                'sender': 'bot'
-            })
+            # Участник видел этот ход: он идет в контекст следующих промптов независимо от записи в базу
+            history.add('user', user_message)
+            history.add('bot', bot_response)
             
             # Логируем анализ
             self.llm_analyzer.log_analysis(user_id, user_message, analysis, bot_response)
             
             # Сохраняем в базу данных
-            await self.db.log_llm_analysis(
-                participant_id=session_data['participant_id'],
+            logged = await self.db.log_llm_analysis(
+                participant_id=session_data.participant_id,
                 user_message=user_message,
                 analysis=analysis,
-                bot_response=bot_response
+                bot_response=bot_response,
+                service_mode=service_mode
+            )
+            if not logged:
+                logger.warning(f"Ход участника {session_data.participant_id} не записан в llm_analysis")
+            await self.db.update_message_features(
+                participant_id=session_data.participant_id,
+                message=user_message,
+                analysis=analysis,
+                message_time=received_at
             )
             
-            # Анализируем поток разговора
-            if len(self.conversation_history[user_id]) >= 3:
-                flow_analysis = self.llm_analyzer.analyze_conversation_flow(
-                    self.conversation_history[user_id]
-                )
+            # Анализируем поток разговора (пропускается при перегрузке)
+            if len(history) >= 3 and self.degradation.allows_flow_analysis(service_mode):
+                flow_analysis = await self.llm_analyzer.analyze_conversation_flow(history)
                 
                 # Сохраняем анализ потока
                 await self.db.log_conversation_flow(
-                    participant_id=session_data['participant_id'],
+                    participant_id=session_data.participant_id,
                     flow_analysis=flow_analysis
                 )
+                await self.db.update_flow_features(session_data.participant_id, flow_analysis)
             
             # Проверяем, не нужно ли предупреждение о времени
-            time_remaining = (session_data['end_time'] - datetime.now()).total_seconds() / 60
-            if time_remaining <= 1 and not session_data.get('warning_sent', False):
-                await self._send_time_warning(update, context, session_data['language'])
-                session_data['warning_sent'] = True
+            time_remaining = session_data.remaining_minutes()
+            if time_remaining <= 1 and not session_data.warning_sent:
+                await self._send_time_warning(update, context, session_data.language)
+                session_data.warning_sent = True
             
         except Exception as e:
             logger.error(f"Ошибка при обработке сообщения: {e}")
@@ -491,15 +514,14 @@ class LLMExperimentHandler:
         
         if user_id in self.active_sessions:
             session_data = self.active_sessions[user_id]
-            start_time = session_data['start_time']
-            elapsed = (datetime.now() - start_time).total_seconds()
+            elapsed = session_data.elapsed_minutes() * 60
             remaining = max(0, 600 - elapsed)  # 10 минут = 600 секунд
             
             if remaining > 0:
                 minutes = int(remaining // 60)
                 seconds = int(remaining % 60)
                 
-                if session_data['language'] == 'ru':
+                if session_data.language == 'ru':
                     if minutes > 0:
                         time_message = f"⏰ Осталось времени: {minutes} мин {seconds} сек"
                     else:
@@ -545,7 +567,7 @@ class LLMExperimentHandler:
             session_data = self.active_sessions[user_id]
             
             # Анализируем финальное состояние разговора
-            if self.conversation_history[user_id]:
+            if self.conversation_history[user_id] and self.degradation.allows_flow_analysis():
                 # Показываем сообщение об анализе
                 if update and update.message:
                     typing_message = await update.message.reply_text("Анализирую разговор...")
@@ -556,12 +578,12 @@ class LLMExperimentHandler:
                         text="Анализирую разговор..."
                     )
                 
-                final_analysis = self.llm_analyzer.analyze_conversation_flow(
+                final_analysis = await self.llm_analyzer.analyze_conversation_flow(
                     self.conversation_history[user_id]
                 )
                 
                 await self.db.log_final_conversation_analysis(
-                    participant_id=session_data['participant_id'],
+                    participant_id=session_data.participant_id,
                     final_analysis=final_analysis
                 )
                 
@@ -573,9 +595,9 @@ class LLMExperimentHandler:
             
             # Записываем завершение эксперимента
             await self.db.log_experiment_completion(
-                participant_id=session_data['participant_id'],
+                participant_id=session_data.participant_id,
                 end_time=datetime.now(),
-                total_messages=session_data['message_count']
+                total_messages=session_data.message_count
             )
             
             # Очищаем сессию
@@ -585,8 +607,8 @@ class LLMExperimentHandler:
             # Показываем опрос
             await self.survey_handler.start_survey(
                 update, context, 
-                session_data['participant_id'], 
-                session_data['language'],
+                session_data.participant_id, 
+                session_data.language,
                 user_id
             )
             
@@ -682,13 +704,13 @@ class LLMExperimentHandler:
             return
         
         session_data = self.active_sessions[user_id]
-        time_remaining = (session_data['end_time'] - datetime.now()).total_seconds() / 60
+        time_remaining = session_data.remaining_minutes()
         
         status_text = f"""
 📊 Статус эксперимента:
-👤 Группа: {session_data['group']}
-🌍 Язык: {session_data['language']}
-💬 Сообщений: {session_data['message_count']}
+👤 Группа: {session_data.group}
+🌍 Язык: {session_data.language}
+💬 Сообщений: {session_data.message_count}
 ⏰ Осталось времени: {max(0, time_remaining):.1f} минут
 """
         
@@ -744,12 +766,12 @@ class LLMExperimentHandler:
             # Задача была отменена - это нормально
             pass
     
-    async def _show_final_decision(self, bot, user_id: int, session_data: Dict):
+    async def _show_final_decision(self, bot, user_id: int, session_data: ExperimentSession):
         """Показывает финальное решение с кнопками"""
         try:
             logger.info(f"Показываем финальное решение для пользователя {user_id}")
             
-            if session_data['language'] == 'ru':
+            if session_data.language == 'ru':
                 message_text = (
                     "⏰ **Время эксперимента истекло!**\n\n"
                     "Теперь вам нужно принять финальное решение в дилемме заключенного.\n\n"
@@ -849,32 +871,35 @@ class LLMExperimentHandler:
         
         try:
             # Записываем финальное решение
+            decision_time = datetime.now()
             await self.db.log_final_decision(
-                participant_id=session_data['participant_id'],
+                participant_id=session_data.participant_id,
                 decision=decision,
-                decision_time=datetime.now()
+                decision_time=decision_time
             )
+            await self.db.update_decision_features(session_data.participant_id, decision, decision_time)
             
             # Анализируем финальное состояние разговора
-            if user_id in self.conversation_history and self.conversation_history[user_id]:
-                final_analysis = self.llm_analyzer.analyze_conversation_flow(
+            if (user_id in self.conversation_history and self.conversation_history[user_id]
+                    and self.degradation.allows_flow_analysis()):
+                final_analysis = await self.llm_analyzer.analyze_conversation_flow(
                     self.conversation_history[user_id]
                 )
                 
                 await self.db.log_final_conversation_analysis(
-                    participant_id=session_data['participant_id'],
+                    participant_id=session_data.participant_id,
                     final_analysis=final_analysis
                 )
             
             # Записываем завершение эксперимента
             await self.db.log_experiment_completion(
-                participant_id=session_data['participant_id'],
+                participant_id=session_data.participant_id,
                 end_time=datetime.now(),
-                total_messages=session_data['message_count']
+                total_messages=session_data.message_count
             )
             
             # Показываем благодарность
-            if session_data['language'] == 'ru':
+            if session_data.language == 'ru':
                 decision_text = "признались" if decision == "confess" else "решили молчать"
                 thank_you_text = (
                     f"🎉 **Спасибо за участие в эксперименте!**\n\n"
@@ -911,8 +936,8 @@ class LLMExperimentHandler:
             try:
                 await self.survey_handler.start_survey(
                     update, context, 
-                    session_data['participant_id'], 
-                    session_data['language'],
+                    session_data.participant_id, 
+                    session_data.language,
                     user_id
                 )
             except Exception as e:
@@ -8,6 +8,7 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
 from utils.database import DatabaseManager
+from utils.metrics import SURVEY_COMPLETIONS
 from utils.validation import InputValidator
 from config.nudging_texts import COMMON_TEXTS
 
@@ -213,7 +214,9 @@ class SurveyHandler:
         # Сохраняем в базу данных
         try:
             self.db.save_survey_response(participant_id, survey_responses)
+            await self.db.update_survey_features(participant_id, survey_responses)
             logger.info(f"Ответы опроса сохранены для участника {participant_id}")
+            SURVEY_COMPLETIONS.labels(language).inc()
         except Exception as e:
             logger.error(f"Ошибка сохранения ответов опроса: {e}")
         
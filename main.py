@@ -14,19 +14,39 @@ from handlers.llm_experiment_handler import LLMExperimentHandler
 from handlers.survey_handler import SurveyHandler
 from handlers.admin_handler import AdminHandler
 from utils.database import DatabaseManager
+from utils.update_processor import PerUserUpdateProcessor
+from utils.profiling import HandlerTimings, InstrumentedRequest
+from utils.loop_monitor import LoopMonitor
+from utils import metrics
+from utils.tracing import Tracer
+from utils.logging_setup import setup_logging
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=getattr(logging, Config.LOG_LEVEL),
-    handlers=[
-        logging.FileHandler(Config.LOG_FILE),
-        logging.StreamHandler()
-    ]
+# Настройка логирования: запись в файл и консоль в фоновом потоке, с ротацией
+setup_logging(
+    level=Config.LOG_LEVEL,
+    log_file=Config.LOG_FILE,
+    json_format=Config.LOG_FORMAT == 'json',
+    module_levels=Config.LOG_LEVELS,
+    rotation=Config.LOG_ROTATION,
+    max_bytes=Config.LOG_MAX_BYTES,
+    backup_count=Config.LOG_BACKUP_COUNT,
+    when=Config.LOG_ROTATE_WHEN,
+    compress=Config.LOG_COMPRESS
 )
 
 logger = logging.getLogger(__name__)
 
+# Префиксы callback data в порядке проверки в handle_callback
+CALLBACK_PREFIXES = ('lang_', 'start_discussion_', 'survey_', 'final_decision_', 'decision_')
+
+def _callback_label(update: Update):
+    """Тип callback запроса для статистики времени обработчиков"""
+    data = update.callback_query.data if update.callback_query else None
+    for prefix in CALLBACK_PREFIXES:
+        if data and data.startswith(prefix):
+            return prefix.rstrip('_')
+    return 'other'
+
 class PrisonersDilemmaBot:
     """Основной класс бота для эксперимента"""
     
@@ -55,7 +75,29 @@ class PrisonersDilemmaBot:
         
         # Устанавливаем experiment_handler в survey_handler
         self.survey_handler.experiment_handler = self.experiment_handler
-        self.admin_handler = AdminHandler()
+        self.admin_handler = AdminHandler(self.experiment_handler)
+        
+        # Время обработчиков по стадиям, доступно админу через /admin timings
+        self.timings = HandlerTimings()
+        self.admin_handler.timings = self.timings
+        
+        # Задержка event loop и блокирующие вызовы, доступно админу через /admin loop
+        self.loop_monitor = LoopMonitor(
+            interval=Config.LOOP_MONITOR_INTERVAL,
+            threshold=Config.LOOP_BLOCK_THRESHOLD
+        )
+        self.admin_handler.loop_monitor = self.loop_monitor
+        self.metrics_server = None
+        
+        # Трассы обновлений с выборкой: медленные и с ошибками сохраняются всегда
+        self.tracer = Tracer(
+            path=Config.TRACE_FILE,
+            sample_rate=Config.TRACE_SAMPLE_RATE,
+            slow_threshold=Config.TRACE_SLOW_THRESHOLD,
+            max_bytes=Config.TRACE_MAX_BYTES,
+            backup_count=Config.TRACE_BACKUP_COUNT,
+            compress=Config.LOG_COMPRESS
+        )
         
         # Инициализируем активные сессии
         self.active_sessions = getattr(self.experiment_handler, 'active_sessions', {})
@@ -212,20 +254,76 @@ class PrisonersDilemmaBot:
             except:
                 pass
     
+    async def _post_init(self, application: Application):
+        """Запускает фоновые задачи после старта event loop"""
+        if Config.LOOP_MONITOR_ENABLED:
+            self.loop_monitor.start()
+        
+        if Config.METRICS_ENABLED:
+            metrics.STATE.bind(
+                experiment_handler=self.experiment_handler,
+                survey_handler=self.survey_handler,
+                update_processor=application.update_processor,
+                loop_monitor=self.loop_monitor if Config.LOOP_MONITOR_ENABLED else None
+            )
+            self.metrics_server = metrics.start_metrics_server(Config.METRICS_PORT, Config.METRICS_HOST)
+        
+        degradation = getattr(self.experiment_handler, 'degradation', None)
+        if degradation and Config.DEGRADATION_ENABLED:
+            degradation.loop_monitor = self.loop_monitor
+            degradation.start()
+    
+    async def _post_shutdown(self, application: Application):
+        """Останавливает рабочие процессы фоновых задач админки, мониторинг, сервер метрик, запись трасс и бэкенды LLM"""
+        self.admin_handler.jobs.shutdown()
+        degradation = getattr(self.experiment_handler, 'degradation', None)
+        if degradation:
+            await degradation.stop()
+        await self.loop_monitor.stop()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server = None
+        self.tracer.close()
+        
+        llm_analyzer = getattr(self.experiment_handler, 'llm_analyzer', None)
+        if llm_analyzer:
+            await llm_analyzer.close()
+    
+    def _build_application(self) -> Application:
+        """Создает приложение с параллельной обработкой обновлений и обработчиками"""
+        application = (
+            Application.builder()
+            .token(self.config.BOT_TOKEN)
+            .request(InstrumentedRequest())
+            .concurrent_updates(PerUserUpdateProcessor(
+                concurrency=self.config.UPDATE_CONCURRENCY,
+                max_pending=self.config.UPDATE_MAX_PENDING
+            ))
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+            .build()
+        )
+        
+        # Добавляем обработчики, каждый с замером времени по стадиям и трассировкой
+        def timed(name, callback, label=None):
+            if Config.TRACING_ENABLED:
+                callback = self.tracer.wrap(name, callback, label)
+            return self.timings.wrap(name, callback, label)
+        
+        application.add_handler(CommandHandler("start", timed('start', self.start_command)))
+        application.add_handler(CommandHandler("help", timed('help', self.help_command)))
+        application.add_handler(CommandHandler("status", timed('status', self.status_command)))
+        application.add_handler(CommandHandler("admin", timed('admin', self.admin_command)))
+        application.add_handler(CallbackQueryHandler(timed('callback', self.handle_callback, _callback_label)))
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed('message', self.handle_message)))
+        
+        return application
+    
     def run_polling(self):
         """Запускает бота в режиме polling"""
         logger.info("Запуск бота в режиме polling...")
         
-        # Создаем приложение
-        application = Application.builder().token(self.config.BOT_TOKEN).build()
-        
-        # Добавляем обработчики
-        application.add_handler(CommandHandler("start", self.start_command))
-        application.add_handler(CommandHandler("help", self.help_command))
-        application.add_handler(CommandHandler("status", self.status_command))
-        application.add_handler(CommandHandler("admin", self.admin_command))
-        application.add_handler(CallbackQueryHandler(self.handle_callback))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+        application = self._build_application()
         
         # Запускаем бота
         application.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -234,16 +332,7 @@ class PrisonersDilemmaBot:
         """Запускает бота в режиме webhook"""
         logger.info("Запуск бота в режиме webhook...")
         
-        # Создаем приложение
-        application = Application.builder().token(self.config.BOT_TOKEN).build()
-        
-        # Добавляем обработчики
-        application.add_handler(CommandHandler("start", self.start_command))
-        application.add_handler(CommandHandler("help", self.help_command))
-        application.add_handler(CommandHandler("status", self.status_command))
-        application.add_handler(CommandHandler("admin", self.admin_command))
-        application.add_handler(CallbackQueryHandler(self.handle_callback))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+        application = self._build_application()
         
         # Настраиваем webhook
         if self.config.WEBHOOK_URL:
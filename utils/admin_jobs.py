@@ -0,0 +1,143 @@
+"""
+Фоновые задачи админки: экспорт данных и отчет
+Задачи выполняются в отдельном процессе (spawn), результат пишется в zip
+архив, а прогресс передается в бота через очередь менеджера процессов
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = "data/exports"
+
+# Ограничение Bot API на размер отправляемого документа
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+# Как часто бот забирает прогресс из очереди, сек
+PROGRESS_INTERVAL = 2.0
+
+def parse_since(value: Optional[str]) -> Optional[str]:
+    """
+    Разбирает аргумент since: 7d, 12h, YYYY-MM-DD или YYYY-MM-DDTHH:MM
+    
+    Returns:
+        Время в UTC в формате CURRENT_TIMESTAMP SQLite или None
+    """
+    if not value:
+        return None
+    
+    relative = re.fullmatch(r'(\d+)([dh])', value)
+    if relative:
+        amount, unit = int(relative.group(1)), relative.group(2)
+        moment = datetime.utcnow() - (timedelta(days=amount) if unit == 'd' else timedelta(hours=amount))
+    else:
+        try:
+            moment = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"Неверный формат since: {value}")
+    
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+def _reporter(queue) -> Callable[[str, int], None]:
+    def report(stage: str, rows: int):
+        queue.put((stage, rows))
+    return report
+
+def run_export(db_path: str, output_path: str, fmt: str, since: Optional[str], queue) -> Dict:
+    """Выгружает таблицы в zip архив (выполняется в рабочем процессе)"""
+    from utils.export import StreamingExporter
+    from utils.snapshot import SnapshotManager
+    
+    # Долгое чтение рабочей базы держало бы блокировку и задерживало записи бота
+    queue.put(('snapshot', 0))
+    snapshot = SnapshotManager(db_path).create()
+    
+    exporter = StreamingExporter(snapshot, since=since, progress=_reporter(queue))
+    rows = exporter.export_archive(output_path, fmt)
+    return {'path': output_path, 'rows': rows, 'size': os.path.getsize(output_path)}
+
+def run_report(db_path: str, output_path: str, queue) -> Dict:
+    """Строит текстовый отчет и упаковывает его в zip архив (выполняется в рабочем процессе)"""
+    from utils.data_analysis import DataAnalyzer
+    
+    queue.put(('snapshot', 0))
+    analyzer = DataAnalyzer.from_snapshot(db_path)
+    queue.put(('report', 0))
+    report = analyzer.generate_report()
+    
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with zipfile.ZipFile(output_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('report.txt', report)
+    return {'path': output_path, 'rows': {}, 'size': os.path.getsize(output_path)}
+
+class AdminJobRunner:
+    """Выполняет тяжелые задачи админки вне event loop, по одной за раз"""
+    
+    def __init__(self, max_workers: int = 1):
+        self.max_workers = max_workers
+        self._context = multiprocessing.get_context('spawn')
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._manager = None
+        self.current_job: Optional[str] = None
+    
+    @property
+    def busy(self) -> bool:
+        return self.current_job is not None
+    
+    def _start(self):
+        """Создает пул и менеджер очередей (блокирующий вызов, выполняется в потоке)"""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self._context)
+        if self._manager is None:
+            self._manager = self._context.Manager()
+    
+    async def run(self, name: str, func: Callable, *args,
+                  on_progress: Callable[[str, int], Awaitable[None]] = None) -> Dict:
+        """
+        Выполняет func(*args, queue) в рабочем процессе
+        
+        Args:
+            name: Имя задачи для статуса
+            func: Функция уровня модуля (должна импортироваться в рабочем процессе)
+            on_progress: Корутина, вызываемая с последним прогрессом (стадия, строки)
+        """
+        if self.busy:
+            raise RuntimeError(f"Уже выполняется задача {self.current_job}")
+        
+        self.current_job = name
+        try:
+            await asyncio.to_thread(self._start)
+            queue = self._manager.Queue()
+            future = asyncio.get_running_loop().run_in_executor(self._executor, func, *args, queue)
+            
+            while True:
+                done, _ = await asyncio.wait({future}, timeout=PROGRESS_INTERVAL)
+                latest = None
+                while not queue.empty():
+                    latest = queue.get_nowait()
+                if latest and on_progress:
+                    try:
+                        await on_progress(*latest)
+                    except Exception as e:
+                        logger.warning(f"Не удалось обновить прогресс задачи {name}: {e}")
+                if done:
+                    return future.result()
+        finally:
+            self.current_job = None
+    
+    def shutdown(self):
+        """Останавливает пул процессов и менеджер"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
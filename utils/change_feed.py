@@ -0,0 +1,155 @@
+"""
+Лента изменений для инкрементального экспорта
+Каждый потребитель хранит свою отметку (updated_at, id) по таблицам и при
+следующей синхронизации получает только новые и измененные строки
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+from typing import Dict, List
+
+from utils.export import StreamingExporter
+
+logger = logging.getLogger(__name__)
+
+# Таблицы ленты: участники изменяемы (отслеживаются по updated_at), остальные только дополняются
+FEED_TABLES = {
+    'participants': 'updated_at',
+    'chat_messages': None,
+    'llm_analysis': None,
+    'conversation_flow': None,
+    'survey_responses': None
+}
+
+class ChangeFeed:
+    """Лента изменений с сохраняемой отметкой для каждого потребителя"""
+    
+    def __init__(self, consumer: str, db_path: str = "data/experiment.db",
+                 state_dir: str = "data/change_feed", decrypt: bool = False):
+        """
+        Args:
+            consumer: Имя потребителя (например, nightly_sync); у каждого своя отметка
+            db_path: Путь к базе данных
+            state_dir: Каталог с файлами отметок потребителей
+            decrypt: Расшифровывать зашифрованные колонки
+        """
+        if not consumer or not consumer.replace('_', '').replace('-', '').isalnum():
+            raise ValueError(f"Недопустимое имя потребителя: {consumer}")
+        
+        self.consumer = consumer
+        self.state_path = os.path.join(state_dir, f"{consumer}.json")
+        self.exporter = StreamingExporter(db_path, decrypt=decrypt)
+    
+    def load_checkpoint(self) -> Dict[str, Dict]:
+        """Возвращает отметки по таблицам {таблица: {"id": int, "updated_at": str | None}}"""
+        checkpoint = {table: {'id': 0, 'updated_at': None} for table in FEED_TABLES}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                checkpoint.update(json.load(f).get('tables', {}))
+        return checkpoint
+    
+    def _save_checkpoint(self, checkpoint: Dict[str, Dict]):
+        """Атомарно сохраняет отметки: сначала во временный файл, затем переименование"""
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'consumer': self.consumer,
+                'saved_at': datetime.now().isoformat(),
+                'tables': checkpoint
+            }, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.state_path)
+    
+    def iter_changes(self, table: str, mark: Dict):
+        """
+        Отдает порции строк таблицы после отметки
+        
+        Для участников используется ключ (updated_at, id); строки текущей
+        секунды пропускаются, так как в эту секунду могут появиться еще
+        изменения с тем же updated_at и меньшим id.
+        """
+        if FEED_TABLES[table]:
+            updated_at = mark.get('updated_at') or ''
+            return self.exporter.iter_batches(
+                table,
+                where="(updated_at > ? OR (updated_at = ? AND id > ?)) AND updated_at < datetime('now')",
+                params=(updated_at, updated_at, mark.get('id', 0)),
+                order_by="updated_at, id"
+            )
+        return self.exporter.iter_batches(table, where="id > ?", params=(mark.get('id', 0),), order_by="id")
+    
+    def export(self, output_dir: str, tables: List[str] = None) -> Dict[str, Dict]:
+        """
+        Выгружает изменения после отметки в новые файлы JSONL (gzip)
+        
+        Отметка сохраняется только после записи всех таблиц, поэтому прерванная
+        синхронизация при повторе выгрузит те же строки заново.
+        
+        Returns:
+            Словарь {таблица: {"rows": int, "file": str | None}}
+        """
+        checkpoint = self.load_checkpoint()
+        stamp = datetime.now().strftime('%Y%m%dT%H%M%S_%f')
+        result = {}
+        
+        for table in tables or FEED_TABLES:
+            mark = dict(checkpoint[table])
+            path = os.path.join(output_dir, table, f"changes-{stamp}.jsonl.gz")
+            handle = None
+            rows_written = 0
+            
+            try:
+                for columns, rows in self.iter_changes(table, mark):
+                    if handle is None:
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        handle = gzip.open(path, 'wt', encoding='utf-8')
+                    
+                    for row in rows:
+                        handle.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str))
+                        handle.write('\n')
+                    
+                    # Последняя строка порции - новая отметка (строки упорядочены по ключу)
+                    last = dict(zip(columns, rows[-1]))
+                    mark['id'] = last['id']
+                    if FEED_TABLES[table]:
+                        mark['updated_at'] = last[FEED_TABLES[table]]
+                    rows_written += len(rows)
+            finally:
+                if handle:
+                    handle.close()
+            
+            checkpoint[table] = mark
+            result[table] = {'rows': rows_written, 'file': path if rows_written else None}
+            logger.info(f"Лента изменений {self.consumer}: {table} - {rows_written} строк")
+        
+        self._save_checkpoint(checkpoint)
+        return result
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Выгрузка изменений базы эксперимента с прошлой синхронизации потребителя")
+    parser.add_argument('consumer', help="Имя потребителя (например, nightly_sync); у каждого своя отметка")
+    parser.add_argument('output_dir', help="Каталог для файлов changes-*.jsonl.gz по таблицам")
+    parser.add_argument('--db-path', default="data/experiment.db", help="Путь к базе данных")
+    parser.add_argument('--state-dir', default="data/change_feed", help="Каталог с отметками потребителей")
+    parser.add_argument('--tables', nargs='+', choices=list(FEED_TABLES), default=None,
+                        help="Выгружать только эти таблицы (по умолчанию все)")
+    parser.add_argument('--decrypt', action='store_true', help="Расшифровывать зашифрованные колонки")
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(name)s - %(message)s')
+    
+    feed = ChangeFeed(args.consumer, db_path=args.db_path, state_dir=args.state_dir, decrypt=args.decrypt)
+    result = feed.export(args.output_dir, tables=args.tables)
+    for table, info in result.items():
+        print(f"{table}: {info['rows']} строк" + (f" -> {info['file']}" if info['file'] else ""))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
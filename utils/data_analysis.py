@@ -3,23 +3,98 @@
 """
 import sqlite3
 import pandas as pd
+import numpy as np
+import copy
 import json
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Iterator, Optional, Tuple
 from datetime import datetime
 import logging
 
+from utils.database import ANALYSIS_FIELDS
+from utils.export import StreamingExporter
+from utils.inference import NudgingInference
+from utils.snapshot import SnapshotManager, connect_readonly
+from utils.trajectory_analysis import TrajectoryAnalyzer
+
 logger = logging.getLogger(__name__)
 
+# Ключ кеша: новые строки меняют MAX(rowid), изменения и удаления - версию из
+# experiment_counters (ее поддерживают триггеры DatabaseManager)
+DATA_VERSION_QUERY = """
+    SELECT
+        (SELECT MAX(rowid) FROM participants),
+        (SELECT MAX(rowid) FROM survey_responses),
+        (SELECT value FROM experiment_counters WHERE scope = 'version' AND key = 'participants'),
+        (SELECT value FROM experiment_counters WHERE scope = 'version' AND key = 'survey_responses')
+"""
+
+# Разрезы для запросов по полям LLM анализа
+ANALYSIS_DIMENSIONS = {
+    'experiment_group': 'p.experiment_group',
+    'language': 'p.language',
+    'service_mode': 'a.service_mode'
+}
+
 class DataAnalyzer:
     """Класс для анализа данных эксперимента"""
     
-    def __init__(self, db_path: str = "data/experiment.db"):
+    FETCH_BATCH_SIZE = 500
+    
+    def __init__(self, db_path: str = "data/experiment.db", immutable: bool = False):
+        """
+        Args:
+            db_path: Путь к базе данных или к снимку
+            immutable: База не меняется (снимок) - открывать только на чтение без блокировок
+        """
         self.db_path = db_path
+        self.immutable = immutable
+        self._query_cache: Dict[str, Tuple[Tuple, Any]] = {}
+    
+    @classmethod
+    def from_snapshot(cls, db_path: str = "data/experiment.db", max_age_seconds: float = 300) -> 'DataAnalyzer':
+        """Анализатор по снимку базы не старше max_age_seconds, чтобы не мешать записям бота"""
+        return cls(SnapshotManager(db_path).get_fresh(max_age_seconds), immutable=True)
+    
+    def _connect(self) -> sqlite3.Connection:
+        return connect_readonly(self.db_path) if self.immutable else sqlite3.connect(self.db_path)
+    
+    def _data_version(self, conn: sqlite3.Connection) -> Optional[Tuple]:
+        """Возвращает версию данных для ключа кеша или None, если ее не определить"""
+        try:
+            return tuple(conn.execute(DATA_VERSION_QUERY).fetchone())
+        except sqlite3.OperationalError:
+            # База создана без таблицы счетчиков - работаем без кеша
+            return None
+    
+    def _cached(self, name: str, compute):
+        """Возвращает результат compute(conn) из кеша, если данные не менялись"""
+        with self._connect() as conn:
+            version = self._data_version(conn)
+            cached = self._query_cache.get(name)
+            if version is not None and cached and cached[0] == version:
+                return copy.deepcopy(cached[1])
+            
+            result = compute(conn)
+            if version is not None:
+                self._query_cache[name] = (version, result)
+            return copy.deepcopy(result)
+    
+    def iter_rows(self, query: str, params: tuple = ()) -> Iterator[Dict[str, Any]]:
+        """Построчно отдает результат запроса, читая курсор порциями"""
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(self.FETCH_BATCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row)
     
     def get_participants_data(self) -> pd.DataFrame:
         """Получает данные участников"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 return pd.read_sql_query("SELECT * FROM participants", conn)
         except Exception as e:
             logger.error(f"Ошибка получения данных участников: {e}")
@@ -28,7 +103,7 @@ class DataAnalyzer:
     def get_chat_messages(self, participant_id: str = None) -> pd.DataFrame:
         """Получает сообщения чата"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 if participant_id:
                     query = "SELECT * FROM chat_messages WHERE participant_id = ?"
                     return pd.read_sql_query(query, conn, params=(participant_id,))
@@ -41,115 +116,348 @@ class DataAnalyzer:
     def get_survey_responses(self) -> pd.DataFrame:
         """Получает ответы на опрос"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 return pd.read_sql_query("SELECT * FROM survey_responses", conn)
         except Exception as e:
             logger.error(f"Ошибка получения ответов опроса: {e}")
             return pd.DataFrame()
     
+    def get_participant_features(self) -> pd.DataFrame:
+        """
+        Загружает признаки участников одной компактной таблицей
+        
+        Счетчики эмоций и намерений разворачиваются в доли (emotion_*, intent_*),
+        траектория качества разговора - в среднее, последнее значение и наклон.
+        Категории хранятся как category, числа - в минимальных типах.
+        """
+        try:
+            with self._connect() as conn:
+                df = pd.read_sql_query("SELECT * FROM participant_features", conn)
+        except Exception as e:
+            logger.error(f"Ошибка получения признаков участников: {e}")
+            return pd.DataFrame()
+        
+        if df.empty:
+            return df
+        
+        for column in ('experiment_group', 'language', 'final_decision', 'felt_influence'):
+            df[column] = df[column].astype('category')
+        for column in ('discussion_start', 'first_message_at', 'last_message_at', 'decided_at', 'updated_at'):
+            df[column] = pd.to_datetime(df[column], errors='coerce')
+        
+        message_count = df['message_count'].replace(0, np.nan)
+        df['mean_message_length'] = (df['total_message_chars'] / message_count).astype('float32')
+        
+        for column in ('emotion_counts', 'intent_counts'):
+            prefix = column.split('_')[0]
+            counts = pd.DataFrame.from_records(df[column].map(json.loads).tolist(), index=df.index).fillna(0)
+            shares = counts.div(message_count, axis=0).astype('float32').add_prefix(f"{prefix}_")
+            df = pd.concat([df.drop(columns=column), shares], axis=1)
+        
+        trajectories = df.pop('flow_quality_trajectory').map(json.loads)
+        df['flow_updates'] = trajectories.map(len)
+        df['flow_quality_mean'] = trajectories.map(lambda t: np.mean(t) if t else np.nan).astype('float32')
+        df['flow_quality_last'] = trajectories.map(lambda t: t[-1] if t else np.nan).astype('float32')
+        df['flow_quality_slope'] = trajectories.map(
+            lambda t: (t[-1] - t[0]) / (len(t) - 1) if len(t) > 1 else np.nan
+        ).astype('float32')
+        
+        for column in ('message_count', 'total_message_chars', 'survey_completed', 'flow_updates'):
+            df[column] = pd.to_numeric(df[column], downcast='unsigned')
+        for column in ('time_to_first_message', 'time_to_decision', 'survey_confidence'):
+            df[column] = df[column].astype('float32')
+        
+        return df
+    
     def get_experiment_summary(self) -> Dict[str, Any]:
-        """Получает сводку эксперимента"""
+        """Получает сводку эксперимента (агрегаты считаются в SQL)"""
         try:
-            participants = self.get_participants_data()
-            survey = self.get_survey_responses()
-            
-            if participants.empty:
-                return {"error": "Нет данных участников"}
-            
-            summary = {
-                "total_participants": len(participants),
-                "completed_sessions": len(participants[participants['final_decision'].notna()]),
-                "group_distribution": participants['experiment_group'].value_counts().to_dict(),
-                "language_distribution": participants['language'].value_counts().to_dict(),
-                "decision_distribution": participants['final_decision'].value_counts().to_dict(),
-                "survey_completion_rate": len(survey) / len(participants) * 100 if len(participants) > 0 else 0,
-                "average_session_duration": self._calculate_average_duration(participants)
-            }
-            
-            return summary
-            
+            return self._cached('summary', self._compute_summary)
         except Exception as e:
             logger.error(f"Ошибка создания сводки: {e}")
             return {"error": str(e)}
     
-    def _calculate_average_duration(self, participants: pd.DataFrame) -> float:
-        """Вычисляет среднюю продолжительность сессии"""
-        try:
-            participants['start_time'] = pd.to_datetime(participants['start_time'])
-            participants['end_time'] = pd.to_datetime(participants['end_time'])
-            
-            # Вычисляем продолжительность только для завершенных сессий
-            completed = participants[participants['end_time'].notna()]
-            if len(completed) == 0:
-                return 0
-            
-            durations = (completed['end_time'] - completed['start_time']).dt.total_seconds() / 60
-            return durations.mean()
-            
-        except Exception as e:
-            logger.error(f"Ошибка вычисления продолжительности: {e}")
-            return 0
+    def _compute_summary(self, conn: sqlite3.Connection) -> Dict[str, Any]:
+        """Считает сводку эксперимента одним проходом по каждой таблице"""
+        total, completed, average_duration = conn.execute("""
+            SELECT
+                COUNT(*),
+                COUNT(final_decision),
+                -- Продолжительность в минутах только для завершенных сессий
+                AVG(CASE WHEN end_time IS NOT NULL
+                    THEN (julianday(end_time) - julianday(start_time)) * 1440 END)
+            FROM participants
+        """).fetchone()
+        
+        if total == 0:
+            return {"error": "Нет данных участников"}
+        
+        survey_count = conn.execute("SELECT COUNT(*) FROM survey_responses").fetchone()[0]
+        
+        return {
+            "total_participants": total,
+            "completed_sessions": completed,
+            "group_distribution": self._distribution(conn, 'experiment_group'),
+            "language_distribution": self._distribution(conn, 'language'),
+            "decision_distribution": self._distribution(conn, 'final_decision'),
+            "survey_completion_rate": survey_count / total * 100,
+            "average_session_duration": average_duration or 0
+        }
+    
+    def _distribution(self, conn: sqlite3.Connection, column: str) -> Dict[str, int]:
+        """Распределение значений колонки participants (без NULL), по убыванию частоты"""
+        return dict(conn.execute(f"""
+            SELECT {column}, COUNT(*) AS cnt
+            FROM participants
+            WHERE {column} IS NOT NULL
+            GROUP BY {column}
+            ORDER BY cnt DESC
+        """).fetchall())
     
     def get_nudging_effectiveness(self) -> Dict[str, Any]:
         """Анализирует эффективность нуджинга"""
         try:
-            participants = self.get_participants_data()
-            survey = self.get_survey_responses()
-            
-            if participants.empty or survey.empty:
-                return {"error": "Недостаточно данных для анализа"}
-            
-            # Объединяем данные
-            merged = participants.merge(survey, on='participant_id', how='inner')
-            
-            # Анализ по группам
-            confess_group = merged[merged['experiment_group'] == 'confess']
-            silent_group = merged[merged['experiment_group'] == 'silent']
-            
-            analysis = {
-                "confess_group": {
-                    "total": len(confess_group),
-                    "confessed": len(confess_group[confess_group['final_decision'] == 'confess']),
-                    "felt_influence": len(confess_group[confess_group['question_1'] == 'yes']),
-                    "avg_confidence": confess_group['question_3'].mean() if 'question_3' in confess_group.columns else 0
-                },
-                "silent_group": {
-                    "total": len(silent_group),
-                    "remained_silent": len(silent_group[silent_group['final_decision'] == 'silent']),
-                    "felt_influence": len(silent_group[silent_group['question_1'] == 'yes']),
-                    "avg_confidence": silent_group['question_3'].mean() if 'question_3' in silent_group.columns else 0
-                }
-            }
-            
-            # Вычисляем процент успешного нуджинга
-            confess_success_rate = analysis["confess_group"]["confessed"] / analysis["confess_group"]["total"] * 100 if analysis["confess_group"]["total"] > 0 else 0
-            silent_success_rate = analysis["silent_group"]["remained_silent"] / analysis["silent_group"]["total"] * 100 if analysis["silent_group"]["total"] > 0 else 0
-            
-            analysis["nudging_success_rate"] = {
-                "confess_group": confess_success_rate,
-                "silent_group": silent_success_rate,
-                "overall": (confess_success_rate + silent_success_rate) / 2
-            }
-            
-            return analysis
-            
+            return self._cached('nudging', self._compute_nudging_effectiveness)
         except Exception as e:
             logger.error(f"Ошибка анализа эффективности нуджинга: {e}")
             return {"error": str(e)}
     
+    def _compute_nudging_effectiveness(self, conn: sqlite3.Connection) -> Dict[str, Any]:
+        """Считает эффективность нуджинга соединением и группировкой в SQL"""
+        has_participants = conn.execute("SELECT EXISTS (SELECT 1 FROM participants)").fetchone()[0]
+        has_survey = conn.execute("SELECT EXISTS (SELECT 1 FROM survey_responses)").fetchone()[0]
+        if not has_participants or not has_survey:
+            return {"error": "Недостаточно данных для анализа"}
+        
+        # Успех нуджинга - решение совпадает с группой (confess/confess, silent/silent)
+        rows = conn.execute("""
+            SELECT
+                p.experiment_group,
+                COUNT(*),
+                SUM(p.final_decision = p.experiment_group),
+                SUM(s.question_1 = 'yes'),
+                AVG(s.question_3)
+            FROM participants p
+            JOIN survey_responses s ON s.participant_id = p.participant_id
+            GROUP BY p.experiment_group
+        """).fetchall()
+        groups = {row[0]: row[1:] for row in rows}
+        
+        def group_stats(group: str, success_key: str) -> Dict[str, Any]:
+            total, success, felt_influence, avg_confidence = groups.get(group, (0, 0, 0, None))
+            return {
+                "total": total,
+                success_key: success or 0,
+                "felt_influence": felt_influence or 0,
+                "avg_confidence": avg_confidence or 0
+            }
+        
+        analysis = {
+            "confess_group": group_stats('confess', 'confessed'),
+            "silent_group": group_stats('silent', 'remained_silent')
+        }
+        
+        # Вычисляем процент успешного нуджинга
+        confess_success_rate = analysis["confess_group"]["confessed"] / analysis["confess_group"]["total"] * 100 if analysis["confess_group"]["total"] > 0 else 0
+        silent_success_rate = analysis["silent_group"]["remained_silent"] / analysis["silent_group"]["total"] * 100 if analysis["silent_group"]["total"] > 0 else 0
+        
+        analysis["nudging_success_rate"] = {
+            "confess_group": confess_success_rate,
+            "silent_group": silent_success_rate,
+            "overall": (confess_success_rate + silent_success_rate) / 2
+        }
+        
+        return analysis
+    
+    def get_inference_data(self) -> Dict[str, np.ndarray]:
+        """Массивы для статистических выводов: участники с финальным решением и их опрос"""
+        with self._connect() as conn:
+            rows = conn.execute("""
+                SELECT
+                    p.experiment_group,
+                    p.language,
+                    p.final_decision,
+                    CASE s.question_1 WHEN 'yes' THEN 1.0 WHEN 'no' THEN 0.0 END,
+                    s.question_3
+                FROM participants p
+                LEFT JOIN survey_responses s ON s.id = (
+                    SELECT MAX(id) FROM survey_responses WHERE participant_id = p.participant_id
+                )
+                WHERE p.final_decision IS NOT NULL
+            """).fetchall()
+        
+        columns = list(zip(*rows)) if rows else [()] * 5
+        return {
+            'group': np.array(columns[0], dtype=object),
+            'language': np.array(columns[1], dtype=object),
+            'decision': np.array(columns[2], dtype=object),
+            'felt_influence': np.array(columns[3], dtype=float),
+            'confidence': np.array(columns[4], dtype=float)
+        }
+    
+    def get_statistical_inference(self, n_resamples: int = 10000, seed: int = None,
+                                  n_workers: int = 1) -> Dict[str, Any]:
+        """
+        Доверительные интервалы, тесты и размеры эффекта нуджинга
+        
+        Args:
+            n_resamples: Количество бутстрэп повторов и перестановок
+            seed: Зерно для воспроизводимости
+            n_workers: Число процессов для перестановок и бутстрэпа корреляций
+        """
+        try:
+            data = self.get_inference_data()
+            if len(data['group']) == 0:
+                return {"error": "Нет участников с финальным решением"}
+            return NudgingInference(n_resamples=n_resamples, seed=seed, n_workers=n_workers).analyze(data)
+        except Exception as e:
+            logger.error(f"Ошибка статистического анализа: {e}")
+            return {"error": str(e)}
+    
+    def get_analysis_distribution(self, field: str, by: str = 'experiment_group') -> pd.DataFrame:
+        """
+        Распределение значений поля LLM анализа в разрезе группы, языка или режима
+        
+        Args:
+            field: Поле анализа (emotion, intent, confidence, ...)
+            by: experiment_group, language или service_mode
+        
+        Returns:
+            DataFrame с колонками [by, value, count, share]; share - доля внутри by
+        """
+        self._check_analysis_field(field)
+        if by not in ANALYSIS_DIMENSIONS:
+            raise ValueError(f"Неизвестный разрез: {by}")
+        
+        query = f"""
+            SELECT {ANALYSIS_DIMENSIONS[by]} AS {by}, f.{field} AS value, COUNT(*) AS count
+            FROM llm_analysis_fields f
+            JOIN participants p ON p.participant_id = f.participant_id
+            JOIN llm_analysis a ON a.id = f.analysis_id
+            GROUP BY 1, 2
+            ORDER BY 1, count DESC
+        """
+        try:
+            with self._connect() as conn:
+                df = pd.read_sql_query(query, conn)
+            df['share'] = df['count'] / df.groupby(by)['count'].transform('sum')
+            return df
+        except Exception as e:
+            logger.error(f"Ошибка получения распределения {field}: {e}")
+            return pd.DataFrame()
+    
+    def get_analysis_trajectory(self, field: str, bucket: str = 'turn') -> pd.DataFrame:
+        """
+        Динамика поля LLM анализа по ходу разговора или во времени по группам
+        
+        Args:
+            field: Поле анализа (emotion, intent, confidence, ...)
+            bucket: turn - номер хода участника, hour или day - календарное время
+        
+        Returns:
+            DataFrame с колонками [experiment_group, bucket, value, count, share]
+        """
+        self._check_analysis_field(field)
+        buckets = {
+            'turn': "ROW_NUMBER() OVER (PARTITION BY f.participant_id ORDER BY f.analysis_id)",
+            'hour': "strftime('%Y-%m-%d %H:00', a.timestamp)",
+            'day': "date(a.timestamp)"
+        }
+        if bucket not in buckets:
+            raise ValueError(f"Неизвестный интервал: {bucket}")
+        
+        query = f"""
+            WITH turns AS (
+                SELECT p.experiment_group, {buckets[bucket]} AS bucket, f.{field} AS value
+                FROM llm_analysis_fields f
+                JOIN participants p ON p.participant_id = f.participant_id
+                JOIN llm_analysis a ON a.id = f.analysis_id
+            )
+            SELECT experiment_group, bucket, value, COUNT(*) AS count
+            FROM turns
+            GROUP BY 1, 2, 3
+            ORDER BY 1, 2, count DESC
+        """
+        try:
+            with self._connect() as conn:
+                df = pd.read_sql_query(query, conn)
+            df['share'] = df['count'] / df.groupby(['experiment_group', 'bucket'])['count'].transform('sum')
+            return df
+        except Exception as e:
+            logger.error(f"Ошибка получения траектории {field}: {e}")
+            return pd.DataFrame()
+    
+    def get_trajectory_analysis(self, field: str = 'emotion', bin_seconds: int = 30,
+                                max_seconds: float = None) -> Dict[str, Any]:
+        """
+        Матрицы переходов и кривые состояний по ходу разговора по группам и языкам
+        
+        Args:
+            field: Категориальное поле анализа (emotion, intent, ...)
+            bin_seconds: Ширина интервала кривых во времени
+            max_seconds: Отбрасывать ходы позже этого времени от начала обсуждения
+        """
+        try:
+            return TrajectoryAnalyzer(self.db_path, immutable=self.immutable).analyze(field, bin_seconds, max_seconds)
+        except Exception as e:
+            logger.error(f"Ошибка анализа траекторий {field}: {e}")
+            return {"error": str(e)}
+    
+    def get_theme_distribution(self, by: str = 'experiment_group', limit: int = 20) -> pd.DataFrame:
+        """Самые частые темы сообщений (key_themes) в разрезе группы, языка или режима"""
+        if by not in ANALYSIS_DIMENSIONS:
+            raise ValueError(f"Неизвестный разрез: {by}")
+        
+        query = f"""
+            SELECT {by}, theme, count FROM (
+                SELECT {ANALYSIS_DIMENSIONS[by]} AS {by}, t.theme, COUNT(*) AS count,
+                       ROW_NUMBER() OVER (PARTITION BY {ANALYSIS_DIMENSIONS[by]} ORDER BY COUNT(*) DESC) AS rank
+                FROM llm_analysis_themes t
+                JOIN llm_analysis a ON a.id = t.analysis_id
+                JOIN participants p ON p.participant_id = a.participant_id
+                GROUP BY 1, 2
+            )
+            WHERE rank <= ?
+            ORDER BY 1, count DESC
+        """
+        try:
+            with self._connect() as conn:
+                return pd.read_sql_query(query, conn, params=(limit,))
+        except Exception as e:
+            logger.error(f"Ошибка получения распределения тем: {e}")
+            return pd.DataFrame()
+    
+    @staticmethod
+    def _check_analysis_field(field: str):
+        if field not in ANALYSIS_FIELDS:
+            raise ValueError(f"Неизвестное поле анализа: {field}")
+    
     def export_data(self, output_file: str = "experiment_data.json"):
-        """Экспортирует все данные в JSON файл"""
+        """
+        Экспортирует данные в JSON файл
+        
+        Строки таблиц пишутся по мере чтения из курсора, поэтому память не
+        зависит от размера выборки. Структура файла прежняя.
+        """
         try:
-            data = {
-                "export_timestamp": datetime.now().isoformat(),
-                "participants": self.get_participants_data().to_dict('records'),
-                "survey_responses": self.get_survey_responses().to_dict('records'),
-                "summary": self.get_experiment_summary(),
-                "nudging_analysis": self.get_nudging_effectiveness()
-            }
-            
             with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+                f.write('{\n')
+                f.write(f'  "export_timestamp": {json.dumps(datetime.now().isoformat())},\n')
+                
+                for table in ('participants', 'survey_responses'):
+                    f.write(f'  "{table}": [')
+                    separator = '\n    '
+                    for row in self.iter_rows(f"SELECT * FROM {table} ORDER BY rowid"):
+                        f.write(separator)
+                        f.write(json.dumps(row, ensure_ascii=False, default=str))
+                        separator = ',\n    '
+                    f.write('\n  ],\n')
+                
+                f.write('  "summary": ')
+                f.write(json.dumps(self.get_experiment_summary(), ensure_ascii=False, default=str))
+                f.write(',\n  "nudging_analysis": ')
+                f.write(json.dumps(self.get_nudging_effectiveness(), ensure_ascii=False, default=str))
+                f.write('\n}\n')
             
             logger.info(f"Данные экспортированы в {output_file}")
             return True
@@ -248,6 +556,10 @@ def main():
     # Экспорт данных
     if analyzer.export_data():
         print("\nДанные экспортированы в experiment_data.json")
+    
+    # Полная выгрузка таблиц для анализа в ноутбуках
+    manifest = StreamingExporter(analyzer.db_path).export("experiment_export")
+    print(f"Таблицы выгружены в experiment_export: {', '.join(manifest['files'].get('parquet', {}))}")
 
 if __name__ == "__main__":
     main()
@@ -4,6 +4,7 @@
 import sqlite3
 import json
 import logging
+import re
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any, List
 from cryptography.fernet import Fernet
@@ -11,9 +12,130 @@ import base64
 import hashlib
 
 from config.settings import Config
+from utils.metrics import timed_db_writes
+from utils.profiling import timed_methods
 
 logger = logging.getLogger(__name__)
 
+def _counter_increment(scope: str, key: str, condition: str = None) -> str:
+    """SQL увеличения счетчика для использования внутри триггера"""
+    # WHERE нужен всегда: без него SQLite принимает ON CONFLICT за условие JOIN
+    where = f" WHERE {condition}" if condition else " WHERE 1"
+    return f"""
+        INSERT INTO experiment_counters (scope, key, value)
+        SELECT {scope}, {key}, 1{where}
+        ON CONFLICT (scope, key) DO UPDATE SET value = value + 1;"""
+
+def _counter_decrement(scope: str, key: str, condition: str = None) -> str:
+    """SQL уменьшения счетчика для использования внутри триггера"""
+    extra = f" AND {condition}" if condition else ""
+    return f"""
+        UPDATE experiment_counters SET value = value - 1
+        WHERE scope = {scope} AND key = {key}{extra};"""
+
+def _participant_counters(row: str, change, include_total: bool = True) -> str:
+    """Изменения счетчиков участников для строки NEW или OLD"""
+    return "".join([
+        change("'total'", "'participants'") if include_total else "",
+        change("'group'", f"{row}.experiment_group"),
+        change("'language'", f"{row}.language"),
+        change("'decision'", f"{row}.final_decision", f"{row}.final_decision IS NOT NULL"),
+        change("'completed'", "'participants'", f"{row}.final_decision IS NOT NULL")
+    ])
+
+COUNTER_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS counters_participants_insert AFTER INSERT ON participants
+    BEGIN{_participant_counters('NEW', _counter_increment)}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS counters_participants_update
+    AFTER UPDATE OF experiment_group, language, final_decision ON participants
+    BEGIN{_participant_counters('OLD', _counter_decrement, False)}{_participant_counters('NEW', _counter_increment, False)}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS counters_participants_delete AFTER DELETE ON participants
+    BEGIN{_participant_counters('OLD', _counter_decrement)}
+    END"""
+] + [
+    f"""CREATE TRIGGER IF NOT EXISTS counters_{table}_{event.lower()} AFTER {event} ON {table}
+    BEGIN{change("'rows'", f"'{table}'")}
+    END"""
+    for table in ('chat_messages', 'llm_analysis', 'survey_responses')
+    for event, change in (('INSERT', _counter_increment), ('DELETE', _counter_decrement))
+] + [
+    # Версия таблицы меняется при изменении и удалении строк: вместе с MAX(rowid)
+    # она служит ключом кеша результатов запросов в DataAnalyzer
+    f"""CREATE TRIGGER IF NOT EXISTS counters_{table}_version_{event.lower()} AFTER {event} ON {table}
+    BEGIN{_counter_increment("'version'", f"'{table}'")}
+    END"""
+    for table in ('participants', 'survey_responses')
+    for event in ('UPDATE', 'DELETE')
+]
+
+COUNTER_BACKFILL = """
+    DELETE FROM experiment_counters;
+    INSERT INTO experiment_counters (scope, key, value)
+        SELECT 'total', 'participants', COUNT(*) FROM participants;
+    INSERT INTO experiment_counters (scope, key, value)
+        SELECT 'completed', 'participants', COUNT(*) FROM participants WHERE final_decision IS NOT NULL;
+    INSERT INTO experiment_counters (scope, key, value)
+        SELECT 'group', experiment_group, COUNT(*) FROM participants GROUP BY experiment_group;
+    INSERT INTO experiment_counters (scope, key, value)
+        SELECT 'language', language, COUNT(*) FROM participants GROUP BY language;
+    INSERT INTO experiment_counters (scope, key, value)
+        SELECT 'decision', final_decision, COUNT(*) FROM participants
+        WHERE final_decision IS NOT NULL GROUP BY final_decision;
+    INSERT INTO experiment_counters (scope, key, value)
+        SELECT 'rows', 'chat_messages', COUNT(*) FROM chat_messages;
+    INSERT INTO experiment_counters (scope, key, value)
+        SELECT 'rows', 'llm_analysis', COUNT(*) FROM llm_analysis;
+    INSERT INTO experiment_counters (scope, key, value)
+        SELECT 'rows', 'survey_responses', COUNT(*) FROM survey_responses;
+"""
+
+# Числовая оценка качества разговора для траектории в participant_features
+FLOW_QUALITY_SCORES = {'poor': 0, 'average': 1, 'good': 2}
+
+def _feature_label(value) -> str:
+    """Метка эмоции/намерения для ключа JSON: буквы, цифры, '_' и '-', иначе путь json_set невалиден"""
+    label = re.sub(r'[^\w-]+', '_', str(value or '').strip().lower()).strip('_')
+    return label or 'unknown'
+
+# Поля анализа, которые выносятся из analysis_json в колонки llm_analysis_fields
+ANALYSIS_FIELDS = [
+    'emotion', 'intent', 'confidence', 'persuasion_resistance',
+    'nudging_effectiveness', 'risk_of_dropout', 'analysis_method', 'suggested_response'
+]
+
+def _analysis_fields_insert(source: str, id_expr: str, participant_expr: str, json_expr: str) -> str:
+    """SQL заполнения llm_analysis_fields и llm_analysis_themes из JSON анализа"""
+    extracts = ", ".join(f"json_extract({json_expr}, '$.{field}')" for field in ANALYSIS_FIELDS)
+    # json_each падает на некорректном JSON, а в триггере это отменило бы саму вставку анализа
+    safe_json = f"CASE WHEN json_valid({json_expr}) THEN {json_expr} ELSE '{{}}' END"
+    return f"""
+        INSERT OR REPLACE INTO llm_analysis_fields (analysis_id, participant_id, {', '.join(ANALYSIS_FIELDS)})
+        SELECT {id_expr}, {participant_expr}, {extracts}
+        {source} WHERE json_valid({json_expr});
+        INSERT OR IGNORE INTO llm_analysis_themes (analysis_id, theme)
+        SELECT {id_expr}, themes.value
+        {source + ',' if source else 'FROM'} json_each({safe_json}, '$.key_themes') AS themes
+        WHERE themes.value IS NOT NULL;"""
+
+ANALYSIS_FIELDS_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS analysis_fields_insert AFTER INSERT ON llm_analysis
+    BEGIN{_analysis_fields_insert('', 'NEW.id', 'NEW.participant_id', 'NEW.analysis_json')}
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS analysis_fields_delete AFTER DELETE ON llm_analysis
+    BEGIN
+        DELETE FROM llm_analysis_fields WHERE analysis_id = OLD.id;
+        DELETE FROM llm_analysis_themes WHERE analysis_id = OLD.id;
+    END"""
+]
+
+ANALYSIS_FIELDS_BACKFILL = _analysis_fields_insert(
+    'FROM llm_analysis', 'llm_analysis.id', 'llm_analysis.participant_id', 'llm_analysis.analysis_json'
+)
+
+@timed_methods('db')
+@timed_db_writes
 class DatabaseManager:
     """Менеджер базы данных для эксперимента"""
     
@@ -65,6 +187,30 @@ class DatabaseManager:
                     # Поле уже существует
                     pass
                 
+                # Добавляем поле updated_at для ленты изменений (ChangeFeed)
+                try:
+                    cursor.execute("ALTER TABLE participants ADD COLUMN updated_at TIMESTAMP")
+                    cursor.execute("UPDATE participants SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP)")
+                except sqlite3.OperationalError:
+                    # Поле уже существует
+                    pass
+                
+                # updated_at проставляется триггерами при любой вставке и изменении строки
+                cursor.execute('''
+                    CREATE TRIGGER IF NOT EXISTS participants_touch_insert AFTER INSERT ON participants
+                    BEGIN
+                        UPDATE participants SET updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id;
+                    END
+                ''')
+                cursor.execute('''
+                    CREATE TRIGGER IF NOT EXISTS participants_touch_update AFTER UPDATE ON participants
+                    WHEN NEW.updated_at IS OLD.updated_at
+                    BEGIN
+                        UPDATE participants SET updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id;
+                    END
+                ''')
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_participants_updated_at ON participants (updated_at, id)")
+                
                 # Таблица сообщений чата
                 cursor.execute('''
                     CREATE TABLE IF NOT EXISTS chat_messages (
@@ -119,6 +265,17 @@ class DatabaseManager:
                     )
                 ''')
                 
+                # Режим обслуживания, в котором обработан ход
+                try:
+                    cursor.execute("ALTER TABLE llm_analysis ADD COLUMN service_mode TEXT DEFAULT 'full'")
+                except sqlite3.OperationalError:
+                    # Поле уже существует
+                    pass
+                # Выборки анализа по участнику (get_llm_analysis_data)
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_llm_analysis_participant ON llm_analysis (participant_id, id)"
+                )
+                
                 # Таблица для анализа потока разговора
                 cursor.execute('''
                     CREATE TABLE IF NOT EXISTS conversation_flow (
@@ -130,6 +287,46 @@ class DatabaseManager:
                     )
                 ''')
                 
+                # Журнал смены режимов обслуживания (деградация под нагрузкой)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS service_mode_changes (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        previous_mode TEXT NOT NULL,
+                        new_mode TEXT NOT NULL,
+                        metrics_json TEXT, -- показатели нагрузки в момент переключения
+                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                
+                # Признаки участников, обновляемые на каждом ходе
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS participant_features (
+                        participant_id TEXT PRIMARY KEY,
+                        experiment_group TEXT,
+                        language TEXT,
+                        discussion_start TIMESTAMP,
+                        first_message_at TIMESTAMP,
+                        last_message_at TIMESTAMP,
+                        message_count INTEGER NOT NULL DEFAULT 0,
+                        total_message_chars INTEGER NOT NULL DEFAULT 0,
+                        time_to_first_message REAL, -- секунды от начала обсуждения
+                        final_decision TEXT,
+                        decided_at TIMESTAMP,
+                        time_to_decision REAL, -- секунды от начала обсуждения
+                        emotion_counts TEXT NOT NULL DEFAULT '{}', -- JSON {эмоция: количество}
+                        intent_counts TEXT NOT NULL DEFAULT '{}', -- JSON {намерение: количество}
+                        flow_quality_trajectory TEXT NOT NULL DEFAULT '[]', -- JSON массив оценок качества
+                        survey_completed INTEGER NOT NULL DEFAULT 0,
+                        felt_influence TEXT,
+                        survey_confidence INTEGER,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (participant_id) REFERENCES participants (participant_id)
+                    )
+                ''')
+                
+                self._init_counters(cursor)
+                self._init_analysis_fields(cursor)
+                
                 conn.commit()
                 logger.info("База данных инициализирована успешно")
                 
@@ -137,6 +334,72 @@ class DatabaseManager:
             logger.error(f"Ошибка инициализации базы данных: {e}")
             raise
     
+    def _init_counters(self, cursor):
+        """
+        Создает таблицу счетчиков статистики и поддерживающие ее триггеры
+        
+        Счетчики обновляются в той же транзакции, что и запись в исходные
+        таблицы, поэтому get_experiment_statistics читает готовые значения
+        вместо полного сканирования participants.
+        """
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'experiment_counters'")
+        needs_backfill = cursor.fetchone() is None
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS experiment_counters (
+                scope TEXT NOT NULL, -- total, completed, group, language, decision, rows
+                key TEXT NOT NULL,
+                value INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (scope, key)
+            )
+        ''')
+        
+        for trigger_sql in COUNTER_TRIGGERS:
+            cursor.execute(trigger_sql)
+        
+        if needs_backfill:
+            # Заполняем счетчики по уже накопленным данным
+            cursor.executescript(COUNTER_BACKFILL)
+            logger.info("Счетчики статистики заполнены по существующим данным")
+    
+    def _init_analysis_fields(self, cursor):
+        """
+        Создает типизированную копию полей analysis_json и таблицу тем
+        
+        Таблицы заполняются триггерами при вставке в llm_analysis, так что
+        распределения и траектории считаются в SQL без json.loads по строкам.
+        """
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'llm_analysis_fields'")
+        needs_backfill = cursor.fetchone() is None
+        
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS llm_analysis_fields (
+                analysis_id INTEGER PRIMARY KEY,
+                participant_id TEXT NOT NULL,
+                {', '.join(f"{field} TEXT" for field in ANALYSIS_FIELDS)},
+                FOREIGN KEY (analysis_id) REFERENCES llm_analysis (id)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS llm_analysis_themes (
+                analysis_id INTEGER NOT NULL,
+                theme TEXT NOT NULL,
+                PRIMARY KEY (analysis_id, theme),
+                FOREIGN KEY (analysis_id) REFERENCES llm_analysis (id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_analysis_fields_participant ON llm_analysis_fields (participant_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_analysis_fields_intent ON llm_analysis_fields (intent)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_analysis_fields_emotion ON llm_analysis_fields (emotion)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_analysis_themes_theme ON llm_analysis_themes (theme)")
+        
+        for trigger_sql in ANALYSIS_FIELDS_TRIGGERS:
+            cursor.execute(trigger_sql)
+        
+        if needs_backfill:
+            cursor.executescript(ANALYSIS_FIELDS_BACKFILL)
+            logger.info("Поля LLM анализа заполнены по существующим данным")
+    
     def _encrypt_data(self, data: str) -> str:
         """Шифрует данные"""
         try:
@@ -303,69 +566,50 @@ class DatabaseManager:
             return []
     
     def get_experiment_statistics(self) -> Dict[str, Any]:
-        """Получает статистику эксперимента"""
+        """Получает статистику эксперимента из счетчиков, поддерживаемых триггерами"""
         try:
             with sqlite3.connect(self.db_path) as conn:
                 cursor = conn.cursor()
+                cursor.execute('SELECT scope, key, value FROM experiment_counters WHERE value != 0')
                 
-                # Общее количество участников
-                cursor.execute('SELECT COUNT(*) FROM participants')
-                total_participants = cursor.fetchone()[0]
-                
-                # Распределение по группам
-                cursor.execute('''
-                    SELECT experiment_group, COUNT(*) 
-                    FROM participants 
-                    GROUP BY experiment_group
-                ''')
-                group_distribution = dict(cursor.fetchall())
-                
-                # Распределение по языкам
-                cursor.execute('''
-                    SELECT language, COUNT(*) 
-                    FROM participants 
-                    GROUP BY language
-                ''')
-                language_distribution = dict(cursor.fetchall())
-                
-                # Финальные решения
-                cursor.execute('''
-                    SELECT final_decision, COUNT(*) 
-                    FROM participants 
-                    WHERE final_decision IS NOT NULL
-                    GROUP BY final_decision
-                ''')
-                decision_distribution = dict(cursor.fetchall())
+                counters = {}
+                for scope, key, value in cursor.fetchall():
+                    counters.setdefault(scope, {})[key] = value
                 
-                # Количество завершенных экспериментов
-                cursor.execute('SELECT COUNT(*) FROM participants WHERE final_decision IS NOT NULL')
-                completed = cursor.fetchone()[0]
+                group_distribution = counters.get('group', {})
+                rows = counters.get('rows', {})
                 
                 return {
-                    'total_participants': total_participants,
-                    'completed': completed,
+                    'total_participants': counters.get('total', {}).get('participants', 0),
+                    'completed': counters.get('completed', {}).get('participants', 0),
                     'groups': group_distribution,  # Переименовано для совместимости с админ-панелью
                     'group_distribution': group_distribution,
-                    'language_distribution': language_distribution,
-                    'decision_distribution': decision_distribution
+                    'language_distribution': counters.get('language', {}),
+                    'decision_distribution': counters.get('decision', {}),
+                    'llm_analyses': rows.get('llm_analysis', 0),
+                    'chat_messages': rows.get('chat_messages', 0),
+                    'survey_responses': rows.get('survey_responses', 0)
                 }
         except Exception as e:
             logger.error(f"Ошибка получения статистики: {e}")
             return {}
     
-    async def log_llm_analysis(self, participant_id: str, user_message: str, analysis: Dict, bot_response: str):
-        """Логирует LLM анализ сообщения"""
+    async def log_llm_analysis(self, participant_id: str, user_message: str, analysis: Dict, bot_response: str,
+                               service_mode: str = 'full') -> bool:
+        """Логирует LLM анализ сообщения; возвращает, записан ли ход"""
         try:
             with sqlite3.connect(self.db_path) as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
-                    INSERT INTO llm_analysis (participant_id, user_message, analysis_json, bot_response)
-                    VALUES (?, ?, ?, ?)
-                """, (participant_id, user_message, json.dumps(analysis, ensure_ascii=False), bot_response))
+                    INSERT INTO llm_analysis (participant_id, user_message, analysis_json, bot_response, service_mode)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (participant_id, user_message, json.dumps(analysis, ensure_ascii=False), bot_response, service_mode))
                 conn.commit()
+                return True
                 
         except Exception as e:
             logger.error(f"Ошибка при логировании LLM анализа: {e}")
+            return False
     
     async def log_conversation_flow(self, participant_id: str, flow_analysis: Dict):
         """Логирует анализ потока разговора"""
@@ -395,6 +639,142 @@ class DatabaseManager:
         except Exception as e:
             logger.error(f"Ошибка при логировании финального анализа: {e}")
     
+    async def log_service_mode_change(self, previous_mode: str, new_mode: str, metrics: Dict):
+        """Логирует смену режима обслуживания"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT INTO service_mode_changes (previous_mode, new_mode, metrics_json)
+                    VALUES (?, ?, ?)
+                """, (previous_mode, new_mode, json.dumps(metrics, ensure_ascii=False)))
+                conn.commit()
+        
+        except Exception as e:
+            logger.error(f"Ошибка при логировании смены режима обслуживания: {e}")
+    
+    def get_service_mode_changes(self, limit: int = 5) -> List[Dict[str, Any]]:
+        """Получает последние смены режима обслуживания"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.row_factory = sqlite3.Row
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT previous_mode, new_mode, metrics_json, timestamp
+                    FROM service_mode_changes
+                    ORDER BY id DESC
+                    LIMIT ?
+                """, (limit,))
+                return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения смен режима обслуживания: {e}")
+            return []
+    
+    def _upsert_features(self, sql: str, params: tuple, participant_id: str):
+        """Выполняет обновление participant_features, ошибки только логируются"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute(sql, params)
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка обновления признаков участника {participant_id}: {e}")
+    
+    async def init_participant_features(self, participant_id: str, experiment_group: str,
+                                        language: str, discussion_start: datetime):
+        """Создает или сбрасывает признаки участника при начале обсуждения (повторный запуск - с нуля)"""
+        self._upsert_features("""
+            INSERT INTO participant_features (participant_id, experiment_group, language, discussion_start)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (participant_id) DO UPDATE SET
+                experiment_group = excluded.experiment_group,
+                language = excluded.language,
+                discussion_start = excluded.discussion_start,
+                first_message_at = NULL,
+                last_message_at = NULL,
+                message_count = 0,
+                total_message_chars = 0,
+                time_to_first_message = NULL,
+                final_decision = NULL,
+                decided_at = NULL,
+                time_to_decision = NULL,
+                emotion_counts = '{}',
+                intent_counts = '{}',
+                flow_quality_trajectory = '[]',
+                survey_completed = 0,
+                felt_influence = NULL,
+                survey_confidence = NULL,
+                updated_at = CURRENT_TIMESTAMP
+        """, (participant_id, experiment_group, language, discussion_start), participant_id)
+    
+    async def update_message_features(self, participant_id: str, message: str, analysis: Dict,
+                                      message_time: datetime):
+        """Учитывает сообщение участника и его анализ (эмоция, намерение)"""
+        emotion = _feature_label(analysis.get('emotion'))
+        intent = _feature_label(analysis.get('intent'))
+        emotion_path = f'$."{emotion}"'
+        intent_path = f'$."{intent}"'
+        
+        self._upsert_features("""
+            INSERT INTO participant_features (
+                participant_id, first_message_at, last_message_at, message_count,
+                total_message_chars, emotion_counts, intent_counts
+            )
+            VALUES (?, ?, ?, 1, ?, ?, ?)
+            ON CONFLICT (participant_id) DO UPDATE SET
+                first_message_at = COALESCE(first_message_at, excluded.first_message_at),
+                time_to_first_message = COALESCE(
+                    time_to_first_message,
+                    (julianday(excluded.first_message_at) - julianday(discussion_start)) * 86400
+                ),
+                last_message_at = excluded.last_message_at,
+                message_count = message_count + 1,
+                total_message_chars = total_message_chars + excluded.total_message_chars,
+                emotion_counts = json_set(emotion_counts, ?, COALESCE(json_extract(emotion_counts, ?), 0) + 1),
+                intent_counts = json_set(intent_counts, ?, COALESCE(json_extract(intent_counts, ?), 0) + 1),
+                updated_at = CURRENT_TIMESTAMP
+        """, (
+            participant_id, message_time, message_time, len(message),
+            json.dumps({emotion: 1}, ensure_ascii=False), json.dumps({intent: 1}, ensure_ascii=False),
+            emotion_path, emotion_path, intent_path, intent_path
+        ), participant_id)
+    
+    async def update_flow_features(self, participant_id: str, flow_analysis: Dict):
+        """Добавляет оценку качества разговора в траекторию участника"""
+        score = FLOW_QUALITY_SCORES.get(flow_analysis.get('conversation_quality'))
+        if score is None:
+            return
+        
+        self._upsert_features("""
+            UPDATE participant_features
+            SET flow_quality_trajectory = json_insert(flow_quality_trajectory, '$[#]', ?),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE participant_id = ?
+        """, (score, participant_id), participant_id)
+    
+    async def update_decision_features(self, participant_id: str, decision: str, decision_time: datetime):
+        """Записывает финальное решение и время до него"""
+        self._upsert_features("""
+            INSERT INTO participant_features (participant_id, final_decision, decided_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT (participant_id) DO UPDATE SET
+                final_decision = excluded.final_decision,
+                decided_at = excluded.decided_at,
+                time_to_decision = (julianday(excluded.decided_at) - julianday(discussion_start)) * 86400,
+                updated_at = CURRENT_TIMESTAMP
+        """, (participant_id, decision, decision_time), participant_id)
+    
+    async def update_survey_features(self, participant_id: str, responses: Dict[str, Any]):
+        """Отмечает завершение опроса и сохраняет его закрытые ответы"""
+        self._upsert_features("""
+            INSERT INTO participant_features (participant_id, survey_completed, felt_influence, survey_confidence)
+            VALUES (?, 1, ?, ?)
+            ON CONFLICT (participant_id) DO UPDATE SET
+                survey_completed = 1,
+                felt_influence = excluded.felt_influence,
+                survey_confidence = excluded.survey_confidence,
+                updated_at = CURRENT_TIMESTAMP
+        """, (participant_id, responses.get('question_1'), responses.get('question_3')), participant_id)
+    
     async def get_llm_analysis_data(self, participant_id: str = None) -> List[Dict]:
         """Получает данные LLM анализа"""
         try:
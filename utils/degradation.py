@@ -0,0 +1,185 @@
+"""
+Контроллер деградации сервиса при перегрузке
+Следит за очередью LLM вызовов, задержкой event loop и ошибками провайдера
+и переключает режимы обработки сообщений
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Optional
+
+from config.settings import Config
+
+logger = logging.getLogger(__name__)
+
+class ServiceMode:
+    """Режимы обработки сообщений, от полного к самому облегченному"""
+    
+    FULL = 'full'  # анализ, ответ и анализ потока через LLM
+    NO_FLOW = 'no_flow'  # без анализа потока разговора
+    HEURISTIC = 'heuristic'  # эвристический анализ, ответ через LLM
+    TEMPLATE = 'template'  # эвристический анализ и шаблонный ответ, без LLM
+    
+    ORDER = [FULL, NO_FLOW, HEURISTIC, TEMPLATE]
+
+class DegradationController:
+    """Автоматически переключает режимы обслуживания в зависимости от нагрузки"""
+    
+    SAMPLE_INTERVAL = 0.25  # период измерения задержки event loop, сек
+    MIN_CALLS_FOR_ERROR_RATE = 3  # меньше вызовов за окно - доля ошибок не считается
+    
+    def __init__(self, llm_analyzer, db, analysis_batcher=None):
+        """
+        Args:
+            llm_analyzer: LLMAnalyzer, источник глубины очереди и статистики ошибок
+            db: DatabaseManager для журнала смены режимов
+            analysis_batcher: Необязательный AnalysisBatcher, его очередь тоже учитывается
+        """
+        self.llm_analyzer = llm_analyzer
+        self.db = db
+        self.analysis_batcher = analysis_batcher
+        self.loop_monitor = None  # LoopMonitor, устанавливается ботом; без него задержка меряется здесь
+        self.check_interval = Config.DEGRADATION_CHECK_INTERVAL
+        
+        self.mode = ServiceMode.FULL
+        self.mode_since = datetime.now()
+        self.last_metrics: Dict = {}
+        
+        self._recovery_checks = 0
+        self._last_calls = 0
+        self._last_errors = 0
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        """Запускает фоновый мониторинг (нужен работающий event loop)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._monitor())
+            logger.info("Контроллер деградации запущен")
+    
+    async def stop(self):
+        """Останавливает фоновый мониторинг"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    @property
+    def level(self) -> int:
+        """Номер текущего режима (0 - полный)"""
+        return ServiceMode.ORDER.index(self.mode)
+    
+    # Проверки принимают режим, зафиксированный на ход; без него берется текущий
+    
+    def allows_flow_analysis(self, mode: str = None) -> bool:
+        return (mode or self.mode) == ServiceMode.FULL
+    
+    def allows_llm_analysis(self, mode: str = None) -> bool:
+        return ServiceMode.ORDER.index(mode or self.mode) < ServiceMode.ORDER.index(ServiceMode.HEURISTIC)
+    
+    def allows_llm_response(self, mode: str = None) -> bool:
+        return (mode or self.mode) != ServiceMode.TEMPLATE
+    
+    async def _monitor(self):
+        """Измеряет задержку event loop и периодически пересчитывает режим"""
+        if self.loop_monitor and self.loop_monitor.running:
+            # Задержку уже непрерывно измеряет монитор event loop
+            while True:
+                await asyncio.sleep(self.check_interval)
+                try:
+                    await self.evaluate(self.loop_monitor.take_window_max())
+                except Exception as e:
+                    logger.error(f"Ошибка при оценке режима деградации: {e}")
+        
+        loop = asyncio.get_running_loop()
+        max_lag = 0.0
+        elapsed = 0.0
+        
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.SAMPLE_INTERVAL)
+            lag = max(0.0, loop.time() - started - self.SAMPLE_INTERVAL)
+            max_lag = max(max_lag, lag)
+            elapsed += self.SAMPLE_INTERVAL + lag
+            
+            if elapsed >= self.check_interval:
+                try:
+                    await self.evaluate(max_lag)
+                except Exception as e:
+                    logger.error(f"Ошибка при оценке режима деградации: {e}")
+                max_lag = 0.0
+                elapsed = 0.0
+    
+    def _collect_metrics(self, loop_lag: float) -> Dict:
+        """Собирает показатели нагрузки за прошедшее окно"""
+        queue_depth = self.llm_analyzer.in_flight
+        if self.analysis_batcher:
+            queue_depth += self.analysis_batcher.get_stats()['pending']
+        
+        calls = errors = 0
+        for stats in self.llm_analyzer.model_stats.values():
+            calls += stats.calls
+            errors += stats.errors
+        window_calls = calls - self._last_calls
+        window_errors = errors - self._last_errors
+        self._last_calls, self._last_errors = calls, errors
+        
+        error_rate = window_errors / window_calls if window_calls >= self.MIN_CALLS_FOR_ERROR_RATE else 0.0
+        
+        return {
+            'queue_depth': queue_depth,
+            'loop_lag': round(loop_lag, 3),
+            'error_rate': round(error_rate, 3),
+            'window_calls': window_calls
+        }
+    
+    @staticmethod
+    def _pressure_level(value: float, thresholds) -> int:
+        """Возвращает, сколько порогов превышено"""
+        return sum(1 for threshold in thresholds if value >= threshold)
+    
+    async def evaluate(self, loop_lag: float = 0.0):
+        """Пересчитывает целевой режим и при необходимости переключает его на один шаг"""
+        metrics = self._collect_metrics(loop_lag)
+        self.last_metrics = metrics
+        
+        target = max(
+            self._pressure_level(metrics['queue_depth'], Config.DEGRADATION_QUEUE_THRESHOLDS),
+            self._pressure_level(metrics['loop_lag'], Config.DEGRADATION_LAG_THRESHOLDS),
+            self._pressure_level(metrics['error_rate'], Config.DEGRADATION_ERROR_THRESHOLDS)
+        )
+        target = min(target, len(ServiceMode.ORDER) - 1)
+        
+        if target > self.level:
+            # Ухудшаем сразу, но по одному шагу за проверку
+            self._recovery_checks = 0
+            await self._switch_mode(ServiceMode.ORDER[self.level + 1], metrics)
+        elif target < self.level:
+            # Восстанавливаемся только после нескольких спокойных проверок подряд
+            self._recovery_checks += 1
+            if self._recovery_checks >= Config.DEGRADATION_RECOVERY_CHECKS:
+                self._recovery_checks = 0
+                await self._switch_mode(ServiceMode.ORDER[self.level - 1], metrics)
+        else:
+            self._recovery_checks = 0
+    
+    async def _switch_mode(self, new_mode: str, metrics: Dict):
+        """Переключает режим и записывает смену в базу данных"""
+        previous_mode = self.mode
+        self.mode = new_mode
+        self.mode_since = datetime.now()
+        
+        logger.warning(f"Режим обслуживания: {previous_mode} -> {new_mode}, показатели: {metrics}")
+        await self.db.log_service_mode_change(previous_mode, new_mode, metrics)
+    
+    def get_status(self) -> Dict:
+        """Возвращает текущее состояние контроллера"""
+        return {
+            'mode': self.mode,
+            'mode_since': self.mode_since.isoformat(),
+            'running': self._task is not None and not self._task.done(),
+            'metrics': self.last_metrics
+        }
@@ -0,0 +1,325 @@
+"""
+Потоковый экспорт данных эксперимента
+Таблицы выгружаются порциями из курсора в JSONL (gzip) и Parquet,
+так что потребление памяти не зависит от размера базы
+"""
+
+import gzip
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import zipfile
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Типы колонок для Parquet; колонки, которых здесь нет, выгружаются строками
+TABLE_SCHEMAS = {
+    'participants': {
+        'id': 'int',
+        'participant_id': 'string',
+        'telegram_user_id': 'int',
+        'language': 'string',
+        'experiment_group': 'string',
+        'start_time': 'timestamp',
+        'end_time': 'timestamp',
+        'final_decision': 'string',
+        'decision_time': 'timestamp',
+        'created_at': 'timestamp',
+        'total_messages': 'int',
+        'updated_at': 'timestamp'
+    },
+    'chat_messages': {
+        'id': 'int',
+        'participant_id': 'string',
+        'message_type': 'string',
+        'message_content': 'string',
+        'timestamp': 'timestamp'
+    },
+    'survey_responses': {
+        'id': 'int',
+        'participant_id': 'string',
+        'question_1': 'string',
+        'question_2': 'string',
+        'question_3': 'int',
+        'question_4': 'string',
+        'timestamp': 'timestamp'
+    },
+    'llm_analysis': {
+        'id': 'int',
+        'participant_id': 'string',
+        'user_message': 'string',
+        'analysis_json': 'string',
+        'bot_response': 'string',
+        'timestamp': 'timestamp',
+        'service_mode': 'string'
+    },
+    'conversation_flow': {
+        'id': 'int',
+        'participant_id': 'string',
+        'flow_analysis_json': 'string',
+        'timestamp': 'timestamp'
+    }
+}
+
+# Колонка времени для отбора строк, измененных после заданного момента (since)
+TIME_COLUMNS = {
+    'participants': 'updated_at',
+    'chat_messages': 'timestamp',
+    'survey_responses': 'timestamp',
+    'llm_analysis': 'timestamp',
+    'conversation_flow': 'timestamp'
+}
+
+# Колонки, которые DatabaseManager хранит зашифрованными
+ENCRYPTED_COLUMNS = {
+    'chat_messages': ['message_content'],
+    'survey_responses': ['question_4']
+}
+
+def _parse_timestamp(value) -> Optional[datetime]:
+    """Разбирает время из SQLite (CURRENT_TIMESTAMP или str(datetime))"""
+    if value is None or value == '':
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+def _parse_int(value) -> Optional[int]:
+    try:
+        return int(value) if value is not None and value != '' else None
+    except (TypeError, ValueError):
+        return None
+
+class StreamingExporter:
+    """Экспорт таблиц эксперимента порциями фиксированного размера"""
+    
+    def __init__(self, db_path: str = "data/experiment.db", batch_size: int = 5000,
+                 chunk_rows: int = 100000, decrypt: bool = False, since: str = None,
+                 progress: Callable[[str, int], None] = None):
+        """
+        Args:
+            db_path: Путь к базе данных
+            batch_size: Сколько строк читать из курсора за раз
+            chunk_rows: Максимум строк в одном JSONL файле
+            decrypt: Расшифровывать зашифрованные колонки (нужен ENCRYPTION_KEY)
+            since: Выгружать только строки не старше этого времени (UTC, 'YYYY-MM-DD[ HH:MM:SS]')
+            progress: Необязательный обратный вызов progress(таблица, выгружено строк)
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.chunk_rows = chunk_rows
+        self.decrypt = decrypt
+        self.since = since
+        self.progress = progress
+        self._decryptor = None
+    
+    def _get_decryptor(self):
+        if self._decryptor is None:
+            from utils.database import DatabaseManager
+            self._decryptor = DatabaseManager(self.db_path)._decrypt_data
+        return self._decryptor
+    
+    def iter_batches(self, table: str, where: str = None, params: tuple = (),
+                     order_by: str = "rowid") -> Iterator[Tuple[List[str], List[tuple]]]:
+        """
+        Отдает (колонки, строки) порциями по batch_size
+        
+        Args:
+            table: Таблица из TABLE_SCHEMAS
+            where: Необязательное SQL условие отбора строк
+            params: Параметры условия
+            order_by: Порядок выдачи строк
+        """
+        if table not in TABLE_SCHEMAS:
+            raise ValueError(f"Неизвестная таблица для экспорта: {table}")
+        
+        query = f"SELECT * FROM {table}"
+        if where:
+            query += f" WHERE {where}"
+        query += f" ORDER BY {order_by}"
+        
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute(query, params)
+            columns = [description[0] for description in cursor.description]
+            
+            encrypted = []
+            if self.decrypt:
+                encrypted = [columns.index(c) for c in ENCRYPTED_COLUMNS.get(table, []) if c in columns]
+            
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                
+                if encrypted:
+                    decrypt = self._get_decryptor()
+                    rows = [
+                        tuple(decrypt(value) if i in encrypted and value else value for i, value in enumerate(row))
+                        for row in rows
+                    ]
+                
+                yield columns, rows
+    
+    def iter_export_batches(self, table: str) -> Iterator[Tuple[List[str], List[tuple]]]:
+        """Порции таблицы для экспорта с учетом since и отчетом о прогрессе"""
+        where, params = None, ()
+        if self.since:
+            where, params = f"{TIME_COLUMNS[table]} >= ?", (self.since,)
+        
+        rows_done = 0
+        for columns, rows in self.iter_batches(table, where=where, params=params):
+            yield columns, rows
+            rows_done += len(rows)
+            if self.progress:
+                self.progress(table, rows_done)
+    
+    def export_jsonl(self, output_dir: str, tables: List[str] = None, compress: bool = True) -> Dict[str, List[str]]:
+        """
+        Выгружает таблицы в JSONL, по каталогу на таблицу и файлу на chunk_rows строк
+        
+        Returns:
+            Словарь {таблица: [пути к файлам]}
+        """
+        files = {}
+        for table in tables or TABLE_SCHEMAS:
+            table_dir = os.path.join(output_dir, table)
+            os.makedirs(table_dir, exist_ok=True)
+            files[table] = []
+            
+            handle = None
+            rows_in_file = 0
+            try:
+                for columns, rows in self.iter_export_batches(table):
+                    for row in rows:
+                        if handle is None or rows_in_file >= self.chunk_rows:
+                            if handle:
+                                handle.close()
+                            path = os.path.join(table_dir, f"part-{len(files[table]):05d}.jsonl" + (".gz" if compress else ""))
+                            handle = gzip.open(path, 'wt', encoding='utf-8') if compress else open(path, 'w', encoding='utf-8')
+                            files[table].append(path)
+                            rows_in_file = 0
+                        
+                        handle.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str))
+                        handle.write('\n')
+                        rows_in_file += 1
+            finally:
+                if handle:
+                    handle.close()
+            
+            logger.info(f"Таблица {table} выгружена в JSONL: {len(files[table])} файлов")
+        
+        return files
+    
+    def export_parquet(self, output_dir: str, tables: List[str] = None, compression: str = 'zstd') -> Dict[str, str]:
+        """
+        Выгружает таблицы в Parquet с типизированными колонками, по файлу на таблицу
+        
+        Returns:
+            Словарь {таблица: путь к файлу}
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Для экспорта в Parquet установите pyarrow")
+        
+        arrow_types = {'int': pa.int64(), 'timestamp': pa.timestamp('us'), 'string': pa.string()}
+        converters = {'int': _parse_int, 'timestamp': _parse_timestamp, 'string': lambda v: None if v is None else str(v)}
+        
+        os.makedirs(output_dir, exist_ok=True)
+        files = {}
+        
+        for table in tables or TABLE_SCHEMAS:
+            path = os.path.join(output_dir, f"{table}.parquet")
+            writer = None
+            try:
+                for columns, rows in self.iter_export_batches(table):
+                    types = [TABLE_SCHEMAS[table].get(column, 'string') for column in columns]
+                    if writer is None:
+                        schema = pa.schema([(column, arrow_types[t]) for column, t in zip(columns, types)])
+                        writer = pq.ParquetWriter(path, schema, compression=compression)
+                    
+                    arrays = [
+                        pa.array([converters[t](row[i]) for row in rows], type=arrow_types[t])
+                        for i, t in enumerate(types)
+                    ]
+                    writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                
+                if writer is None:
+                    # Пустая таблица: записываем файл со схемой, чтобы чтение не падало
+                    schema = pa.schema([(column, arrow_types[t]) for column, t in TABLE_SCHEMAS[table].items()])
+                    pq.write_table(schema.empty_table(), path, compression=compression)
+            finally:
+                if writer:
+                    writer.close()
+            
+            files[table] = path
+            logger.info(f"Таблица {table} выгружена в Parquet: {path}")
+        
+        return files
+    
+    def export_archive(self, output_path: str, fmt: str = 'jsonl', tables: List[str] = None) -> Dict[str, int]:
+        """
+        Выгружает таблицы в один zip архив
+        
+        JSONL пишется в архив построчно (deflate) без промежуточных файлов;
+        Parquet уже сжат zstd, поэтому файлы добавляются в архив без сжатия.
+        
+        Returns:
+            Словарь {таблица: число строк}
+        """
+        if fmt not in ('jsonl', 'parquet'):
+            raise ValueError(f"Неизвестный формат экспорта: {fmt}")
+        
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        counts = {}
+        
+        if fmt == 'jsonl':
+            with zipfile.ZipFile(output_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+                for table in tables or TABLE_SCHEMAS:
+                    counts[table] = 0
+                    with archive.open(f"{table}.jsonl", 'w', force_zip64=True) as entry:
+                        for columns, rows in self.iter_export_batches(table):
+                            lines = [json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) for row in rows]
+                            entry.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                            counts[table] += len(rows)
+            return counts
+        
+        tmp_dir = tempfile.mkdtemp(prefix='export-', dir=os.path.dirname(output_path) or '.')
+        try:
+            files = self.export_parquet(tmp_dir, tables)
+            import pyarrow.parquet as pq
+            with zipfile.ZipFile(output_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+                for table, path in files.items():
+                    counts[table] = pq.ParquetFile(path).metadata.num_rows
+                    archive.write(path, f"{table}.parquet")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return counts
+    
+    def export(self, output_dir: str, formats: Tuple[str, ...] = ('jsonl', 'parquet'),
+               tables: List[str] = None) -> Dict:
+        """Выгружает таблицы в выбранных форматах и пишет manifest.json"""
+        os.makedirs(output_dir, exist_ok=True)
+        manifest = {
+            'export_timestamp': datetime.now().isoformat(),
+            'decrypted': self.decrypt,
+            'since': self.since,
+            'files': {}
+        }
+        
+        if 'jsonl' in formats:
+            manifest['files']['jsonl'] = self.export_jsonl(os.path.join(output_dir, 'jsonl'), tables)
+        if 'parquet' in formats:
+            manifest['files']['parquet'] = self.export_parquet(os.path.join(output_dir, 'parquet'), tables)
+        
+        with open(os.path.join(output_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        
+        return manifest
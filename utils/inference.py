@@ -0,0 +1,261 @@
+"""
+Статистические выводы об эффективности нуджинга
+Бутстрэп и перестановочные тесты векторизованы на NumPy: для бинарных и
+дискретных данных повторы генерируются сразу счетчиками (биномиальное,
+гипергеометрическое, мультиномиальное распределения), для непрерывных -
+матрицами индексов порциями, при необходимости в пуле процессов
+"""
+
+import logging
+import math
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Сколько повторов обрабатывать одной матрицей (ограничивает память: chunk x n)
+CHUNK_SIZE = 2000
+
+# До скольких различных пар (x, y) бутстрэп корреляции считается через мультиномиальные счетчики
+MAX_DISCRETE_PAIRS = 256
+
+def _split(total: int, parts: int) -> List[int]:
+    """Делит число повторов на части для процессов"""
+    base, extra = divmod(total, parts)
+    sizes = [base + (1 if i < extra else 0) for i in range(parts)]
+    return [size for size in sizes if size > 0] or [0]
+
+def _correlation_chunk(x: np.ndarray, y: np.ndarray, n_resamples: int, seed) -> np.ndarray:
+    """Бутстрэп коэффициента корреляции Пирсона; повторы с нулевой дисперсией дают NaN"""
+    rng = np.random.default_rng(seed)
+    n = len(x)
+    results = []
+    for start in range(0, n_resamples, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, n_resamples - start)
+        idx = rng.integers(0, n, size=(size, n))
+        xs = x[idx]
+        ys = y[idx]
+        xc = xs - xs.mean(axis=1, keepdims=True)
+        yc = ys - ys.mean(axis=1, keepdims=True)
+        denominator = np.sqrt((xc ** 2).sum(axis=1) * (yc ** 2).sum(axis=1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            results.append((xc * yc).sum(axis=1) / denominator)
+    return np.concatenate(results) if results else np.empty(0)
+
+def _pearson_from_counts(counts: np.ndarray, ux: np.ndarray, uy: np.ndarray) -> np.ndarray:
+    """Корреляция Пирсона для каждой строки матрицы счетчиков пар (ux[k], uy[k])"""
+    n = counts.sum(axis=1)
+    mx = counts @ ux / n
+    my = counts @ uy / n
+    cov = counts @ (ux * uy) / n - mx * my
+    var_x = counts @ (ux * ux) / n - mx ** 2
+    var_y = counts @ (uy * uy) / n - my ** 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = cov / np.sqrt(var_x * var_y)
+    # Повторы, где одна из переменных постоянна, не дают корреляции
+    r[(var_x <= 1e-12) | (var_y <= 1e-12)] = np.nan
+    return r
+
+def chi_square_2x2(table: np.ndarray) -> Dict[str, float]:
+    """
+    Критерий хи-квадрат для таблицы 2x2 (без поправки Йейтса)
+    
+    p-значение для одной степени свободы: P(X > s) = erfc(sqrt(s / 2))
+    """
+    table = np.asarray(table, dtype=float)
+    total = table.sum()
+    expected = np.outer(table.sum(axis=1), table.sum(axis=0)) / total if total else np.zeros((2, 2))
+    if total == 0 or (expected == 0).any():
+        return {'statistic': 0.0, 'p_value': 1.0}
+    statistic = float(((table - expected) ** 2 / expected).sum())
+    return {'statistic': statistic, 'p_value': math.erfc(math.sqrt(statistic / 2))}
+
+def cohens_h(p1: float, p2: float) -> float:
+    """Размер эффекта Коэна h для разницы двух долей"""
+    return 2 * math.asin(math.sqrt(p1)) - 2 * math.asin(math.sqrt(p2))
+
+def odds_ratio(table: np.ndarray, confidence: float = 0.95) -> Dict[str, float]:
+    """Отношение шансов с поправкой Холдейна (+0.5) и доверительным интервалом по log OR"""
+    a, b, c, d = np.asarray(table, dtype=float).ravel() + 0.5
+    log_or = math.log(a * d / (b * c))
+    se = math.sqrt(1 / a + 1 / b + 1 / c + 1 / d)
+    z = _normal_quantile(0.5 + confidence / 2)
+    return {
+        'odds_ratio': math.exp(log_or),
+        'ci_low': math.exp(log_or - z * se),
+        'ci_high': math.exp(log_or + z * se)
+    }
+
+def _normal_quantile(p: float) -> float:
+    """Квантиль стандартного нормального распределения (бисекция по erfc)"""
+    low, high = -10.0, 10.0
+    for _ in range(100):
+        mid = (low + high) / 2
+        if 0.5 * math.erfc(-mid / math.sqrt(2)) < p:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+class NudgingInference:
+    """Бутстрэп доверительные интервалы, перестановочные тесты и размеры эффекта"""
+    
+    def __init__(self, n_resamples: int = 10000, confidence: float = 0.95,
+                 seed: Optional[int] = None, n_workers: int = 1):
+        """
+        Args:
+            n_resamples: Количество бутстрэп повторов и перестановок
+            confidence: Уровень доверия для интервалов
+            seed: Зерно генератора для воспроизводимости
+            n_workers: Число процессов; 1 - считать в текущем процессе
+        """
+        self.n_resamples = n_resamples
+        self.confidence = confidence
+        self.n_workers = max(1, n_workers)
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.rng = np.random.default_rng(self.seed_sequence.spawn(1)[0])
+    
+    def _percentile_ci(self, samples: np.ndarray) -> Dict[str, float]:
+        samples = samples[~np.isnan(samples)]
+        if samples.size == 0:
+            return {'ci_low': float('nan'), 'ci_high': float('nan')}
+        alpha = (1 - self.confidence) / 2
+        low, high = np.quantile(samples, [alpha, 1 - alpha])
+        return {'ci_low': float(low), 'ci_high': float(high)}
+    
+    def _run_chunks(self, func, *args) -> list:
+        """Делит повторы между процессами, у каждого свое независимое зерно"""
+        parts = _split(self.n_resamples, self.n_workers)
+        seeds = self.seed_sequence.spawn(len(parts))
+        if len(parts) == 1:
+            return [func(*args, parts[0], seeds[0])]
+        with ProcessPoolExecutor(max_workers=len(parts)) as executor:
+            futures = [executor.submit(func, *args, count, seed) for count, seed in zip(parts, seeds)]
+            return [future.result() for future in futures]
+    
+    def proportion_ci(self, successes: np.ndarray) -> Dict[str, float]:
+        """
+        Бутстрэп интервал для доли
+        
+        Число успехов в бутстрэп выборке из n бинарных значений распределено
+        как Binomial(n, p), поэтому повторы генерируются без матрицы индексов.
+        """
+        n = len(successes)
+        if n == 0:
+            return {'n': 0, 'rate': float('nan'), 'ci_low': float('nan'), 'ci_high': float('nan')}
+        rate = float(np.mean(successes))
+        samples = self.rng.binomial(n, rate, size=self.n_resamples) / n
+        return {'n': n, 'rate': rate, **self._percentile_ci(samples)}
+    
+    def difference_ci(self, a: np.ndarray, b: np.ndarray) -> Dict[str, float]:
+        """Бутстрэп интервал для разницы долей a - b"""
+        if len(a) == 0 or len(b) == 0:
+            return {'difference': float('nan'), 'ci_low': float('nan'), 'ci_high': float('nan')}
+        pa, pb = float(np.mean(a)), float(np.mean(b))
+        samples = (self.rng.binomial(len(a), pa, size=self.n_resamples) / len(a)
+                   - self.rng.binomial(len(b), pb, size=self.n_resamples) / len(b))
+        return {'difference': pa - pb, **self._percentile_ci(samples)}
+    
+    def permutation_test(self, a: np.ndarray, b: np.ndarray) -> Dict[str, float]:
+        """
+        Двусторонний перестановочный тест для разницы долей
+        
+        При случайной перестановке бинарных значений число успехов, попавших
+        в первую группу, распределено гипергеометрически, поэтому перестановки
+        генерируются сразу счетчиками, без перемешивания массивов.
+        """
+        if len(a) == 0 or len(b) == 0:
+            return {'p_value': float('nan'), 'n_permutations': 0}
+        n_a, n_b = len(a), len(b)
+        successes = int(np.sum(a)) + int(np.sum(b))
+        observed = float(np.mean(a) - np.mean(b))
+        
+        in_a = self.rng.hypergeometric(successes, n_a + n_b - successes, n_a, size=self.n_resamples)
+        diffs = in_a / n_a - (successes - in_a) / n_b
+        # Небольшой допуск, чтобы ошибки округления не теряли равные разницы
+        extreme = int(np.count_nonzero(np.abs(diffs) >= abs(observed) - 1e-12))
+        return {
+            'p_value': (extreme + 1) / (self.n_resamples + 1),
+            'n_permutations': self.n_resamples
+        }
+    
+    def correlation(self, x: np.ndarray, y: np.ndarray) -> Dict[str, float]:
+        """Корреляция Пирсона с бутстрэп интервалом (для бинарных переменных - phi)"""
+        mask = ~(np.isnan(x) | np.isnan(y))
+        x, y = x[mask], y[mask]
+        if len(x) < 3 or x.std() == 0 or y.std() == 0:
+            return {'n': int(len(x)), 'r': float('nan'), 'ci_low': float('nan'), 'ci_high': float('nan')}
+        r = float(np.corrcoef(x, y)[0, 1])
+        
+        pairs, counts = np.unique(np.column_stack([x, y]), axis=0, return_counts=True)
+        if len(pairs) <= MAX_DISCRETE_PAIRS:
+            # Ответы опроса дискретны: бутстрэп выборка - это мультиномиальные счетчики пар
+            resampled = self.rng.multinomial(len(x), counts / len(x), size=self.n_resamples)
+            samples = _pearson_from_counts(resampled.astype(float), pairs[:, 0], pairs[:, 1])
+        else:
+            samples = np.concatenate(self._run_chunks(_correlation_chunk, x, y))
+        return {'n': int(len(x)), 'r': r, **self._percentile_ci(samples)}
+    
+    def treatment_effect(self, confessed: np.ndarray, in_confess_group: np.ndarray) -> Dict:
+        """
+        Эффект нуджинга: доля признаний в группе confess против группы silent
+        
+        Args:
+            confessed: Булев массив, участник признался
+            in_confess_group: Булев массив, участник в группе confess
+        """
+        a = confessed[in_confess_group]
+        b = confessed[~in_confess_group]
+        table = np.array([
+            [a.sum(), len(a) - a.sum()],
+            [b.sum(), len(b) - b.sum()]
+        ])
+        result = {
+            'confess_rate_confess_group': self.proportion_ci(a),
+            'confess_rate_silent_group': self.proportion_ci(b),
+            'difference': self.difference_ci(a, b),
+            'permutation': self.permutation_test(a, b),
+            'chi_square': chi_square_2x2(table),
+            'odds_ratio': odds_ratio(table, self.confidence)
+        }
+        if len(a) and len(b):
+            result['cohens_h'] = cohens_h(float(a.mean()), float(b.mean()))
+        return result
+    
+    def analyze(self, data: Dict[str, np.ndarray]) -> Dict:
+        """
+        Полный набор выводов по данным участников с финальным решением
+        
+        Args:
+            data: Массивы одинаковой длины: group, language, decision (строки),
+                felt_influence и confidence (float, NaN если опроса нет)
+        """
+        group = data['group']
+        decision = data['decision']
+        confessed = decision == 'confess'
+        in_confess_group = group == 'confess'
+        success = decision == group
+        
+        result = {
+            'n_participants': int(len(group)),
+            'n_resamples': self.n_resamples,
+            'confidence': self.confidence,
+            'success_rate': {
+                'confess_group': self.proportion_ci(success[in_confess_group]),
+                'silent_group': self.proportion_ci(success[~in_confess_group])
+            },
+            'treatment_effect': self.treatment_effect(confessed, in_confess_group),
+            'by_language': {},
+            'survey_correlations': {
+                'felt_influence_vs_success': self.correlation(data['felt_influence'], success.astype(float)),
+                'confidence_vs_success': self.correlation(data['confidence'], success.astype(float))
+            }
+        }
+        
+        for language in np.unique(data['language']):
+            mask = data['language'] == language
+            result['by_language'][str(language)] = self.treatment_effect(confessed[mask], in_confess_group[mask])
+        
+        return result
@@ -3,24 +3,158 @@ LLM анализатор для обработки сообщений польз
 Интеграция с cloud.ru API для анализа эмоций, намерений и контекста
 """
 
+import asyncio
 import logging
-import requests
+import hashlib
+import time
 import json
 from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 from config.settings import Config
+from utils.llm_backends import LLMBackend, LatencyStats, create_backends
+from utils.metrics import observe_llm_call
+from utils.profiling import timed_stage
+from utils.tracing import record_span, traced
+from utils.logging_setup import RateLimitedLog, SampledLog
 
 logger = logging.getLogger(__name__)
+# Успешные вызовы идут на каждое сообщение, в лог попадает их выборка;
+# сбои пишутся всегда, но не чаще раза в минуту на модель
+sampled_log = SampledLog(logger, Config.LOG_SAMPLE_RATE)
+failure_log = RateLimitedLog(logger, interval=60)
+
+# Неизменяемые инструкции вынесены в системное сообщение, чтобы префикс запроса
+# был побайтно одинаковым между ходами и кешировался на стороне провайдера
+ANALYSIS_INSTRUCTIONS = """Проанализируй сообщение пользователя в контексте эксперимента по дилемме заключенного.
+
+Верни результат в формате JSON со следующими полями:
+
+1. "emotion": эмоциональное состояние (positive, negative, neutral, anxious, frustrated, cooperative, defensive)
+2. "intent": намерение пользователя (cooperate, defect, question, complaint, confusion, agreement, disagreement)
+3. "confidence": уровень уверенности в решении (high, medium, low)
+4. "persuasion_resistance": сопротивление убеждению (high, medium, low)
+5. "key_themes": основные темы в сообщении (массив строк)
+6. "suggested_response": предложение для ответа бота (краткое)
+7. "nudging_effectiveness": эффективность нуджинга (high, medium, low)
+8. "risk_of_dropout": риск выхода из эксперимента (high, medium, low)
+
+Ответ должен быть только в формате JSON, без дополнительного текста."""
+
+FLOW_INSTRUCTIONS = """Проанализируй поток разговора в эксперименте по дилемме заключенного.
+
+Верни анализ в формате JSON:
+1. "engagement_level": уровень вовлеченности (high, medium, low)
+2. "conversation_quality": качество разговора (good, average, poor)
+3. "user_satisfaction": удовлетворенность пользователя (high, medium, low)
+4. "experiment_progress": прогресс эксперимента (on_track, struggling, off_track)
+5. "recommendations": рекомендации для бота (массив строк)"""
+
+BATCH_ANALYSIS_INSTRUCTIONS = """Тебе передается JSON-массив сообщений разных участников. Каждый элемент содержит поля "id", "context" и "message".
+Проанализируй каждое сообщение независимо от остальных и верни JSON-массив той же длины.
+Каждый элемент массива - объект с полем "id" исходного сообщения и полями анализа, перечисленными выше.
+Ответ должен быть только JSON-массивом, без дополнительного текста."""
+
+RESPONSE_INSTRUCTIONS = """Сгенерируй ответ бота, который:
+1. Учитывает всю историю разговора и контекст
+2. Отвечает на конкретные вопросы и замечания пользователя
+3. Развивает диалог естественно и логично
+4. Соответствует стратегии для группы {group}
+5. Поддерживает интерес к эксперименту
+6. Естественно звучит на {language} языке
+7. Может быть развернутым (3-5 предложений) для лучшего взаимодействия
+
+Ответ должен быть в формате JSON:
+{{
+    "response": "Ваш развернутый ответ здесь"
+}}"""
+
+# Ключевые слова для эвристического анализа в режиме деградации (ru/en, подстроки)
+HEURISTIC_KEYWORDS = {
+    'cooperate': ['призна', 'честн', 'сознаюсь', 'confess', 'honest', 'admit'],
+    'defect': ['молч', 'не скажу', 'не буду призна', 'silent', 'silence', 'stay quiet'],
+    'anxious': ['боюсь', 'страшно', 'волну', 'тревож', 'afraid', 'scared', 'worried', 'nervous'],
+    'frustrated': ['надоел', 'раздраж', 'бесит', 'зачем', 'annoy', 'frustrat', 'pointless'],
+    'positive': ['спасибо', 'интересно', 'согласен', 'хорошо', 'thanks', 'interesting', 'agree', 'good']
+}
+
+class PrefixCacheTracker:
+    """
+    Локальная оценка попаданий в кеш префиксов провайдера.
+    
+    Провайдер кеширует KV-состояние для одинакового начала запроса в течение
+    некоторого времени. Трекер запоминает хеши отправленных префиксов и считает
+    попаданием повторную отправку того же префикса в пределах TTL.
+    """
+    
+    def __init__(self, ttl_seconds: int = 300):
+        self.ttl_seconds = ttl_seconds
+        self._last_seen: Dict[str, float] = {}
+        self.requests = 0
+        self.hits = 0
+        self.prefix_chars = 0
+        self.cached_prefix_chars = 0
+        # Фактические значения из usage, если провайдер их возвращает
+        self.provider_prompt_tokens = 0
+        self.provider_cached_tokens = 0
+    
+    def record(self, prefix: str, model: str = ''):
+        """Учитывает отправку префикса (кеш провайдера раздельный для каждой модели)"""
+        now = time.monotonic()
+        key = hashlib.sha1(f"{model}\n{prefix}".encode('utf-8')).hexdigest()
+        last_seen = self._last_seen.get(key)
+        
+        self.requests += 1
+        self.prefix_chars += len(prefix)
+        if last_seen is not None and now - last_seen <= self.ttl_seconds:
+            self.hits += 1
+            self.cached_prefix_chars += len(prefix)
+        self._last_seen[key] = now
+    
+    def record_usage(self, usage: Optional[Dict]):
+        """Учитывает статистику токенов из ответа провайдера"""
+        if not usage:
+            return
+        self.provider_prompt_tokens += usage.get('prompt_tokens') or 0
+        details = usage.get('prompt_tokens_details') or {}
+        self.provider_cached_tokens += details.get('cached_tokens') or 0
+    
+    def get_stats(self) -> Dict:
+        """Возвращает статистику кеширования префиксов"""
+        return {
+            'requests': self.requests,
+            'hits': self.hits,
+            'hit_rate': self.hits / self.requests if self.requests else 0.0,
+            'unique_prefixes': len(self._last_seen),
+            # Грубая оценка: ~4 символа на токен
+            'estimated_cached_tokens': self.cached_prefix_chars // 4,
+            'provider_prompt_tokens': self.provider_prompt_tokens,
+            'provider_cached_tokens': self.provider_cached_tokens
+        }
+
+class ModelStats(LatencyStats):
+    """Статистика вызовов одной модели с учетом паузы после сбоя"""
+    
+    def __init__(self):
+        super().__init__()
+        self.unavailable_until = 0.0
 
 class LLMAnalyzer:
     """Анализатор сообщений с использованием LLM"""
     
-    def __init__(self):
+    def __init__(self, backends: Dict[str, LLMBackend] = None):
         self.api_key = Config.CLOUD_RU_API_KEY
-        self.base_url = "https://foundation-models.api.cloud.ru/v1"
-        self.model = "Qwen/Qwen3-235B-A22B-Instruct-2507"  # Используем Qwen модель (более стабильная)
+        self.backends = backends if backends is not None else create_backends()
+        # Маршрутизация по назначению: analysis, flow, response -> [(бэкенд, модель), ...]
+        self.model_routing = Config.get_llm_model_routing()
+        self.model = self.model_routing['response'][0][1]
+        self.model_stats: Dict[str, ModelStats] = {}
+        self.prefix_cache = PrefixCacheTracker(Config.LLM_PREFIX_CACHE_TTL_SECONDS)
+        self._response_prefixes: Dict[Tuple[str, str], str] = {}
+        # Количество вызовов LLM, ожидающих ответа (глубина очереди для контроллера деградации)
+        self.in_flight = 0
         
-    def analyze_message(self, message: str, context: Dict = None) -> Dict:
+    @traced()
+    async def analyze_message(self, message: str, context: Dict = None) -> Dict:
         """
         Анализирует сообщение пользователя
         
@@ -32,15 +166,15 @@ class LLMAnalyzer:
             Словарь с результатами анализа
         """
         try:
-            if not self.api_key:
-                logger.warning("Cloud.ru API ключ не настроен, возвращаем базовый анализ")
+            if not self.has_backend('analysis'):
+                logger.warning("Бэкенд LLM для анализа не настроен, возвращаем базовый анализ")
                 return self._basic_analysis(message)
             
-            # Формируем промпт для анализа
-            prompt = self._create_analysis_prompt(message, context)
+            # Формируем сообщения для анализа
+            messages = self._create_analysis_messages(message, context)
             
             # Отправляем запрос к API
-            response = self._call_cloud_ru_api(prompt)
+            response = await self._call_llm(messages, purpose='analysis')
             
             if response:
                 return self._parse_analysis_response(response)
@@ -51,107 +185,183 @@ class LLMAnalyzer:
             logger.error(f"Ошибка при анализе сообщения: {e}")
             return self._basic_analysis(message)
     
-    def _create_analysis_prompt(self, message: str, context: Dict = None) -> str:
-        """Создает промпт для анализа сообщения"""
+    def _create_analysis_messages(self, message: str, context: Dict = None) -> List[Dict]:
+        """Создает сообщения для анализа: стабильный системный префикс и переменная часть"""
         
         context_info = ""
         if context:
-            context_info = f"""
-Контекст разговора:
+            context_info = f"""Контекст разговора:
 - Группа: {context.get('group', 'неизвестно')}
 - Время в эксперименте: {context.get('time_elapsed', 0)} минут
 - Предыдущие сообщения: {context.get('message_count', 0)}
-"""
-        
-        prompt = f"""
-Проанализируй следующее сообщение пользователя в контексте эксперимента по дилемме заключенного:
-
-{context_info}
-
-Сообщение пользователя: "{message}"
-
-Пожалуйста, проанализируй и верни результат в формате JSON со следующими полями:
-
-1. "emotion": эмоциональное состояние (positive, negative, neutral, anxious, frustrated, cooperative, defensive)
-2. "intent": намерение пользователя (cooperate, defect, question, complaint, confusion, agreement, disagreement)
-3. "confidence": уровень уверенности в решении (high, medium, low)
-4. "persuasion_resistance": сопротивление убеждению (high, medium, low)
-5. "key_themes": основные темы в сообщении (массив строк)
-6. "suggested_response": предложение для ответа бота (краткое)
-7. "nudging_effectiveness": эффективность нуджинга (high, medium, low)
-8. "risk_of_dropout": риск выхода из эксперимента (high, medium, low)
 
-Ответ должен быть только в формате JSON, без дополнительного текста.
 """
-        return prompt
-    
-    def _call_cloud_ru_api(self, prompt: str) -> Optional[Dict]:
-        """Вызывает API cloud.ru с retry логикой"""
-        import time
         
-        max_retries = 3
-        retry_delay = 2
+        return [
+            {"role": "system", "content": self._get_analysis_prefix()},
+            {"role": "user", "content": f'{context_info}Сообщение пользователя: "{message}"'}
+        ]
+    
+    @traced()
+    async def analyze_messages_batch(self, items: List[Tuple[str, Dict]]) -> List[Dict]:
+        """
+        Анализирует несколько сообщений одним запросом к LLM
         
-        for attempt in range(max_retries):
-            try:
-                headers = {
-                    "Authorization": f"Bearer {self.api_key}",
-                    "Content-Type": "application/json"
-                }
-                
-                data = {
-                    "model": self.model,
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": Config.LLM_SYSTEM_PROMPT
-                        },
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    "max_tokens": 500,
-                    "temperature": 0.3
+        Args:
+            items: Список пар (сообщение, контекст)
+            
+        Returns:
+            Список результатов анализа в том же порядке; для сообщений, которые
+            не удалось разобрать из ответа, возвращается базовый анализ
+        """
+        try:
+            if not self.has_backend('analysis'):
+                return [self._basic_analysis(message) for message, _ in items]
+            
+            payload = [
+                {
+                    "id": index,
+                    "context": {
+                        "group": (context or {}).get('group', 'неизвестно'),
+                        "time_elapsed": round((context or {}).get('time_elapsed', 0), 1),
+                        "message_count": (context or {}).get('message_count', 0)
+                    },
+                    "message": message
                 }
-                
-                response = requests.post(
-                    f"{self.base_url}/chat/completions",
-                    headers=headers,
-                    json=data,
-                    timeout=30
+                for index, (message, context) in enumerate(items)
+            ]
+            
+            messages = [
+                {"role": "system", "content": f"{self._get_analysis_prefix()}\n\n{BATCH_ANALYSIS_INSTRUCTIONS}"},
+                {"role": "user", "content": json.dumps(payload, ensure_ascii=False)}
+            ]
+            
+            response = await self._call_llm(messages, purpose='analysis', max_tokens=300 * len(items))
+            parsed = self._parse_batch_response(response) if response else {}
+            
+            return [
+                parsed.get(index) or self._basic_analysis(message)
+                for index, (message, _) in enumerate(items)
+            ]
+            
+        except Exception as e:
+            logger.error(f"Ошибка при пакетном анализе сообщений: {e}")
+            return [self._basic_analysis(message) for message, _ in items]
+    
+    def _parse_batch_response(self, response: str) -> Dict[int, Dict]:
+        """Разбирает JSON-массив пакетного анализа в словарь {id: анализ}"""
+        try:
+            start_idx = response.find('[')
+            end_idx = response.rfind(']') + 1
+            if start_idx == -1 or end_idx == 0:
+                return {}
+            
+            results = {}
+            for item in json.loads(response[start_idx:end_idx]):
+                if isinstance(item, dict) and isinstance(item.get('id'), int):
+                    results[item.pop('id')] = item
+            return results
+            
+        except json.JSONDecodeError as e:
+            logger.error(f"Ошибка парсинга JSON пакетного анализа: {e}")
+            return {}
+    
+    def _get_analysis_prefix(self) -> str:
+        """Возвращает неизменяемый системный префикс для анализа сообщений"""
+        return f"{Config.LLM_SYSTEM_PROMPT}\n\n{ANALYSIS_INSTRUCTIONS}"
+    
+    def has_backend(self, purpose: str) -> bool:
+        """Проверяет, есть ли настроенный бэкенд для назначения вызова"""
+        return bool(self._get_route(purpose))
+    
+    def _get_route(self, purpose: str) -> List[Tuple[str, str]]:
+        """Возвращает цепочку (бэкенд, модель) для назначения, исключая ненастроенные бэкенды"""
+        chain = self.model_routing.get(purpose, self.model_routing['response'])
+        return [
+            (backend_name, model) for backend_name, model in chain
+            if backend_name in self.backends and self.backends[backend_name].is_configured()
+        ]
+    
+    @timed_stage('llm')
+    async def _call_llm(self, messages: List[Dict], purpose: str = 'response', max_tokens: int = 500) -> Optional[str]:
+        """
+        Вызывает LLM через бэкенды с переключением на резервную модель
+        
+        Args:
+            messages: Сообщения чата; первое (системное) сообщение считается
+                кешируемым префиксом запроса
+            purpose: Назначение вызова (analysis, flow, response)
+            max_tokens: Ограничение длины ответа
+        """
+        route = self._get_route(purpose)
+        if not route:
+            return None
+        
+        now = time.monotonic()
+        
+        # Модели после недавнего сбоя пропускаем, но последняя в цепочке пробуется всегда
+        candidates = [entry for entry in route[:-1] if self._get_model_stats(*entry).unavailable_until <= now]
+        candidates.append(route[-1])
+        
+        self.in_flight += 1
+        try:
+            for index, (backend_name, model) in enumerate(candidates):
+                is_last = index == len(candidates) - 1
+                stats = self._get_model_stats(backend_name, model)
+            
+                started = time.monotonic()
+                # Для не последней модели не ждем повторов, сразу переходим к резервной
+                result = await self.backends[backend_name].chat(
+                    model, messages, max_tokens=max_tokens, max_retries=3 if is_last else 1
                 )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    return result.get("choices", [{}])[0].get("message", {}).get("content")
-                elif response.status_code in [503, 502, 504]:  # Временные ошибки сервера
-                    if attempt < max_retries - 1:
-                        logger.warning(f"Временная ошибка API cloud.ru: {response.status_code}, повтор через {retry_delay}с (попытка {attempt + 1}/{max_retries})")
-                        time.sleep(retry_delay)
-                        retry_delay *= 2  # Экспоненциальная задержка
-                        continue
-                    else:
-                        logger.error(f"API cloud.ru недоступен после {max_retries} попыток: {response.status_code} - {response.text}")
-                        return None
-                else:
-                    logger.error(f"Ошибка API cloud.ru: {response.status_code} - {response.text}")
-                    return None
-                    
-            except requests.exceptions.Timeout:
-                if attempt < max_retries - 1:
-                    logger.warning(f"Таймаут API cloud.ru, повтор через {retry_delay}с (попытка {attempt + 1}/{max_retries})")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2
-                    continue
+                latency = time.monotonic() - started
+            
+                success = result is not None and result.get('content') is not None
+                stats.record(latency, success)
+                observe_llm_call(f"{backend_name}:{model}", purpose, latency, success)
+                record_span('llm.attempt', latency, model=f"{backend_name}:{model}", purpose=purpose, success=success)
+                if success:
+                    sampled_log.log(logging.INFO, "LLM %s: %s:%s, %.0f мс", purpose, backend_name, model, latency * 1000)
                 else:
-                    logger.error("API cloud.ru недоступен: таймаут")
-                    return None
-            except Exception as e:
-                logger.error(f"Ошибка при вызове cloud.ru API: {e}")
-                return None
+                    failure_log.log(
+                        logging.WARNING, f"{backend_name}:{model}",
+                        f"LLM {purpose}: {backend_name}:{model}, {latency * 1000:.0f} мс, ошибка"
+                    )
+            
+                if success:
+                    self.prefix_cache.record(messages[0]["content"], f"{backend_name}:{model}")
+                    self.prefix_cache.record_usage(result.get("usage"))
+                    return result['content']
+            
+                if not is_last:
+                    stats.unavailable_until = time.monotonic() + Config.LLM_MODEL_COOLDOWN_SECONDS
+                    logger.warning(f"Модель {backend_name}:{model} недоступна для {purpose}, переключаемся на {candidates[index + 1][0]}:{candidates[index + 1][1]}")
         
-        return None
+            return None
+        finally:
+            self.in_flight -= 1
+    
+    def _get_model_stats(self, backend_name: str, model: str) -> ModelStats:
+        """Возвращает статистику модели, создавая ее при необходимости"""
+        key = f"{backend_name}:{model}"
+        if key not in self.model_stats:
+            self.model_stats[key] = ModelStats()
+        return self.model_stats[key]
+    
+    async def check_backends_health(self) -> Dict[str, bool]:
+        """Проверяет доступность всех настроенных бэкендов"""
+        configured = {name: backend for name, backend in self.backends.items() if backend.is_configured()}
+        results = await asyncio.gather(*(backend.health_check() for backend in configured.values()))
+        return dict(zip(configured.keys(), results))
+    
+    async def close(self):
+        """Освобождает ресурсы всех бэкендов (HTTP клиенты, потоки локальной модели)"""
+        results = await asyncio.gather(
+            *(backend.close() for backend in self.backends.values()), return_exceptions=True
+        )
+        for name, result in zip(self.backends.keys(), results):
+            if isinstance(result, Exception):
+                logger.warning(f"Не удалось закрыть бэкенд {name}: {result}")
     
     def _parse_analysis_response(self, response: str) -> Dict:
         """Парсит ответ от LLM"""
@@ -203,7 +413,44 @@ class LLMAnalyzer:
             "analysis_method": "basic"
         }
     
-    def analyze_conversation_flow(self, messages: List[Dict]) -> Dict:
+    def heuristic_analysis(self, message: str) -> Dict:
+        """
+        Быстрый анализ по ключевым словам без обращения к LLM
+        
+        Используется контроллером деградации при перегрузке: поля совпадают
+        с LLM анализом, но без suggested_response, так что ответ строится
+        либо LLM, либо по шаблону группы.
+        """
+        text = message.lower()
+        
+        # Только метки из словаря LLM (ANALYSIS_INSTRUCTIONS); без ключевых слов -
+        # "question", как и в базовом анализе, чтобы доли намерений не зависели от режима
+        intent = "question"
+        # Отказ проверяется первым: "не буду признаваться" содержит и "призна"
+        if any(word in text for word in HEURISTIC_KEYWORDS['defect']):
+            intent = "defect"
+        elif any(word in text for word in HEURISTIC_KEYWORDS['cooperate']):
+            intent = "cooperate"
+        
+        emotion = "neutral"
+        for candidate in ('anxious', 'frustrated', 'positive'):
+            if any(word in text for word in HEURISTIC_KEYWORDS[candidate]):
+                emotion = candidate
+                break
+        
+        return {
+            "emotion": emotion,
+            "intent": intent,
+            "confidence": "medium",
+            "persuasion_resistance": "medium",
+            "key_themes": ["general"],
+            "nudging_effectiveness": "medium",
+            "risk_of_dropout": "medium" if emotion == "frustrated" else "low",
+            "analysis_method": "heuristic"
+        }
+    
+    @traced()
+    async def analyze_conversation_flow(self, messages: List[Dict]) -> Dict:
         """
         Анализирует поток разговора
         
@@ -225,20 +472,12 @@ class LLMAnalyzer:
                 for msg in recent_messages
             ])
             
-            prompt = f"""
-Проанализируй поток разговора в эксперименте по дилемме заключенного:
-
-{conversation_text}
-
-Верни анализ в формате JSON:
-1. "engagement_level": уровень вовлеченности (high, medium, low)
-2. "conversation_quality": качество разговора (good, average, poor)
-3. "user_satisfaction": удовлетворенность пользователя (high, medium, low)
-4. "experiment_progress": прогресс эксперимента (on_track, struggling, off_track)
-5. "recommendations": рекомендации для бота (массив строк)
-"""
+            request_messages = [
+                {"role": "system", "content": f"{Config.LLM_SYSTEM_PROMPT}\n\n{FLOW_INSTRUCTIONS}"},
+                {"role": "user", "content": conversation_text}
+            ]
             
-            response = self._call_cloud_ru_api(prompt)
+            response = await self._call_llm(request_messages, purpose='flow')
             
             if response:
                 return self._parse_analysis_response(response)
@@ -256,7 +495,8 @@ class LLMAnalyzer:
             logger.error(f"Ошибка при анализе потока разговора: {e}")
             return {"flow_analysis": "error", "error": str(e)}
     
-    def generate_personalized_response(self, user_message: str, analysis: Dict, context: Dict, conversation_history: List[Dict] = None) -> str:
+    @traced()
+    async def generate_personalized_response(self, user_message: str, analysis: Dict, context: Dict, conversation_history: List[Dict] = None) -> str:
         """
         Генерирует персонализированный ответ на основе анализа и истории разговора
         
@@ -270,56 +510,11 @@ class LLMAnalyzer:
             Персонализированный ответ
         """
         try:
-            if not self.api_key:
+            if not self.has_backend('response'):
                 return self._get_default_response(analysis, context)
             
-            # Формируем историю разговора для контекста
-            history_text = ""
-            if conversation_history and len(conversation_history) > 1:
-                history_text = "\n\nИстория разговора:\n"
-                for msg in conversation_history[-6:]:  # Последние 6 сообщений
-                    sender = "Пользователь" if msg['sender'] == 'user' else "Бот"
-                    history_text += f"{sender}: {msg['text']}\n"
-            
-            # Определяем системный промпт в зависимости от группы
-            system_prompt = self._get_system_prompt(context.get('group', 'confess'), context.get('language', 'ru'))
-            
-            prompt = f"""
-{system_prompt}
-
-{history_text}
-
-Текущий анализ сообщения:
-- Эмоция: {analysis.get('emotion', 'neutral')}
-- Намерение: {analysis.get('intent', 'question')}
-- Уверенность: {analysis.get('confidence', 'medium')}
-- Сопротивление убеждению: {analysis.get('persuasion_resistance', 'medium')}
-- Основные темы: {', '.join(analysis.get('key_themes', []))}
-
-Контекст эксперимента:
-- Группа: {context.get('group', 'неизвестно')}
-- Время в эксперименте: {context.get('time_elapsed', 0)} минут
-- Количество сообщений: {context.get('message_count', 1)}
-- Язык: {context.get('language', 'ru')}
-
-Текущее сообщение пользователя: "{user_message}"
-
-Сгенерируй ответ бота, который:
-1. Учитывает всю историю разговора и контекст
-2. Отвечает на конкретные вопросы и замечания пользователя
-3. Развивает диалог естественно и логично
-4. Соответствует стратегии для группы {context.get('group', 'confess')}
-5. Поддерживает интерес к эксперименту
-6. Естественно звучит на {context.get('language', 'ru')} языке
-7. Может быть развернутым (3-5 предложений) для лучшего взаимодействия
-
-Ответ должен быть в формате JSON:
-{{
-    "response": "Ваш развернутый ответ здесь"
-}}
-"""
-            
-            response = self._call_cloud_ru_api(prompt)
+            messages = self._build_response_messages(user_message, analysis, context, conversation_history)
+            response = await self._call_llm(messages, purpose='response')
             
             if response and isinstance(response, str):
                 # Пытаемся извлечь JSON из ответа
@@ -355,6 +550,67 @@ class LLMAnalyzer:
             logger.error(f"Ошибка при генерации персонализированного ответа: {e}")
             return self._get_default_response(analysis, context)
     
+    def _build_response_messages(self, user_message: str, analysis: Dict, context: Dict,
+                                 conversation_history: List[Dict] = None) -> List[Dict]:
+        """
+        Собирает сообщения для генерации ответа
+        
+        Порядок: неизменяемый префикс группы и языка в системном сообщении,
+        затем история как реплики чата, и в конце переменные поля анализа
+        и текущее сообщение. Так начало запроса совпадает между ходами.
+        """
+        group = context.get('group', 'confess')
+        language = context.get('language', 'ru')
+        
+        messages = [{"role": "system", "content": self._get_response_prefix(group, language)}]
+        
+        # История без текущего сообщения (оно идет последним вместе с анализом)
+        if conversation_history and len(conversation_history) > 1:
+            for msg in conversation_history[-6:-1]:
+                role = "user" if msg['sender'] == 'user' else "assistant"
+                messages.append({"role": role, "content": msg['text']})
+        
+        messages.append({"role": "user", "content": f"""Текущий анализ сообщения:
+- Эмоция: {analysis.get('emotion', 'neutral')}
+- Намерение: {analysis.get('intent', 'question')}
+- Уверенность: {analysis.get('confidence', 'medium')}
+- Сопротивление убеждению: {analysis.get('persuasion_resistance', 'medium')}
+- Основные темы: {', '.join(analysis.get('key_themes', []))}
+
+Контекст эксперимента:
+- Время в эксперименте: {context.get('time_elapsed', 0)} минут
+- Количество сообщений: {context.get('message_count', 1)}
+
+Текущее сообщение пользователя: "{user_message}\""""})
+        
+        return messages
+    
+    def _get_response_prefix(self, group: str, language: str) -> str:
+        """Возвращает побайтно стабильный системный префикс для пары (группа, язык)"""
+        key = (group, language)
+        prefix = self._response_prefixes.get(key)
+        if prefix is None:
+            prefix = (
+                f"{self._get_system_prompt(group, language)}\n\n"
+                f"Группа участника: {group}. Язык общения: {language}.\n\n"
+                f"{RESPONSE_INSTRUCTIONS.format(group=group, language=language)}"
+            )
+            self._response_prefixes[key] = prefix
+        return prefix
+    
+    def get_metrics(self) -> Dict:
+        """Возвращает метрики работы анализатора"""
+        return {
+            'model': self.model,
+            'routing': {
+                purpose: [f"{backend_name}:{model}" for backend_name, model in chain]
+                for purpose, chain in self.model_routing.items()
+            },
+            'models': {model: stats.get_stats() for model, stats in self.model_stats.items()},
+            'backends': {name: backend.get_stats() for name, backend in self.backends.items() if backend.is_configured()},
+            'prefix_cache': self.prefix_cache.get_stats()
+        }
+    
     def _get_system_prompt(self, group: str, language: str) -> str:
         """
         Возвращает системный промпт в зависимости от группы и языка
@@ -433,6 +689,10 @@ You should:
     
     def log_analysis(self, user_id: int, message: str, analysis: Dict, response: str):
         """Логирует анализ для дальнейшего изучения"""
+        # Анализ целиком сохраняется в базе (llm_analysis), в лог пишется только при отладке
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        
         try:
             log_entry = {
                 "timestamp": datetime.now().isoformat(),
@@ -442,7 +702,7 @@ You should:
                 "generated_response": response
             }
             
-            logger.info(f"LLM Analysis: {json.dumps(log_entry, ensure_ascii=False)}")
+            logger.debug(f"LLM Analysis: {json.dumps(log_entry, ensure_ascii=False)}")
             
         except Exception as e:
             logger.error(f"Ошибка при логировании анализа: {e}")
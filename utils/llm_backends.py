@@ -0,0 +1,345 @@
+"""
+Бэкенды LLM с единым асинхронным интерфейсом
+Поддерживаются cloud.ru, любой OpenAI-совместимый endpoint и локальная модель на CPU
+"""
+
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import httpx
+import requests
+from openai import AsyncOpenAI, APIError, APIConnectionError, APITimeoutError
+
+from config.settings import Config
+
+logger = logging.getLogger(__name__)
+
+CLOUD_RU_BASE_URL = "https://foundation-models.api.cloud.ru/v1"
+
+class LatencyStats:
+    """Статистика вызовов: количество, ошибки и задержка"""
+    
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_latency = 0.0
+    
+    def record(self, latency: float, success: bool):
+        """Учитывает вызов"""
+        self.calls += 1
+        if not success:
+            self.errors += 1
+        self.total_latency += latency
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+    
+    def get_stats(self) -> Dict:
+        """Возвращает статистику"""
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'avg_latency': self.total_latency / self.calls if self.calls else 0.0,
+            'max_latency': self.max_latency,
+            'last_latency': self.last_latency
+        }
+
+class LLMBackend(ABC):
+    """
+    Базовый класс бэкенда LLM
+    
+    Наследники реализуют _chat и _health_check; учет задержки и состояния
+    здоровья выполняется здесь одинаково для всех бэкендов.
+    """
+    
+    name = 'base'
+    
+    def __init__(self):
+        self.stats = LatencyStats()
+        self.healthy: Optional[bool] = None
+        self.last_health_check: Optional[datetime] = None
+    
+    def is_configured(self) -> bool:
+        """Проверяет, заданы ли настройки, необходимые для вызовов"""
+        return True
+    
+    async def chat(self, model: str, messages: List[Dict], max_tokens: int = 500,
+                   temperature: float = 0.3, max_retries: int = 3) -> Optional[Dict]:
+        """
+        Выполняет chat completion
+        
+        Returns:
+            Словарь {"content": str, "usage": dict | None} или None при ошибке
+        """
+        started = time.monotonic()
+        result = None
+        try:
+            result = await self._chat(model, messages, max_tokens, temperature, max_retries)
+            return result
+        except Exception as e:
+            logger.error(f"Ошибка бэкенда {self.name}: {e}")
+            return None
+        finally:
+            self.stats.record(time.monotonic() - started, result is not None)
+    
+    async def health_check(self) -> bool:
+        """Проверяет доступность бэкенда"""
+        try:
+            healthy = self.is_configured() and await self._health_check()
+        except Exception as e:
+            logger.warning(f"Проверка здоровья бэкенда {self.name} не прошла: {e}")
+            healthy = False
+        
+        self.healthy = healthy
+        self.last_health_check = datetime.now()
+        return healthy
+    
+    @abstractmethod
+    async def _chat(self, model: str, messages: List[Dict], max_tokens: int,
+                    temperature: float, max_retries: int) -> Optional[Dict]:
+        """Выполняет запрос к модели; ответ в формате chat completions или None"""
+    
+    @abstractmethod
+    async def _health_check(self) -> bool:
+        """Проверяет доступность бэкенда без учета статистики"""
+    
+    async def close(self):
+        """Освобождает ресурсы бэкенда"""
+    
+    def get_stats(self) -> Dict:
+        """Возвращает статистику и состояние бэкенда"""
+        stats = self.stats.get_stats()
+        stats.update({
+            'configured': self.is_configured(),
+            'healthy': self.healthy,
+            'last_health_check': self.last_health_check.isoformat() if self.last_health_check else None
+        })
+        return stats
+
+class CloudRuBackend(LLMBackend):
+    """Бэкенд cloud.ru Foundation Models"""
+    
+    name = 'cloud_ru'
+    
+    def __init__(self, api_key: str = None, base_url: str = CLOUD_RU_BASE_URL):
+        super().__init__()
+        self.api_key = api_key if api_key is not None else Config.CLOUD_RU_API_KEY
+        self.base_url = base_url
+    
+    def is_configured(self) -> bool:
+        return bool(self.api_key)
+    
+    def _headers(self) -> Dict:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+    
+    async def _chat(self, model: str, messages: List[Dict], max_tokens: int,
+                    temperature: float, max_retries: int) -> Optional[Dict]:
+        """Вызывает API cloud.ru с retry логикой (HTTP запрос выполняется вне event loop)"""
+        retry_delay = 2
+        
+        for attempt in range(max_retries):
+            try:
+                data = {
+                    "model": model,
+                    "messages": messages,
+                    "max_tokens": max_tokens,
+                    "temperature": temperature
+                }
+                
+                response = await asyncio.to_thread(
+                    requests.post,
+                    f"{self.base_url}/chat/completions",
+                    headers=self._headers(),
+                    json=data,
+                    timeout=Config.LLM_REQUEST_TIMEOUT
+                )
+                
+                if response.status_code == 200:
+                    result = response.json()
+                    return {
+                        "content": result.get("choices", [{}])[0].get("message", {}).get("content"),
+                        "usage": result.get("usage")
+                    }
+                elif response.status_code in [503, 502, 504]:  # Временные ошибки сервера
+                    if attempt < max_retries - 1:
+                        logger.warning(f"Временная ошибка API cloud.ru: {response.status_code}, повтор через {retry_delay}с (попытка {attempt + 1}/{max_retries})")
+                        await asyncio.sleep(retry_delay)
+                        retry_delay *= 2  # Экспоненциальная задержка
+                        continue
+                    else:
+                        logger.error(f"API cloud.ru недоступен после {max_retries} попыток: {response.status_code} - {response.text}")
+                        return None
+                else:
+                    logger.error(f"Ошибка API cloud.ru: {response.status_code} - {response.text}")
+                    return None
+            
+            except requests.exceptions.Timeout:
+                if attempt < max_retries - 1:
+                    logger.warning(f"Таймаут API cloud.ru, повтор через {retry_delay}с (попытка {attempt + 1}/{max_retries})")
+                    await asyncio.sleep(retry_delay)
+                    retry_delay *= 2
+                    continue
+                else:
+                    logger.error("API cloud.ru недоступен: таймаут")
+                    return None
+            except Exception as e:
+                logger.error(f"Ошибка при вызове cloud.ru API: {e}")
+                return None
+        
+        return None
+    
+    async def _health_check(self) -> bool:
+        response = await asyncio.to_thread(
+            requests.get,
+            f"{self.base_url}/models",
+            headers=self._headers(),
+            timeout=10
+        )
+        return response.status_code == 200
+
+class OpenAICompatibleBackend(LLMBackend):
+    """Бэкенд для любого OpenAI-совместимого endpoint (vLLM, llama.cpp server, Ollama и т.п.)"""
+    
+    name = 'openai'
+    
+    def __init__(self, base_url: str = None, api_key: str = None):
+        super().__init__()
+        self.base_url = base_url if base_url is not None else Config.OPENAI_COMPATIBLE_BASE_URL
+        self.api_key = api_key if api_key is not None else Config.OPENAI_COMPATIBLE_API_KEY
+        self._client: Optional[AsyncOpenAI] = None
+    
+    def is_configured(self) -> bool:
+        return bool(self.base_url)
+    
+    def _get_client(self) -> AsyncOpenAI:
+        if self._client is None:
+            # Передаем собственный httpx клиент: закрепленная версия openai
+            # не умеет создавать его сама с httpx, который требует telegram
+            self._client = AsyncOpenAI(
+                base_url=self.base_url,
+                api_key=self.api_key or "not-needed",
+                http_client=httpx.AsyncClient(timeout=Config.LLM_REQUEST_TIMEOUT),
+                max_retries=0
+            )
+        return self._client
+    
+    async def _chat(self, model: str, messages: List[Dict], max_tokens: int,
+                    temperature: float, max_retries: int) -> Optional[Dict]:
+        retry_delay = 2
+        
+        for attempt in range(max_retries):
+            try:
+                completion = await self._get_client().chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=temperature
+                )
+                return {
+                    "content": completion.choices[0].message.content if completion.choices else None,
+                    "usage": completion.usage.model_dump() if completion.usage else None
+                }
+            except (APIConnectionError, APITimeoutError) as e:
+                if attempt < max_retries - 1:
+                    logger.warning(f"Ошибка соединения с {self.base_url}: {e}, повтор через {retry_delay}с (попытка {attempt + 1}/{max_retries})")
+                    await asyncio.sleep(retry_delay)
+                    retry_delay *= 2
+                    continue
+                logger.error(f"OpenAI-совместимый endpoint недоступен: {e}")
+                return None
+            except APIError as e:
+                logger.error(f"Ошибка OpenAI-совместимого API: {e}")
+                return None
+        
+        return None
+    
+    async def _health_check(self) -> bool:
+        await self._get_client().models.list()
+        return True
+    
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+class LocalBackend(LLMBackend):
+    """
+    Локальная небольшая модель на CPU через llama-cpp-python (GGUF)
+    
+    Модель загружается при первом вызове. Инференс выполняется в отдельном
+    потоке, так что event loop не блокируется и сетевых запросов нет.
+    Зависимость необязательная: pip install llama-cpp-python
+    """
+    
+    name = 'local'
+    
+    def __init__(self, model_path: str = None, n_threads: int = None, n_ctx: int = None):
+        super().__init__()
+        self.model_path = model_path if model_path is not None else Config.LOCAL_LLM_MODEL_PATH
+        self.n_threads = n_threads or Config.LOCAL_LLM_THREADS
+        self.n_ctx = n_ctx or Config.LOCAL_LLM_CONTEXT_SIZE
+        self._llm = None
+        # Экземпляр модели не потокобезопасен, поэтому один рабочий поток
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='local-llm')
+    
+    def is_configured(self) -> bool:
+        return bool(self.model_path)
+    
+    def _load(self):
+        if self._llm is None:
+            try:
+                from llama_cpp import Llama
+            except ImportError:
+                raise RuntimeError("Для локального бэкенда установите llama-cpp-python")
+            
+            logger.info(f"Загрузка локальной модели {self.model_path}")
+            self._llm = Llama(
+                model_path=self.model_path,
+                n_threads=self.n_threads,
+                n_ctx=self.n_ctx,
+                verbose=False
+            )
+        return self._llm
+    
+    def _complete(self, messages: List[Dict], max_tokens: int, temperature: float) -> Dict:
+        result = self._load().create_chat_completion(
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature
+        )
+        return {
+            "content": result["choices"][0]["message"]["content"],
+            "usage": result.get("usage")
+        }
+    
+    async def _chat(self, model: str, messages: List[Dict], max_tokens: int,
+                    temperature: float, max_retries: int) -> Optional[Dict]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._complete, messages, max_tokens, temperature)
+    
+    async def _health_check(self) -> bool:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._load)
+        return True
+    
+    async def close(self):
+        self._executor.shutdown(wait=False)
+
+BACKEND_CLASSES = {
+    CloudRuBackend.name: CloudRuBackend,
+    OpenAICompatibleBackend.name: OpenAICompatibleBackend,
+    LocalBackend.name: LocalBackend
+}
+
+def create_backends() -> Dict[str, LLMBackend]:
+    """Создает все известные бэкенды; ненастроенные пропускаются при маршрутизации"""
+    return {name: backend_class() for name, backend_class in BACKEND_CLASSES.items()}
@@ -0,0 +1,100 @@
+"""
+Микро-батчинг запросов анализа сообщений к LLM
+Собирает запросы разных участников за короткое окно и отправляет одним вызовом
+"""
+
+import asyncio
+import contextvars
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from config.settings import Config
+from utils.tracing import traced
+
+logger = logging.getLogger(__name__)
+
+class AnalysisBatcher:
+    """Собирает вызовы analyze_message в пакеты с ограничением размера и ожидания"""
+    
+    def __init__(self, llm_analyzer, max_batch_size: int = None, max_wait_ms: int = None):
+        """
+        Args:
+            llm_analyzer: Экземпляр LLMAnalyzer
+            max_batch_size: Максимальное количество сообщений в пакете
+            max_wait_ms: Максимальное время ожидания первого сообщения пакета
+        """
+        self.llm_analyzer = llm_analyzer
+        self.max_batch_size = max(1, max_batch_size or Config.LLM_BATCH_MAX_SIZE)
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else Config.LLM_BATCH_MAX_WAIT_MS) / 1000
+        
+        self._pending: List[Tuple[str, Dict, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        
+        # Статистика
+        self.batches = 0
+        self.items = 0
+        self.max_seen_batch = 0
+    
+    @traced()
+    async def analyze(self, message: str, context: Dict = None) -> Dict:
+        """Ставит сообщение в текущий пакет и ждет его результат"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((message, context, future))
+        
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush)
+        
+        return await future
+    
+    def _flush(self):
+        """Отправляет накопленный пакет на анализ"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        
+        if not self._pending:
+            return
+        
+        batch, self._pending = self._pending, []
+        # Пакет общий для нескольких обновлений: пустой контекст, чтобы его вызовы LLM
+        # не попадали в трассу и замеры того обновления, которое первым открыло пакет
+        task = asyncio.get_running_loop().create_task(self._run_batch(batch), context=contextvars.Context())
+        # Держим ссылку на задачу, чтобы ее не собрал сборщик мусора
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _run_batch(self, batch: List[Tuple[str, Dict, asyncio.Future]]):
+        """Выполняет анализ пакета и раздает результаты ожидающим корутинам"""
+        self.batches += 1
+        self.items += len(batch)
+        self.max_seen_batch = max(self.max_seen_batch, len(batch))
+        
+        try:
+            if len(batch) == 1:
+                message, context, _ = batch[0]
+                results = [await self.llm_analyzer.analyze_message(message, context)]
+            else:
+                items = [(message, context) for message, context, _ in batch]
+                results = await self.llm_analyzer.analyze_messages_batch(items)
+                logger.info(f"Пакетный анализ: {len(batch)} сообщений одним запросом")
+        except Exception as e:
+            logger.error(f"Ошибка при пакетном анализе: {e}")
+            results = [self.llm_analyzer._basic_analysis(message) for message, _, _ in batch]
+        
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+    
+    def get_stats(self) -> Dict:
+        """Возвращает статистику батчинга"""
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'avg_batch_size': self.items / self.batches if self.batches else 0.0,
+            'max_batch_size': self.max_seen_batch,
+            'pending': len(self._pending)
+        }
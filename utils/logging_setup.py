@@ -0,0 +1,200 @@
+"""
+Настройка логирования бота
+Записи ставятся в очередь (QueueHandler), а в файл и консоль их пишет
+фоновый поток QueueListener, поэтому event loop не ждет диск. Файл
+ротируется по размеру или по времени, старые файлы сжимаются gzip.
+Поддерживаются JSON формат, уровни по модулям и ограничение частоты
+записей на горячих путях.
+"""
+
+import atexit
+import copy
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import shutil
+import threading
+import time
+from datetime import datetime
+from typing import Dict
+
+from utils.tracing import current_trace_id
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, подготавливающий запись в потоке вызова
+    
+    Здесь же, пока доступен контекст обновления, в запись добавляется trace_id.
+    Трейсбек сохраняется в exc_text отдельно от сообщения, чтобы JSON формат
+    мог вынести его в свое поле.
+    """
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = _EXCEPTION_FORMATTER.formatException(record.exc_info)
+        record.exc_info = None
+        record.trace_id = current_trace_id()
+        return record
+
+_EXCEPTION_FORMATTER = logging.Formatter()
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        trace_id = getattr(record, 'trace_id', None)
+        if trace_id:
+            entry['trace_id'] = trace_id
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def _gzip_namer(name: str) -> str:
+    return name + '.gz'
+
+def _gzip_rotator(source: str, dest: str):
+    """Сжимает ротированный файл (выполняется в потоке QueueListener)"""
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+def _file_handler(log_file: str, rotation: str, max_bytes: int, backup_count: int,
+                  when: str, compress: bool) -> logging.Handler:
+    directory = os.path.dirname(log_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    
+    if rotation == 'time':
+        handler = logging.handlers.TimedRotatingFileHandler(
+            log_file, when=when, backupCount=backup_count, encoding='utf-8'
+        )
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+        )
+    
+    if compress:
+        handler.namer = _gzip_namer
+        handler.rotator = _gzip_rotator
+    return handler
+
+def parse_module_levels(value: str) -> Dict[str, int]:
+    """Разбирает строку вида 'httpx=WARNING,utils.database=DEBUG'"""
+    levels = {}
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        name, _, level = item.partition('=')
+        if not level or not hasattr(logging, level.strip().upper()):
+            raise ValueError(f"Неверный уровень логирования модуля: {item}")
+        levels[name.strip()] = getattr(logging, level.strip().upper())
+    return levels
+
+def setup_logging(level: str = 'INFO', log_file: str = 'logs/bot.log', json_format: bool = False,
+                  module_levels: str = '', rotation: str = 'size', max_bytes: int = 10 * 1024 * 1024,
+                  backup_count: int = 10, when: str = 'midnight',
+                  compress: bool = True) -> logging.handlers.QueueListener:
+    """
+    Настраивает корневой логгер: очередь в потоке вызова, запись в фоновом потоке
+    
+    Args:
+        level: Уровень корневого логгера
+        log_file: Файл лога
+        json_format: JSON вместо текстового формата
+        module_levels: Уровни отдельных модулей, 'имя=УРОВЕНЬ,...'
+        rotation: 'size' (по max_bytes) или 'time' (по when)
+        backup_count: Сколько ротированных файлов хранить
+        compress: Сжимать ротированные файлы gzip
+    
+    Returns:
+        Запущенный QueueListener (останавливается автоматически при выходе)
+    """
+    formatter = JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT)
+    handlers = [
+        _file_handler(log_file, rotation, max_bytes, backup_count, when, compress),
+        logging.StreamHandler()
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = ContextQueueHandler(log_queue)
+    
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(getattr(logging, level.upper()))
+    
+    for name, module_level in parse_module_levels(module_levels).items():
+        logging.getLogger(name).setLevel(module_level)
+    
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Дописываем очередь при завершении процесса
+    atexit.register(listener.stop)
+    return listener
+
+class RateLimitedLog:
+    """
+    Не больше одной записи на ключ за interval секунд
+    
+    Пропущенные записи считаются, и их число добавляется к следующей
+    записи с тем же ключом, попавшей в лог.
+    """
+    
+    def __init__(self, logger: logging.Logger, interval: float = 60.0):
+        self.logger = logger
+        self.interval = interval
+        self._last: Dict[str, float] = {}
+        self._suppressed: Dict[str, int] = {}
+        self._lock = threading.Lock()
+    
+    def log(self, level: int, key: str, message: str) -> bool:
+        """Пишет запись, если для ключа не было записей за interval; возвращает, записана ли она"""
+        if not self.logger.isEnabledFor(level):
+            return False
+        
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last.get(key, float('-inf')) < self.interval:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return False
+            self._last[key] = now
+            suppressed = self._suppressed.pop(key, 0)
+        
+        if suppressed:
+            message += f" (еще {suppressed} таких записей пропущено за {self.interval:.0f}с)"
+        self.logger.log(level, message)
+        return True
+
+class SampledLog:
+    """Пишет в лог только долю rate записей (для частых однотипных событий)"""
+    
+    def __init__(self, logger: logging.Logger, rate: float = 0.01):
+        self.logger = logger
+        self.rate = rate
+    
+    def log(self, level: int, message: str, *args) -> bool:
+        """Сообщение форматируется только для попавших в выборку записей"""
+        if self.rate < 1.0 and random.random() >= self.rate:
+            return False
+        if not self.logger.isEnabledFor(level):
+            return False
+        self.logger.log(level, message, *args)
+        return True
@@ -0,0 +1,270 @@
+"""
+Наблюдение за задержкой event loop
+Фоновая корутина постоянно измеряет, насколько позже запланированного
+просыпается loop, и ведет гистограмму задержек. Сторожевой поток замечает,
+что loop не проснулся вовремя, и снимает стек потока бота, пока блокирующий
+вызов еще выполняется, поэтому в логе видно, какой код задержал loop.
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from utils.logging_setup import RateLimitedLog
+
+logger = logging.getLogger(__name__)
+# Под нагрузкой одно и то же место блокирует loop на каждом обновлении:
+# стек для него пишется не чаще раза в 30 секунд
+blocking_log = RateLimitedLog(logger, interval=30)
+
+# Верхние границы корзин гистограммы задержки, сек
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+
+class LagHistogram:
+    """Гистограмма задержек с накопительными счетчиками по корзинам"""
+    
+    def __init__(self, buckets=LAG_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+    
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+    
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+    
+    def cumulative(self) -> List:
+        """[(граница, число измерений не больше нее)]"""
+        result = []
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            result.append((bound, seen))
+        return result
+
+def _handler_context(frame) -> Dict:
+    """
+    Ищет в стеке обертку HandlerTimings.wrap и берет из нее имя обработчика и пользователя
+    
+    Пока корутина выполняется, фреймы ожидающих ее корутин связаны через f_back,
+    поэтому обертка обработчика видна в стеке заблокировавшего loop кода.
+    """
+    while frame is not None:
+        code = frame.f_code
+        if frame.f_globals.get('__name__') == 'utils.profiling' and 'handler_name' in code.co_varnames:
+            local_vars = frame.f_locals
+            update = local_vars.get('update')
+            user = getattr(update, 'effective_user', None)
+            return {'handler': local_vars.get('handler_name'), 'user_id': getattr(user, 'id', None)}
+        frame = frame.f_back
+    return {'handler': None, 'user_id': None}
+
+class LoopMonitor:
+    """Измеряет задержку event loop и ловит блокирующие вызовы"""
+    
+    STACK_LIMIT = 25  # сколько последних фреймов сохранять
+    STUCK_SECONDS = 10.0  # после скольких секунд блокировки писать в лог, не дожидаясь ее конца
+    
+    def __init__(self, interval: float = 0.1, threshold: float = 0.1, max_events: int = 20):
+        """
+        Args:
+            interval: Период измерения задержки, сек
+            threshold: Задержка, начиная с которой вызов считается блокирующим, сек
+            max_events: Сколько последних блокировок хранить для админки
+        """
+        self.interval = interval
+        self.threshold = threshold
+        
+        self.histogram = LagHistogram()
+        self.blocking_events = deque(maxlen=max_events)
+        self.blocking_count = 0
+        self.started_at: Optional[datetime] = None
+        
+        self._window_max = 0.0
+        self._deadline = 0.0
+        # Снятый стек помечается сроком, для которого он снят: стек прошлой
+        # итерации (или самого heartbeat) не попадет в следующую блокировку
+        self._captured: Optional[Dict] = None
+        self._stuck_deadline: Optional[float] = None
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+    
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+    
+    def start(self):
+        """Запускает измерение и сторожевой поток (нужен работающий event loop)"""
+        if self.running:
+            return
+        self._loop_thread = threading.get_ident()
+        self._deadline = time.monotonic() + self.interval
+        self.started_at = datetime.now()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+        logger.info(f"Мониторинг event loop запущен, порог блокировки {self.threshold * 1000:.0f} мс")
+    
+    async def stop(self):
+        """Останавливает измерение и сторожевой поток"""
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._watchdog:
+            await asyncio.to_thread(self._watchdog.join)
+            self._watchdog = None
+    
+    async def _heartbeat(self):
+        """Засыпает на interval и измеряет, насколько позже срока проснулся"""
+        while True:
+            deadline = time.monotonic() + self.interval
+            self._deadline = deadline
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - deadline)
+            
+            self.histogram.observe(lag)
+            self._window_max = max(self._window_max, lag)
+            if lag >= self.threshold:
+                self._report_blocking(lag, deadline)
+    
+    def _watch(self):
+        """Сторожевой поток: снимает стек, пока loop заблокирован"""
+        period = min(self.threshold, self.interval) / 2
+        while not self._stop.wait(period):
+            deadline = self._deadline
+            overdue = time.monotonic() - deadline
+            if overdue < self.threshold:
+                continue
+            if self._captured is None or self._captured['deadline'] != deadline:
+                captured = self._capture_stack()
+                if captured is not None:
+                    captured['deadline'] = deadline
+                self._captured = captured
+            if overdue >= self.STUCK_SECONDS and self._stuck_deadline != deadline:
+                self._stuck_deadline = deadline
+                captured = self._captured or {}
+                logger.error(
+                    f"Event loop заблокирован уже {overdue:.1f}с "
+                    f"(обработчик {captured.get('handler')}, пользователь {captured.get('user_id')}):\n"
+                    + "".join(captured.get('stack') or [])
+                )
+    
+    def _capture_stack(self) -> Optional[Dict]:
+        """Снимает стек потока event loop с контекстом обработчика"""
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return None
+        context = _handler_context(frame)
+        context['stack'] = traceback.format_stack(frame, limit=self.STACK_LIMIT)
+        return context
+    
+    def _report_blocking(self, lag: float, deadline: float):
+        """Записывает блокировку в журнал и в список последних блокировок"""
+        self.blocking_count += 1
+        captured = self._captured
+        if captured is None or captured['deadline'] != deadline:
+            captured = {'handler': None, 'user_id': None, 'stack': None}
+        event = {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'duration': lag,
+            'handler': captured['handler'],
+            'user_id': captured['user_id'],
+            'stack': captured['stack']
+        }
+        self.blocking_events.append(event)
+        
+        if captured['stack']:
+            blocking_log.log(
+                logging.WARNING, captured['stack'][-1],
+                f"Event loop заблокирован на {lag * 1000:.0f} мс "
+                f"(обработчик {event['handler']}, пользователь {event['user_id']}):\n"
+                + "".join(captured['stack'])
+            )
+        else:
+            # Блокировка закончилась раньше, чем сторожевой поток успел снять стек
+            blocking_log.log(logging.WARNING, 'no_stack', f"Event loop заблокирован на {lag * 1000:.0f} мс, стек не снят")
+    
+    def take_window_max(self) -> float:
+        """Максимальная задержка с предыдущего вызова (окно контроллера деградации)"""
+        value, self._window_max = self._window_max, 0.0
+        return value
+    
+    def get_stats(self) -> Dict:
+        """Возвращает гистограмму задержки и последние блокировки"""
+        histogram = self.histogram
+        return {
+            'running': self.running,
+            'since': self.started_at.isoformat(timespec='seconds') if self.started_at else None,
+            'interval': self.interval,
+            'threshold': self.threshold,
+            'samples': histogram.count,
+            'avg_lag': histogram.sum / histogram.count if histogram.count else 0.0,
+            'p50_lag': histogram.quantile(0.5),
+            'p99_lag': histogram.quantile(0.99),
+            'max_lag': histogram.max,
+            'buckets': histogram.cumulative(),
+            'blocking_count': self.blocking_count,
+            'recent_blocking': list(self.blocking_events)
+        }
+    
+    def format_summary(self, events: int = 5) -> str:
+        """Текст для админа: гистограмма задержки и последние блокировки"""
+        stats = self.get_stats()
+        if not stats['samples']:
+            return "Мониторинг event loop еще не собрал измерений."
+        
+        lines = [
+            f"🫀 Задержка event loop с {stats['since'][:19]} ({stats['samples']} измерений)",
+            f"среднее {stats['avg_lag'] * 1000:.1f} мс, p50 ≤ {stats['p50_lag'] * 1000:.0f} мс, "
+            f"p99 ≤ {stats['p99_lag'] * 1000:.0f} мс, макс. {stats['max_lag'] * 1000:.0f} мс",
+            "",
+            "Гистограмма (накопительно):"
+        ]
+        previous = 0
+        for bound, seen in stats['buckets']:
+            if seen == previous and bound != float('inf'):
+                continue
+            label = f"≤ {bound * 1000:.0f} мс" if bound != float('inf') else "всего"
+            lines.append(f"• {label}: {seen}")
+            previous = seen
+        
+        lines.append(f"\nБлокировок ≥ {stats['threshold'] * 1000:.0f} мс: {stats['blocking_count']}")
+        for event in stats['recent_blocking'][-events:]:
+            where = event['stack'][-1].strip().splitlines()[0] if event['stack'] else "стек не снят"
+            lines.append(
+                f"• {event['timestamp']} {event['duration'] * 1000:.0f} мс, "
+                f"{event['handler'] or 'вне обработчика'}: {where}"
+            )
+        return "\n".join(lines)
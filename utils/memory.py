@@ -0,0 +1,256 @@
+"""
+Контроль памяти долго работающего бота
+Размеры структур в памяти (сессии, истории разговоров, опросы), задачи
+JobQueue и снимки выделений tracemalloc, сравнение которых между двумя
+моментами показывает, какие строки кода накапливают память.
+"""
+
+import gc
+import logging
+import re
+import sys
+import tracemalloc
+from collections import Counter, deque
+from datetime import datetime
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Сколько объектов обходить при оценке глубокого размера структуры
+DEEP_SIZE_LIMIT = 200000
+
+def deep_sizeof(obj, limit: int = DEEP_SIZE_LIMIT) -> int:
+    """
+    Оценка размера объекта вместе с вложенными контейнерами, байт
+    
+    Обходятся встроенные контейнеры и объекты со __slots__ (сессии, реплики);
+    атрибуты обычных объектов могут ссылаться на все приложение. Общие объекты
+    считаются один раз; после limit объектов обход прекращается.
+    """
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack and len(seen) < limit:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        total += sys.getsizeof(current)
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset, deque)):
+            stack.extend(current)
+        slots = getattr(type(current), '__slots__', None)
+        if slots and not isinstance(current, type):
+            stack.extend(getattr(current, name) for name in slots if hasattr(current, name))
+    return total
+
+def process_rss() -> Optional[int]:
+    """Текущий RSS процесса, байт (Linux), иначе None"""
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _job_group(name: str) -> str:
+    """Имя задачи без ID пользователя в конце: _update_time_counter_123 -> _update_time_counter"""
+    return re.sub(r'_\d+$', '', name or 'unnamed')
+
+class MemoryInspector:
+    """Размеры структур бота и снимки выделений памяти"""
+    
+    TOP_LINES = 10
+    
+    def __init__(self, frames: int = 1):
+        """
+        Args:
+            frames: Глубина стека tracemalloc; 1 - группировка по строке выделения
+        """
+        self.frames = frames
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        self.snapshot_at: Optional[datetime] = None
+        self.snapshot_rss: Optional[int] = None
+    
+    @staticmethod
+    def structure_sizes(structures: Dict[str, dict]) -> Dict[str, Dict]:
+        """
+        Размеры словарей по пользователям
+        
+        Returns:
+            {имя: {'entries', 'items', 'bytes'}}, где items - суммарная длина
+            значений-списков (например, сообщений в историях)
+        """
+        result = {}
+        for name, structure in structures.items():
+            if structure is None:
+                continue
+            values = list(structure.values())
+            result[name] = {
+                'entries': len(values),
+                'items': sum(len(value) for value in values if isinstance(value, (list, tuple, deque))),
+                'bytes': deep_sizeof(structure)
+            }
+        return result
+    
+    @staticmethod
+    def job_counts(job_queue, active_users=None) -> Dict:
+        """
+        Задачи JobQueue по типам
+        
+        Args:
+            active_users: ID пользователей с активной сессией; задачи с user_id
+                вне этого множества считаются осиротевшими
+        """
+        if job_queue is None:
+            return {'total': 0, 'groups': {}, 'orphaned': 0}
+        
+        jobs = job_queue.jobs()
+        groups = Counter(_job_group(job.name) for job in jobs)
+        orphaned = 0
+        if active_users is not None:
+            for job in jobs:
+                data = job.data if isinstance(job.data, dict) else {}
+                if 'user_id' in data and data['user_id'] not in active_users:
+                    orphaned += 1
+        return {'total': len(jobs), 'groups': dict(groups.most_common()), 'orphaned': orphaned}
+    
+    @staticmethod
+    def stale_sessions(active_sessions: Dict, now: datetime = None) -> int:
+        """Сессии, время обсуждения которых истекло, но которые остались в памяти"""
+        now = (now or datetime.now()).timestamp()
+        stale = 0
+        for session in list(active_sessions.values()):
+            end_time = session.get('end_time')
+            # ExperimentSession хранит время числом, словари базового обработчика - datetime
+            if isinstance(end_time, datetime):
+                end_time = end_time.timestamp()
+            if isinstance(end_time, (int, float)) and end_time < now:
+                stale += 1
+        return stale
+    
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+    
+    def take_snapshot(self) -> Dict:
+        """
+        Снимает снимок выделений (блокирующий вызов, выполнять в потоке)
+        
+        Если tracemalloc еще не запущен, он запускается, и снимок учитывает
+        только выделения после этого момента.
+        """
+        started_now = not tracemalloc.is_tracing()
+        if started_now:
+            tracemalloc.start(self.frames)
+            logger.info(f"tracemalloc запущен, глубина стека {self.frames}")
+        
+        gc.collect()
+        self.snapshot = self._filtered(tracemalloc.take_snapshot())
+        self.snapshot_at = datetime.now()
+        self.snapshot_rss = process_rss()
+        traced, peak = tracemalloc.get_traced_memory()
+        return {'started_now': started_now, 'traced': traced, 'peak': peak, 'at': self.snapshot_at}
+    
+    def diff(self) -> Dict:
+        """
+        Сравнивает текущие выделения с сохраненным снимком (блокирующий вызов)
+        
+        Returns:
+            {'since', 'seconds', 'rss_before', 'rss_after', 'size_diff', 'count_diff', 'top': [...]}
+        """
+        if self.snapshot is None or not tracemalloc.is_tracing():
+            raise RuntimeError("Нет сохраненного снимка памяти")
+        
+        gc.collect()
+        current = self._filtered(tracemalloc.take_snapshot())
+        stats = current.compare_to(self.snapshot, 'lineno')
+        now = datetime.now()
+        return {
+            'since': self.snapshot_at,
+            'seconds': (now - self.snapshot_at).total_seconds(),
+            'rss_before': self.snapshot_rss,
+            'rss_after': process_rss(),
+            'size_diff': sum(stat.size_diff for stat in stats),
+            'count_diff': sum(stat.count_diff for stat in stats),
+            'top': [
+                {
+                    'location': self._location(stat.traceback),
+                    'size_diff': stat.size_diff,
+                    'size': stat.size,
+                    'count_diff': stat.count_diff
+                }
+                for stat in stats[:self.TOP_LINES]
+                if stat.size_diff
+            ]
+        }
+    
+    def stop(self):
+        """Останавливает tracemalloc (он замедляет выделения памяти) и забывает снимок"""
+        tracemalloc.stop()
+        self.snapshot = None
+        self.snapshot_at = None
+        self.snapshot_rss = None
+    
+    @staticmethod
+    def _filtered(snapshot: tracemalloc.Snapshot) -> tracemalloc.Snapshot:
+        return snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+            tracemalloc.Filter(False, '<unknown>')
+        ))
+    
+    @staticmethod
+    def _location(traceback: tracemalloc.Traceback) -> str:
+        frame = traceback[0]
+        parts = frame.filename.replace('\\', '/').split('/')
+        return f"{'/'.join(parts[-2:])}:{frame.lineno}"
+
+def format_bytes(size: Optional[int]) -> str:
+    """Размер в удобных единицах, со знаком для разниц"""
+    if size is None:
+        return "н/д"
+    sign = '-' if size < 0 else ''
+    value = abs(size)
+    for unit in ('Б', 'КБ', 'МБ'):
+        if value < 1024:
+            return f"{sign}{value:.0f} {unit}" if unit == 'Б' else f"{sign}{value:.1f} {unit}"
+        value /= 1024
+    return f"{sign}{value:.2f} ГБ"
+
+def format_diff(diff: Dict) -> str:
+    """Текст сравнения снимков для админа"""
+    lines = [
+        f"📈 Изменение памяти за {diff['seconds'] / 60:.1f} мин (с {diff['since'].strftime('%H:%M:%S')})",
+        f"RSS: {format_bytes(diff['rss_before'])} → {format_bytes(diff['rss_after'])}",
+        f"Выделения Python: {format_bytes(diff['size_diff'])}, объектов {diff['count_diff']:+d}"
+    ]
+    if diff['top']:
+        lines.append("\nСтроки с наибольшим ростом:")
+        for stat in diff['top']:
+            lines.append(
+                f"• {stat['location']}: {format_bytes(stat['size_diff'])} "
+                f"(всего {format_bytes(stat['size'])}, объектов {stat['count_diff']:+d})"
+            )
+    return "\n".join(lines)
+
+def format_structures(sizes: Dict[str, Dict], jobs: Dict, stale: int, rss: Optional[int]) -> str:
+    """Текст размеров структур и задач для админа"""
+    lines = [f"🧠 Память процесса (RSS): {format_bytes(rss)}", "", "Структуры:"]
+    for name, size in sizes.items():
+        items = f", элементов {size['items']}" if size['items'] else ""
+        lines.append(f"• {name}: записей {size['entries']}{items}, ~{format_bytes(size['bytes'])}")
+    if stale:
+        lines.append(f"⚠️ Сессий с истекшим временем в памяти: {stale}")
+    
+    lines.append(f"\nЗадачи JobQueue: {jobs['total']}")
+    for group, count in jobs['groups'].items():
+        lines.append(f"• {group}: {count}")
+    if jobs['orphaned']:
+        lines.append(f"⚠️ Задач пользователей без активной сессии: {jobs['orphaned']}")
+    return "\n".join(lines)
@@ -0,0 +1,237 @@
+"""
+Метрики бота в формате Prometheus
+Счетчики и гистограммы обновляются в местах, где происходят события
+(обработчики, LLM, база данных, запросы к Telegram), а состояние бота
+(сессии по фазам, очереди, задержка event loop) читается в момент сбора.
+Метрики отдаются локальным HTTP сервером в отдельном потоке, поэтому
+endpoint работает и в режиме polling, и рядом с webhook сервером.
+"""
+
+import functools
+import inspect
+import json
+import logging
+import time
+from typing import Callable, Optional
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# Границы для длительных операций: LLM вызовы и обработчики с ними
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 60.0, float('inf'))
+# Границы для быстрых операций: запись в SQLite
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, float('inf'))
+
+HANDLER_UPDATES = Counter(
+    'bot_updates_total', 'Обработанные обновления по обработчикам', ['handler']
+)
+HANDLER_ERRORS = Counter(
+    'bot_handler_errors_total', 'Необработанные исключения в обработчиках', ['handler']
+)
+HANDLER_DURATION = Histogram(
+    'bot_handler_duration_seconds', 'Время обработки обновления', ['handler'], buckets=SLOW_BUCKETS
+)
+HANDLER_STAGE_SECONDS = Counter(
+    'bot_handler_stage_seconds_total', 'Суммарное время обработчиков по стадиям', ['handler', 'stage']
+)
+
+LLM_REQUESTS = Counter(
+    'bot_llm_requests_total', 'Вызовы моделей по результату', ['model', 'purpose', 'outcome']
+)
+LLM_LATENCY = Histogram(
+    'bot_llm_request_duration_seconds', 'Задержка вызова модели', ['model', 'purpose'], buckets=SLOW_BUCKETS
+)
+
+DB_WRITE_LATENCY = Histogram(
+    'bot_db_write_duration_seconds', 'Время записи в базу данных', ['method'], buckets=FAST_BUCKETS
+)
+DB_WRITES_IN_PROGRESS = Gauge(
+    'bot_db_writes_in_progress', 'Записи в базу, выполняющиеся или ожидающие блокировки SQLite'
+)
+
+TELEGRAM_REQUESTS = Counter(
+    'bot_telegram_requests_total', 'Запросы к Bot API по методу и HTTP коду', ['method', 'status']
+)
+TELEGRAM_LATENCY = Histogram(
+    'bot_telegram_request_duration_seconds', 'Время запроса к Bot API', ['method'], buckets=SLOW_BUCKETS
+)
+TELEGRAM_ERRORS = Counter(
+    'bot_telegram_errors_total', 'Неуспешные запросы к Bot API', ['method', 'reason']
+)
+TELEGRAM_FLOOD_WAITS = Counter(
+    'bot_telegram_flood_waits_total', 'Ответы 429 (flood wait) от Bot API', ['method']
+)
+TELEGRAM_FLOOD_WAIT_SECONDS = Counter(
+    'bot_telegram_flood_wait_seconds_total', 'Суммарное время ожидания, запрошенное Bot API (retry_after)'
+)
+
+SURVEY_COMPLETIONS = Counter(
+    'bot_survey_completions_total', 'Завершенные опросы', ['language']
+)
+
+# Префиксы методов DatabaseManager, которые пишут в базу
+DB_WRITE_PREFIXES = ('create_', 'update_', 'save_', 'log_', 'init_')
+
+def observe_handler(name: str, total: float, stages: dict, failed: bool = False):
+    """Учитывает одно обновление обработчика (вызывается из HandlerTimings)"""
+    HANDLER_UPDATES.labels(name).inc()
+    HANDLER_DURATION.labels(name).observe(total)
+    if failed:
+        HANDLER_ERRORS.labels(name).inc()
+    for stage_name, elapsed in stages.items():
+        HANDLER_STAGE_SECONDS.labels(name, stage_name).inc(elapsed)
+
+def observe_llm_call(model: str, purpose: str, latency: float, success: bool):
+    """Учитывает одну попытку вызова модели"""
+    LLM_REQUESTS.labels(model, purpose, 'success' if success else 'error').inc()
+    LLM_LATENCY.labels(model, purpose).observe(latency)
+
+def telegram_method(url: str) -> str:
+    """Имя метода Bot API из URL запроса (загрузки файлов объединяются в file)"""
+    if '/file/bot' in url:
+        return 'file'
+    return url.rsplit('/', 1)[-1] or 'unknown'
+
+def observe_telegram_response(method: str, status: int, payload: bytes, elapsed: float):
+    """Учитывает ответ Bot API; 429 дополнительно считается как flood wait"""
+    TELEGRAM_REQUESTS.labels(method, str(status)).inc()
+    TELEGRAM_LATENCY.labels(method).observe(elapsed)
+    if status < 400:
+        return
+    
+    TELEGRAM_ERRORS.labels(method, str(status)).inc()
+    if status == 429:
+        TELEGRAM_FLOOD_WAITS.labels(method).inc()
+        try:
+            retry_after = json.loads(payload)['parameters']['retry_after']
+            TELEGRAM_FLOOD_WAIT_SECONDS.inc(float(retry_after))
+        except (ValueError, KeyError, TypeError):
+            pass
+
+def observe_telegram_failure(method: str, error: Exception):
+    """Учитывает запрос, не получивший ответа (таймаут, сетевая ошибка)"""
+    TELEGRAM_ERRORS.labels(method, type(error).__name__).inc()
+
+def _timed_write(func: Callable) -> Callable:
+    method = func.__name__
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            DB_WRITES_IN_PROGRESS.inc()
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                DB_WRITE_LATENCY.labels(method).observe(time.perf_counter() - started)
+                DB_WRITES_IN_PROGRESS.dec()
+        return async_wrapper
+    
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        DB_WRITES_IN_PROGRESS.inc()
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_WRITE_LATENCY.labels(method).observe(time.perf_counter() - started)
+            DB_WRITES_IN_PROGRESS.dec()
+    return wrapper
+
+def timed_db_writes(cls):
+    """Декоратор класса: время публичных методов записи (DB_WRITE_PREFIXES) попадает в метрики"""
+    for attr, value in list(vars(cls).items()):
+        if attr.startswith(DB_WRITE_PREFIXES) and inspect.isfunction(value):
+            setattr(cls, attr, _timed_write(value))
+    return cls
+
+def _session_phase(session: dict) -> str:
+    """Фаза сессии: базовый обработчик хранит ее явно, LLM обработчик - по отметкам времени"""
+    if 'current_phase' in session:
+        return session['current_phase']
+    return 'conversation' if 'discussion_start_time' in session else 'briefing'
+
+class BotStateCollector:
+    """Метрики состояния бота, вычисляемые при каждом сборе"""
+    
+    def __init__(self):
+        self.experiment_handler = None
+        self.survey_handler = None
+        self.update_processor = None
+        self.loop_monitor = None
+    
+    def bind(self, experiment_handler=None, survey_handler=None, update_processor=None, loop_monitor=None):
+        """Подключает источники состояния работающего бота"""
+        self.experiment_handler = experiment_handler
+        self.survey_handler = survey_handler
+        self.update_processor = update_processor
+        self.loop_monitor = loop_monitor
+    
+    def describe(self):
+        # Набор метрик зависит от подключенных источников, проверка имен при регистрации не нужна
+        return []
+    
+    def collect(self):
+        # Сбор идет в потоке HTTP сервера: словари копируются целиком, без итерации по живым
+        if self.experiment_handler is not None:
+            sessions = GaugeMetricFamily('bot_active_sessions', 'Активные сессии по фазам', labels=['phase'])
+            phases = {'briefing': 0, 'conversation': 0, 'decision': 0, 'survey': 0}
+            for session in list(getattr(self.experiment_handler, 'active_sessions', {}).values()):
+                phase = _session_phase(session)
+                phases[phase] = phases.get(phase, 0) + 1
+            if self.survey_handler is not None:
+                phases['survey'] += len(self.survey_handler.survey_sessions)
+            for phase, count in phases.items():
+                sessions.add_metric([phase], count)
+            yield sessions
+            
+            llm_analyzer = getattr(self.experiment_handler, 'llm_analyzer', None)
+            if llm_analyzer is not None:
+                yield GaugeMetricFamily('bot_llm_in_flight', 'Выполняющиеся вызовы моделей', value=llm_analyzer.in_flight)
+            batcher = getattr(self.experiment_handler, 'analysis_batcher', None)
+            if batcher is not None:
+                yield GaugeMetricFamily(
+                    'bot_llm_batch_pending', 'Сообщения в очереди батчинга анализа', value=batcher.get_stats()['pending']
+                )
+            degradation = getattr(self.experiment_handler, 'degradation', None)
+            if degradation is not None:
+                yield GaugeMetricFamily(
+                    'bot_service_mode_level', 'Режим обслуживания (0 - полный)', value=degradation.level
+                )
+        
+        if self.update_processor is not None:
+            stats = self.update_processor.get_stats()
+            yield GaugeMetricFamily('bot_updates_running', 'Обновления в обработке', value=stats['running'])
+            yield GaugeMetricFamily('bot_updates_waiting', 'Обновления в очереди', value=stats['waiting'])
+        
+        if self.loop_monitor is not None and self.loop_monitor.histogram.count:
+            histogram = self.loop_monitor.histogram
+            lag = HistogramMetricFamily('bot_event_loop_lag_seconds', 'Задержка event loop')
+            lag.add_metric(
+                [],
+                [('+Inf' if bound == float('inf') else str(bound), seen) for bound, seen in histogram.cumulative()],
+                sum_value=histogram.sum
+            )
+            yield lag
+            yield CounterMetricFamily(
+                'bot_event_loop_blocks', 'Блокировки event loop дольше порога', value=self.loop_monitor.blocking_count
+            )
+
+STATE = BotStateCollector()
+REGISTRY.register(STATE)
+
+def start_metrics_server(port: int, host: str = '127.0.0.1') -> Optional[object]:
+    """
+    Запускает HTTP сервер метрик (/metrics) в фоновом потоке
+    
+    Returns:
+        Сервер (для shutdown) или None, если порт занят
+    """
+    try:
+        server, _ = start_http_server(port, addr=host)
+    except OSError as e:
+        logger.error(f"Не удалось запустить сервер метрик на {host}:{port}: {e}")
+        return None
+    logger.info(f"Метрики Prometheus доступны на http://{host}:{port}/metrics")
+    return server
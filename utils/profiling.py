@@ -0,0 +1,372 @@
+"""
+Профилирование обработчиков бота
+Замер времени по стадиям (валидация, база данных, LLM, Telegram) внутри
+каждого обновления и сэмплирующий профилировщик работающего бота.
+
+Обработчик, обернутый HandlerTimings.wrap, открывает контекст замера;
+код стадий помечается stage()/timed_stage()/timed_methods() и добавляет свое
+время в контекст текущего обновления. Вне обработчиков пометки ничего не делают.
+"""
+
+import functools
+import inspect
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from telegram.request import HTTPXRequest
+
+from utils import metrics
+from utils.tracing import span
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = "logs/profiles"
+
+class _UpdateTimings:
+    """Время стадий одного обновления"""
+    
+    __slots__ = ('stages', 'depth')
+    
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self.depth = 0
+
+_current_timings: ContextVar[Optional[_UpdateTimings]] = ContextVar('handler_timings', default=None)
+
+class stage:
+    """
+    Контекстный менеджер стадии: with stage('db'): ...
+    
+    Учитывается только внешняя стадия, вложенные (например, запись в базу
+    внутри валидации) входят во время внешней и не считаются дважды.
+    """
+    
+    __slots__ = ('name', '_timings', '_started')
+    
+    def __init__(self, name: str):
+        self.name = name
+        self._timings = None
+        self._started = 0.0
+    
+    def __enter__(self):
+        timings = _current_timings.get()
+        if timings is not None and timings.depth == 0:
+            self._timings = timings
+            self._started = time.perf_counter()
+        if timings is not None:
+            timings.depth += 1
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.depth -= 1
+        if self._timings is not None:
+            elapsed = time.perf_counter() - self._started
+            self._timings.stages[self.name] = self._timings.stages.get(self.name, 0.0) + elapsed
+            self._timings = None
+        return False
+
+def timed_stage(name: str) -> Callable:
+    """
+    Декоратор функции или корутины, время выполнения которой относится к стадии name
+    
+    Каждый вызов также записывается в трассу обновления спаном <стадия>.<функция>.
+    """
+    def decorator(func):
+        span_name = f"{name}.{func.__name__}"
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name), span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name), span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def timed_methods(name: str) -> Callable:
+    """Декоратор класса: все публичные методы класса относятся к стадии name"""
+    def decorator(cls):
+        for attr, value in list(vars(cls).items()):
+            if attr.startswith('_'):
+                continue
+            if isinstance(value, staticmethod):
+                setattr(cls, attr, staticmethod(timed_stage(name)(value.__func__)))
+            elif isinstance(value, classmethod):
+                setattr(cls, attr, classmethod(timed_stage(name)(value.__func__)))
+            elif callable(value):
+                setattr(cls, attr, timed_stage(name)(value))
+        return cls
+    return decorator
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, время запросов которого относится к стадии telegram и попадает в метрики"""
+    
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = metrics.telegram_method(url)
+        started = time.perf_counter()
+        try:
+            with stage('telegram'), span(f"telegram.{api_method}") as request_span:
+                status, payload = await super().do_request(url, method, *args, **kwargs)
+                if request_span:
+                    request_span.set(status=status)
+        except Exception as e:
+            metrics.observe_telegram_failure(api_method, e)
+            raise
+        metrics.observe_telegram_response(api_method, status, payload, time.perf_counter() - started)
+        return status, payload
+
+class _StageStats:
+    __slots__ = ('calls', 'total', 'max')
+    
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def record(self, elapsed: float):
+        self.calls += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+class HandlerTimings:
+    """Накопленное время обработчиков и их стадий"""
+    
+    def __init__(self):
+        self.handlers: Dict[str, Dict[str, _StageStats]] = {}
+        self.errors = Counter()
+        self.since = datetime.now()
+    
+    def wrap(self, name: str, callback: Callable, label: Callable = None) -> Callable:
+        """
+        Оборачивает обработчик PTB замером времени
+        
+        Args:
+            name: Имя обработчика в статистике
+            callback: Корутина обработчика (update, context)
+            label: Функция update -> уточнение имени (например, тип callback) или None
+        """
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            handler_name = name
+            if label:
+                suffix = label(update)
+                if suffix:
+                    handler_name = f"{name}:{suffix}"
+            
+            timings = _UpdateTimings()
+            token = _current_timings.set(timings)
+            started = time.perf_counter()
+            failed = False
+            try:
+                return await callback(update, context)
+            except Exception:
+                failed = True
+                self.errors[handler_name] += 1
+                raise
+            finally:
+                _current_timings.reset(token)
+                elapsed = time.perf_counter() - started
+                self.record(handler_name, elapsed, timings.stages)
+                metrics.observe_handler(handler_name, elapsed, timings.stages, failed)
+        return wrapper
+    
+    def record(self, name: str, total: float, stages: Dict[str, float]):
+        """Учитывает одно обновление; время вне помеченных стадий попадает в other"""
+        stats = self.handlers.setdefault(name, {})
+        stats.setdefault('total', _StageStats()).record(total)
+        for stage_name, elapsed in stages.items():
+            stats.setdefault(stage_name, _StageStats()).record(elapsed)
+        stats.setdefault('other', _StageStats()).record(max(0.0, total - sum(stages.values())))
+    
+    def reset(self):
+        self.handlers.clear()
+        self.errors.clear()
+        self.since = datetime.now()
+    
+    def get_stats(self) -> Dict:
+        """
+        Returns:
+            {обработчик: {'calls', 'errors', 'avg', 'max', 'stages': {стадия: {'calls', 'avg', 'max', 'share'}}}};
+            avg стадии - среднее на обновление обработчика, share - доля во времени обработчика
+        """
+        result = {}
+        for name, stats in self.handlers.items():
+            total = stats['total']
+            result[name] = {
+                'calls': total.calls,
+                'errors': self.errors[name],
+                'avg': total.total / total.calls,
+                'max': total.max,
+                'stages': {
+                    stage_name: {
+                        'calls': stage_stats.calls,
+                        'avg': stage_stats.total / total.calls,
+                        'max': stage_stats.max,
+                        'share': stage_stats.total / total.total if total.total else 0.0
+                    }
+                    for stage_name, stage_stats in sorted(stats.items(), key=lambda item: -item[1].total)
+                    if stage_name != 'total'
+                }
+            }
+        return result
+    
+    def format_summary(self) -> str:
+        """Текст для админа: обработчики по суммарному времени, стадии по доле"""
+        stats = self.get_stats()
+        if not stats:
+            return "Обработчики еще не вызывались."
+        
+        lines = [f"⏱ Время обработчиков с {self.since.strftime('%Y-%m-%d %H:%M:%S')}"]
+        for name, handler in sorted(stats.items(), key=lambda item: -item[1]['avg'] * item[1]['calls']):
+            lines.append(
+                f"\n{name}: {handler['calls']} вызовов, среднее {handler['avg'] * 1000:.0f} мс, "
+                f"макс. {handler['max'] * 1000:.0f} мс" + (f", ошибок {handler['errors']}" if handler['errors'] else "")
+            )
+            for stage_name, stage_stats in handler['stages'].items():
+                lines.append(
+                    f"  • {stage_name}: {stage_stats['avg'] * 1000:.1f} мс ({stage_stats['share'] * 100:.0f}%), "
+                    f"макс. {stage_stats['max'] * 1000:.0f} мс"
+                )
+        return "\n".join(lines)
+
+def _frame_name(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}"
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профилировщик потока event loop
+    
+    Фоновый поток с заданным интервалом снимает стек потока бота через
+    sys._current_frames() и считает одинаковые стеки. Сам бот не
+    инструментируется, поэтому накладные расходы не зависят от нагрузки.
+    Результат пишется в формате collapsed stacks (flamegraph.pl, speedscope).
+    """
+    
+    MAX_DEPTH = 128
+    
+    def __init__(self, interval: float = 0.005, output_dir: str = PROFILE_DIR, max_seconds: float = 600):
+        """
+        Args:
+            interval: Период снятия стека, сек
+            output_dir: Каталог для файлов профилей
+            max_seconds: Сбор останавливается сам, если профиль не остановили
+        """
+        self.interval = interval
+        self.output_dir = output_dir
+        self.max_seconds = max_seconds
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._stacks: Counter = Counter()
+        self._target_thread = None
+        self.started_at: Optional[datetime] = None
+        self._started = 0.0
+        self._finished = 0.0
+    
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+    
+    def start(self, thread_id: int = None):
+        """Начинает сбор для потока thread_id (по умолчанию - текущего)"""
+        if self.running:
+            raise RuntimeError("Профилирование уже запущено")
+        self._target_thread = thread_id or threading.get_ident()
+        self._stacks = Counter()
+        self._stop.clear()
+        self.started_at = datetime.now()
+        self._started = time.monotonic()
+        self._finished = 0.0
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        logger.info(f"Профилирование запущено, интервал {self.interval * 1000:.0f} мс")
+    
+    def _run(self):
+        deadline = self._started + self.max_seconds
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target_thread)
+            if frame is not None:
+                stack = []
+                while frame is not None and len(stack) < self.MAX_DEPTH:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                self._stacks[tuple(reversed(stack))] += 1
+            if time.monotonic() >= deadline:
+                logger.warning(f"Профилирование остановлено по лимиту {self.max_seconds:.0f}с")
+                break
+        self._finished = time.monotonic()
+    
+    def stop(self) -> Dict:
+        """Останавливает сбор, записывает профиль на диск и возвращает сводку"""
+        if not self.running:
+            raise RuntimeError("Профилирование не запущено")
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        
+        summary = self._summarize()
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"profile-{self.started_at.strftime('%Y%m%dT%H%M%S')}.collapsed")
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{';'.join(_frame_name(code) for code in stack)} {count}\n")
+        summary['path'] = path
+        logger.info(f"Профиль записан: {path}, {summary['samples']} выборок")
+        return summary
+    
+    @staticmethod
+    def _is_idle(stack: tuple) -> bool:
+        """Поток бота ждет событий в селекторе event loop"""
+        leaf = stack[-1] if stack else None
+        return leaf is not None and leaf.co_name == 'select' and leaf.co_filename.endswith('selectors.py')
+    
+    def _summarize(self, top: int = 10) -> Dict:
+        samples = sum(self._stacks.values())
+        idle = sum(count for stack, count in self._stacks.items() if self._is_idle(stack))
+        own = Counter()
+        cumulative = Counter()
+        for stack, count in self._stacks.items():
+            if not stack or self._is_idle(stack):
+                continue
+            own[_frame_name(stack[-1])] += count
+            for name in {_frame_name(code) for code in stack}:
+                cumulative[name] += count
+        
+        busy = samples - idle
+        return {
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'duration': self._finished - self._started,
+            'interval': self.interval,
+            'samples': samples,
+            'busy_samples': busy,
+            'busy_share': busy / samples if samples else 0.0,
+            'top_own': [(name, count / busy) for name, count in own.most_common(top)] if busy else [],
+            'top_cumulative': [(name, count / busy) for name, count in cumulative.most_common(top)] if busy else []
+        }
+
+def format_profile_summary(summary: Dict) -> str:
+    """Текст сводки профиля для админа"""
+    lines = [
+        f"🔬 Профиль: {summary['duration']:.1f}с, {summary['samples']} выборок "
+        f"(интервал {summary['interval'] * 1000:.0f} мс)",
+        f"Загрузка event loop: {summary['busy_share'] * 100:.0f}% (остальное - ожидание событий)",
+        f"Файл: {summary['path']}"
+    ]
+    if summary['top_own']:
+        lines.append("\nСобственное время (доля от занятого):")
+        lines.extend(f"• {share * 100:.1f}% {name}" for name, share in summary['top_own'])
+        lines.append("\nС учетом вызовов:")
+        lines.extend(f"• {share * 100:.1f}% {name}" for name, share in summary['top_cumulative'])
+    return "\n".join(lines)
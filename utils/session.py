@@ -0,0 +1,122 @@
+"""
+Компактное представление сессий эксперимента
+Сессия хранится в объекте со __slots__ вместо словаря, отметки времени -
+числами time.time() вместо datetime. История разговора - кольцевой буфер
+из последних CONVERSATION_WINDOW реплик, которых достаточно промптам;
+более ранние реплики остаются только в базе (llm_analysis).
+"""
+
+import sys
+import time
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+from config.settings import Config
+
+class Turn:
+    """Реплика разговора; читается и как словарь {'sender', 'text', 'timestamp'}"""
+    
+    __slots__ = ('sender', 'text', 'timestamp')
+    
+    def __init__(self, sender: str, text: str, timestamp: float = None):
+        self.sender = sender
+        self.text = text
+        self.timestamp = timestamp if timestamp is not None else time.time()
+    
+    def __getitem__(self, key: str):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def get(self, key: str, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+class ConversationHistory(deque):
+    """
+    Последние реплики разговора (кольцевой буфер)
+    
+    Срезы ([-6:-1]) работают как у списка, чтобы LLMAnalyzer получал
+    историю в прежнем виде.
+    """
+    
+    __slots__ = ()
+    
+    def __init__(self, window: int = None):
+        super().__init__(maxlen=window or Config.CONVERSATION_WINDOW)
+    
+    def add(self, sender: str, text: str) -> Turn:
+        turn = Turn(sender, text)
+        self.append(turn)
+        return turn
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        return super().__getitem__(index)
+
+class ExperimentSession:
+    """
+    Сессия участника LLM эксперимента
+    
+    get() и оператор in поддерживаются для кода, читающего сессии как
+    словари (статус, метрики, контроль памяти): незаданное поле (None)
+    считается отсутствующим.
+    """
+    
+    __slots__ = (
+        'participant_id', 'user_id', 'username', 'group', 'language',
+        'start_time', 'end_time', 'last_activity', 'message_count',
+        'discussion_start_time', 'timer_message_id', 'warning_sent'
+    )
+    
+    def __init__(self, participant_id: str, user_id: int, username: str, group: str, language: str):
+        now = time.time()
+        self.participant_id = participant_id
+        self.user_id = user_id
+        self.username = username
+        # Группа и язык повторяются у тысяч сессий: одна строка на всех
+        self.group = sys.intern(group)
+        self.language = sys.intern(language)
+        self.start_time = now
+        self.end_time = now + Config.DISCUSSION_TIME_MINUTES * 60
+        self.last_activity = now
+        self.message_count = 0
+        self.discussion_start_time: Optional[float] = None
+        self.timer_message_id: Optional[int] = None
+        self.warning_sent = False
+    
+    def get(self, key: str, default=None):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        return default if value is None else value
+    
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+    
+    @property
+    def discussion_started(self) -> bool:
+        return self.discussion_start_time is not None
+    
+    def start_discussion(self) -> datetime:
+        """Отмечает начало обсуждения; возвращает его время для базы данных"""
+        self.discussion_start_time = time.time()
+        return datetime.fromtimestamp(self.discussion_start_time)
+    
+    def touch(self):
+        """Учитывает новое сообщение участника"""
+        self.message_count += 1
+        self.last_activity = time.time()
+    
+    @property
+    def expired(self) -> bool:
+        return time.time() > self.end_time
+    
+    def remaining_minutes(self) -> float:
+        return (self.end_time - time.time()) / 60
+    
+    def elapsed_minutes(self) -> float:
+        return (time.time() - self.start_time) / 60
+    
+    def discussion_elapsed(self) -> float:
+        """Секунды с начала обсуждения"""
+        return time.time() - self.discussion_start_time
@@ -0,0 +1,125 @@
+"""
+Снимки базы данных для аналитики
+Снимок копируется online backup API SQLite порциями страниц: между шагами
+блокировка чтения отпускается, и бот продолжает записывать данные.
+Готовый снимок - неизменяемая копия на момент создания, его открывают
+только на чтение (DataAnalyzer(db_path=путь к снимку))
+"""
+
+import glob
+import logging
+import os
+import sqlite3
+import stat
+import time
+from datetime import datetime
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = "data/snapshots"
+
+class _BackupRestarted(Exception):
+    """Копирование слишком часто начиналось заново из-за записей в базу"""
+
+def connect_readonly(path: str) -> sqlite3.Connection:
+    """Открывает базу только на чтение; снимки неизменяемы, поэтому блокировки не нужны"""
+    return sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro&immutable=1", uri=True)
+
+class SnapshotManager:
+    """Создает, находит и удаляет снимки базы эксперимента"""
+    
+    MAX_RESTARTS = 5  # после стольких перезапусков копия делается за один шаг
+    
+    def __init__(self, db_path: str = "data/experiment.db", snapshot_dir: str = SNAPSHOT_DIR,
+                 pages_per_step: int = 256, step_sleep: float = 0.005, keep: int = 3):
+        """
+        Args:
+            db_path: Путь к рабочей базе данных
+            snapshot_dir: Каталог снимков
+            pages_per_step: Сколько страниц копировать за шаг (блокировка держится только на шаг)
+            step_sleep: Пауза между шагами, сек; в нее проходят записи бота
+            keep: Сколько последних снимков хранить
+        """
+        self.db_path = db_path
+        self.snapshot_dir = snapshot_dir
+        self.pages_per_step = pages_per_step
+        self.step_sleep = step_sleep
+        self.keep = keep
+    
+    def _copy(self, target: sqlite3.Connection):
+        """
+        Копирует базу порциями страниц
+        
+        Если в базу пишет другое соединение, SQLite начинает копирование заново.
+        При постоянной нагрузке это может не закончиться, поэтому после
+        MAX_RESTARTS перезапусков база копируется за один шаг.
+        """
+        state = {'remaining': None, 'restarts': 0}
+        
+        def progress(status, remaining, total):
+            if state['remaining'] is not None and remaining > state['remaining']:
+                state['restarts'] += 1
+                if state['restarts'] > self.MAX_RESTARTS:
+                    raise _BackupRestarted()
+            state['remaining'] = remaining
+        
+        with sqlite3.connect(self.db_path) as source:
+            try:
+                source.backup(target, pages=self.pages_per_step, progress=progress, sleep=self.step_sleep)
+            except _BackupRestarted:
+                logger.warning("Снимок перезапускался из-за записей, копирование за один шаг")
+                source.backup(target)
+    
+    def create(self) -> str:
+        """
+        Создает снимок и возвращает путь к нему
+        
+        Копия пишется во временный файл и переименовывается только после
+        завершения, так что читатели никогда не видят недописанный снимок.
+        """
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        name = f"experiment-{datetime.now().strftime('%Y%m%dT%H%M%S_%f')}.db"
+        path = os.path.join(self.snapshot_dir, name)
+        tmp_path = f"{path}.tmp"
+        
+        started = time.monotonic()
+        target = sqlite3.connect(tmp_path)
+        try:
+            self._copy(target)
+            # Снимок открывается без журнала и блокировок (immutable)
+            target.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            target.close()
+        
+        os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(tmp_path, path)
+        logger.info(f"Снимок базы создан: {path} за {time.monotonic() - started:.2f}с")
+        
+        self.prune()
+        return path
+    
+    def list(self) -> List[str]:
+        """Снимки от старых к новым"""
+        return sorted(glob.glob(os.path.join(self.snapshot_dir, "experiment-*.db")))
+    
+    def latest(self) -> Optional[str]:
+        snapshots = self.list()
+        return snapshots[-1] if snapshots else None
+    
+    def get_fresh(self, max_age_seconds: float = 300) -> str:
+        """Возвращает последний снимок, если он не старше max_age_seconds, иначе создает новый"""
+        latest = self.latest()
+        if latest and time.time() - os.path.getmtime(latest) <= max_age_seconds:
+            return latest
+        return self.create()
+    
+    def prune(self, keep: int = None):
+        """Удаляет старые снимки, оставляя keep последних"""
+        keep = self.keep if keep is None else keep
+        for path in self.list()[:-keep] if keep > 0 else self.list():
+            try:
+                os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Не удалось удалить снимок {path}: {e}")
@@ -0,0 +1,310 @@
+"""
+Трассировка обработки обновлений
+Каждое обновление получает trace_id и дерево спанов: валидация, вызовы
+LLM, записи в базу, запросы к Bot API. Текущий спан хранится в contextvars,
+поэтому ID трассы без явной передачи доходит от обработчика через
+LLMExperimentHandler и LLMAnalyzer до DatabaseManager.
+
+Решение о сохранении принимается в конце обновления: медленные и
+завершившиеся ошибкой трассы сохраняются всегда, остальные - с заданной
+вероятностью. Трассы пишутся в JSONL фоновым потоком.
+"""
+
+import functools
+import inspect
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+TRACE_FILE = "logs/traces.jsonl"
+
+class Span:
+    """Участок обработки обновления"""
+    
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attrs', 'started', 'duration', 'error')
+    
+    def __init__(self, trace: 'Trace', name: str, parent_id: Optional[int], attrs: Dict):
+        self.trace = trace
+        self.span_id = len(trace.spans)
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+    
+    def set(self, **attrs):
+        """Добавляет атрибуты спана"""
+        self.attrs.update(attrs)
+    
+    def to_dict(self) -> Dict:
+        return {
+            'id': self.span_id,
+            'parent': self.parent_id,
+            'name': self.name,
+            'offset_ms': round((self.started - self.trace.started) * 1000, 2),
+            'duration_ms': round(self.duration * 1000, 2) if self.duration is not None else None,
+            'attrs': self.attrs,
+            'error': self.error
+        }
+
+class Trace:
+    """Дерево спанов одного обновления"""
+    
+    __slots__ = ('trace_id', 'timestamp', 'started', 'spans', 'finished')
+    
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.timestamp = datetime.now()
+        self.started = time.perf_counter()
+        self.spans: List[Span] = []
+        self.finished = False
+    
+    def to_dict(self) -> Dict:
+        root = self.spans[0]
+        return {
+            'trace_id': self.trace_id,
+            'timestamp': self.timestamp.isoformat(timespec='milliseconds'),
+            'name': root.name,
+            'duration_ms': round(root.duration * 1000, 2),
+            'error': any(span.error for span in self.spans),
+            'attrs': root.attrs,
+            'spans': [span.to_dict() for span in self.spans]
+        }
+
+_current_span: ContextVar[Optional[Span]] = ContextVar('trace_span', default=None)
+
+# Ограничение на число спанов в трассе, чтобы циклы не раздували файл
+MAX_SPANS = 500
+
+def current_trace_id() -> Optional[str]:
+    """ID трассы текущего обновления или None вне трассировки"""
+    current = _current_span.get()
+    return current.trace.trace_id if current is not None else None
+
+def set_attributes(**attrs):
+    """Добавляет атрибуты корневому спану текущей трассы (например, participant_id)"""
+    current = _current_span.get()
+    if current is not None and not current.trace.finished:
+        current.trace.spans[0].set(**attrs)
+
+def record_span(name: str, duration: float, **attrs):
+    """Добавляет уже завершившийся участок (например, попытку вызова модели) в текущую трассу"""
+    parent = _current_span.get()
+    if parent is None or parent.trace.finished or len(parent.trace.spans) >= MAX_SPANS:
+        return
+    child = Span(parent.trace, name, parent.span_id, attrs)
+    child.started -= duration
+    child.duration = duration
+    parent.trace.spans.append(child)
+
+class span:
+    """
+    Контекстный менеджер спана: with span('db.save', table='chat'): ...
+    
+    Вне трассы (или после ее завершения, например в фоновой задаче,
+    унаследовавшей контекст обработчика) ничего не записывает.
+    """
+    
+    __slots__ = ('name', 'attrs', '_span', '_token')
+    
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self._span: Optional[Span] = None
+        self._token = None
+    
+    def __enter__(self) -> Optional[Span]:
+        parent = _current_span.get()
+        if parent is None or parent.trace.finished or len(parent.trace.spans) >= MAX_SPANS:
+            return None
+        trace = parent.trace
+        self._span = Span(trace, self.name, parent.span_id, self.attrs)
+        trace.spans.append(self._span)
+        self._token = _current_span.set(self._span)
+        return self._span
+    
+    def __exit__(self, exc_type, exc, tb):
+        if self._span is None:
+            return False
+        self._span.duration = time.perf_counter() - self._span.started
+        if exc_type is not None and not issubclass(exc_type, GeneratorExit):
+            self._span.error = f"{exc_type.__name__}: {exc}"
+        _current_span.reset(self._token)
+        self._span = None
+        return False
+
+def traced(name: str = None) -> Callable:
+    """Декоратор функции или корутины, вызов которой записывается отдельным спаном"""
+    def decorator(func):
+        span_name = name or func.__qualname__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class Tracer:
+    """Открывает трассы обновлений и сохраняет выбранные в JSONL"""
+    
+    def __init__(self, path: str = TRACE_FILE, sample_rate: float = 0.1, slow_threshold: float = 2.0,
+                 max_bytes: int = 50 * 1024 * 1024, backup_count: int = 5, compress: bool = True):
+        """
+        Args:
+            path: Файл JSONL для трасс
+            sample_rate: Доля обычных трасс, которые сохраняются
+            slow_threshold: Трассы не короче этого (сек) и с ошибками сохраняются всегда
+            max_bytes: Размер файла, после которого он ротируется (0 - без ротации)
+            backup_count: Сколько ротированных файлов хранить
+            compress: Сжимать ротированные файлы gzip, как логи
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        
+        self.traces = 0
+        self.saved = 0
+        self.dropped = 0
+        
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._writer: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+    
+    def wrap(self, name: str, callback: Callable, label: Callable = None) -> Callable:
+        """
+        Оборачивает обработчик PTB корневым спаном трассы
+        
+        Args:
+            name: Имя корневого спана
+            callback: Корутина обработчика (update, context)
+            label: Функция update -> уточнение имени или None
+        """
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            span_name = name
+            if label:
+                suffix = label(update)
+                if suffix:
+                    span_name = f"{name}:{suffix}"
+            
+            user = getattr(update, 'effective_user', None)
+            trace = Trace()
+            root = Span(trace, span_name, None, {
+                'update_id': getattr(update, 'update_id', None),
+                'user_id': getattr(user, 'id', None)
+            })
+            trace.spans.append(root)
+            token = _current_span.set(root)
+            try:
+                return await callback(update, context)
+            except Exception as e:
+                root.error = f"{type(e).__name__}: {e}"
+                raise
+            finally:
+                root.duration = time.perf_counter() - root.started
+                trace.finished = True
+                _current_span.reset(token)
+                self.finish(trace)
+        return wrapper
+    
+    def finish(self, trace: Trace):
+        """Решает, сохранять ли трассу, и ставит ее в очередь записи"""
+        self.traces += 1
+        root = trace.spans[0]
+        keep = (
+            root.duration >= self.slow_threshold
+            or any(span.error for span in trace.spans)
+            or random.random() < self.sample_rate
+        )
+        if not keep:
+            self.dropped += 1
+            return
+        
+        self.saved += 1
+        # Сериализация откладывается в поток записи, в event loop только постановка в очередь
+        self._queue.put(trace)
+        self._ensure_writer()
+    
+    def _ensure_writer(self):
+        if self._writer is not None:
+            return
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name='trace-writer', daemon=True)
+                self._writer.start()
+    
+    def _open_file(self) -> logging.handlers.RotatingFileHandler:
+        """Файл трасс с той же ротацией по размеру и сжатием, что и у логов"""
+        # utils.logging_setup импортирует этот модуль, поэтому импорт здесь
+        from utils.logging_setup import _gzip_namer, _gzip_rotator
+        
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Без хотя бы одной копии RotatingFileHandler не усекает файл при ротации
+        handler = logging.handlers.RotatingFileHandler(
+            self.path, maxBytes=self.max_bytes, backupCount=max(self.backup_count, 1), encoding='utf-8'
+        )
+        if self.compress:
+            handler.namer = _gzip_namer
+            handler.rotator = _gzip_rotator
+        return handler
+    
+    def _write_loop(self):
+        handler = self._open_file()
+        try:
+            while True:
+                trace = self._queue.get()
+                if trace is None:
+                    break
+                try:
+                    handler.stream.write(json.dumps(trace.to_dict(), ensure_ascii=False, default=str) + "\n")
+                    if self.max_bytes and handler.stream.tell() >= self.max_bytes:
+                        handler.doRollover()
+                except Exception as e:
+                    logger.error(f"Не удалось записать трассу {trace.trace_id}: {e}")
+                if self._queue.empty():
+                    handler.flush()
+        finally:
+            handler.close()
+    
+    def close(self):
+        """Дописывает очередь трасс и останавливает поток записи"""
+        if self._writer is None:
+            return
+        self._queue.put(None)
+        self._writer.join()
+        self._writer = None
+    
+    def get_stats(self) -> Dict:
+        return {
+            'path': self.path,
+            'sample_rate': self.sample_rate,
+            'slow_threshold': self.slow_threshold,
+            'max_bytes': self.max_bytes,
+            'traces': self.traces,
+            'saved': self.saved,
+            'dropped': self.dropped
+        }
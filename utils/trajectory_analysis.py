@@ -0,0 +1,245 @@
+"""
+Анализ траекторий эмоций и намерений участников
+Последовательности состояний по ходам строятся одним упорядоченным проходом
+по llm_analysis_fields, матрицы переходов и кривые во времени считаются
+операциями над массивами кодов (np.add.at) без циклов по строкам
+"""
+
+import logging
+import sqlite3
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+from utils.snapshot import connect_readonly
+
+logger = logging.getLogger(__name__)
+
+# Категориальные поля анализа, для которых имеют смысл последовательности состояний
+TRAJECTORY_FIELDS = [
+    'emotion', 'intent', 'confidence', 'persuasion_resistance',
+    'nudging_effectiveness', 'risk_of_dropout', 'analysis_method'
+]
+
+TRAJECTORY_DIMENSIONS = ['experiment_group', 'language']
+
+# Время анализа пишется CURRENT_TIMESTAMP (UTC), а начало обсуждения - datetime.now()
+# (локальное время), поэтому начало переводится в UTC модификатором 'utc'
+SEQUENCES_QUERY = """
+    SELECT
+        f.participant_id,
+        COALESCE(p.experiment_group, 'unknown'),
+        COALESCE(p.language, 'unknown'),
+        COALESCE(CAST(f.{field} AS TEXT), 'unknown'),
+        (julianday(a.timestamp) - julianday(COALESCE(pf.discussion_start, p.start_time), 'utc')) * 86400.0
+    FROM llm_analysis_fields f
+    JOIN llm_analysis a ON a.id = f.analysis_id
+    JOIN participants p ON p.participant_id = f.participant_id
+    LEFT JOIN participant_features pf ON pf.participant_id = f.participant_id
+    ORDER BY f.participant_id, f.analysis_id
+"""
+
+def _codes(values: list) -> tuple:
+    """Кодирует значения целыми числами; возвращает (коды, подписи)"""
+    codes, labels = pd.factorize(np.asarray(values, dtype=object), sort=True)
+    return codes.astype(np.int32), [str(label) for label in labels]
+
+def _row_shares(counts: np.ndarray) -> np.ndarray:
+    """Нормирует последнюю ось на сумму; строки без наблюдений дают NaN"""
+    totals = counts.sum(axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts / totals
+
+class TrajectoryAnalyzer:
+    """Матрицы переходов и выровненные по времени кривые состояний участников"""
+    
+    def __init__(self, db_path: str = "data/experiment.db", immutable: bool = False):
+        """
+        Args:
+            db_path: Путь к базе данных или к снимку
+            immutable: База не меняется (снимок) - открывать только на чтение без блокировок
+        """
+        self.db_path = db_path
+        self.immutable = immutable
+    
+    def _connect(self) -> sqlite3.Connection:
+        return connect_readonly(self.db_path) if self.immutable else sqlite3.connect(self.db_path)
+    
+    def load_sequences(self, field: str) -> Dict:
+        """
+        Читает последовательности состояний всех участников одним упорядоченным запросом
+        
+        Returns:
+            Словарь массивов одинаковой длины (строка - ход участника): participant,
+            state, experiment_group, language (коды), turn (номер хода с 0),
+            elapsed (секунды от начала обсуждения, NaN если начало неизвестно),
+            а также подписи кодов в states, experiment_group_labels, language_labels
+        """
+        if field not in TRAJECTORY_FIELDS:
+            raise ValueError(f"Неизвестное поле траектории: {field}")
+        
+        with self._connect() as conn:
+            rows = conn.execute(SEQUENCES_QUERY.format(field=field)).fetchall()
+        
+        columns = list(zip(*rows)) if rows else [()] * 5
+        participant, _ = _codes(columns[0])
+        group, group_labels = _codes(columns[1])
+        language, language_labels = _codes(columns[2])
+        state, states = _codes(columns[3])
+        elapsed = np.array(columns[4], dtype=float)
+        
+        # Номер хода: позиция строки минус начало блока участника (строки упорядочены)
+        n = len(participant)
+        starts = np.flatnonzero(np.r_[True, participant[1:] != participant[:-1]]) if n else np.empty(0, dtype=int)
+        turn = np.arange(n) - np.repeat(starts, np.diff(np.r_[starts, n]))
+        
+        return {
+            'participant': participant,
+            'state': state,
+            'experiment_group': group,
+            'language': language,
+            'turn': turn,
+            'elapsed': elapsed,
+            'states': states,
+            'experiment_group_labels': group_labels,
+            'language_labels': language_labels
+        }
+    
+    @staticmethod
+    def transition_counts(data: Dict, by: str = 'experiment_group') -> np.ndarray:
+        """
+        Считает переходы между соседними ходами одного участника
+        
+        Returns:
+            Массив [значение разреза, состояние до, состояние после]
+        """
+        if by not in TRAJECTORY_DIMENSIONS:
+            raise ValueError(f"Неизвестный разрез: {by}")
+        
+        n_states = len(data['states'])
+        n_values = len(data[f"{by}_labels"])
+        counts = np.zeros((n_values, n_states, n_states), dtype=np.int64)
+        
+        participant = data['participant']
+        same = participant[1:] == participant[:-1]
+        state = data['state']
+        np.add.at(counts, (data[by][1:][same], state[:-1][same], state[1:][same]), 1)
+        return counts
+    
+    def transition_matrices(self, field: str, by: str = 'experiment_group', data: Dict = None) -> Dict[str, pd.DataFrame]:
+        """
+        Матрицы вероятностей переходов состояний по группам или языкам
+        
+        Returns:
+            Словарь {значение разреза: DataFrame}, строки - состояние до,
+            колонки - состояние после, плюс колонка transitions с числом переходов
+        """
+        data = data if data is not None else self.load_sequences(field)
+        counts = self.transition_counts(data, by)
+        probabilities = _row_shares(counts.astype(float))
+        
+        matrices = {}
+        for i, value in enumerate(data[f"{by}_labels"]):
+            matrix = pd.DataFrame(probabilities[i], index=data['states'], columns=data['states'])
+            matrix['transitions'] = counts[i].sum(axis=1)
+            matrices[value] = matrix
+        return matrices
+    
+    @staticmethod
+    def time_counts(data: Dict, by: str = 'experiment_group', bin_seconds: int = 30,
+                    max_seconds: float = None) -> np.ndarray:
+        """
+        Считает состояния по интервалам времени от начала обсуждения
+        
+        Ходы до начала обсуждения, после max_seconds и без известного начала
+        отбрасываются.
+        
+        Returns:
+            Массив [значение разреза, интервал, состояние]
+        """
+        if by not in TRAJECTORY_DIMENSIONS:
+            raise ValueError(f"Неизвестный разрез: {by}")
+        
+        elapsed = data['elapsed']
+        valid = ~np.isnan(elapsed) & (elapsed >= 0)
+        if max_seconds is not None:
+            valid &= elapsed < max_seconds
+        
+        bins = (elapsed[valid] // bin_seconds).astype(np.int64)
+        n_bins = int(bins.max()) + 1 if bins.size else 0
+        counts = np.zeros((len(data[f"{by}_labels"]), n_bins, len(data['states'])), dtype=np.int64)
+        np.add.at(counts, (data[by][valid], bins, data['state'][valid]), 1)
+        return counts
+    
+    def time_curves(self, field: str, by: str = 'experiment_group', bin_seconds: int = 30,
+                    max_seconds: float = None, data: Dict = None) -> pd.DataFrame:
+        """
+        Доли состояний во времени, выровненные по началу обсуждения
+        
+        Returns:
+            DataFrame с колонками [by, bin_start, value, count, share];
+            bin_start - секунды от начала обсуждения
+        """
+        data = data if data is not None else self.load_sequences(field)
+        counts = self.time_counts(data, by, bin_seconds, max_seconds)
+        shares = _row_shares(counts.astype(float))
+        
+        index = np.indices(counts.shape).reshape(3, -1)
+        keep = counts.ravel() > 0
+        return pd.DataFrame({
+            by: np.asarray(data[f"{by}_labels"], dtype=object)[index[0][keep]],
+            'bin_start': index[1][keep] * bin_seconds,
+            'value': np.asarray(data['states'], dtype=object)[index[2][keep]],
+            'count': counts.ravel()[keep],
+            'share': shares.ravel()[keep]
+        })
+    
+    def turn_curves(self, field: str, by: str = 'experiment_group', max_turns: int = 20,
+                    data: Dict = None) -> pd.DataFrame:
+        """
+        Доли состояний по номеру хода участника
+        
+        Returns:
+            DataFrame с колонками [by, turn, value, count, share]; turn начинается с 1
+        """
+        if by not in TRAJECTORY_DIMENSIONS:
+            raise ValueError(f"Неизвестный разрез: {by}")
+        
+        data = data if data is not None else self.load_sequences(field)
+        valid = data['turn'] < max_turns
+        counts = np.zeros((len(data[f"{by}_labels"]), max_turns, len(data['states'])), dtype=np.int64)
+        np.add.at(counts, (data[by][valid], data['turn'][valid], data['state'][valid]), 1)
+        shares = _row_shares(counts.astype(float))
+        
+        index = np.indices(counts.shape).reshape(3, -1)
+        keep = counts.ravel() > 0
+        return pd.DataFrame({
+            by: np.asarray(data[f"{by}_labels"], dtype=object)[index[0][keep]],
+            'turn': index[1][keep] + 1,
+            'value': np.asarray(data['states'], dtype=object)[index[2][keep]],
+            'count': counts.ravel()[keep],
+            'share': shares.ravel()[keep]
+        })
+    
+    def analyze(self, field: str, bin_seconds: int = 30, max_seconds: float = None) -> Dict:
+        """
+        Полный набор траекторных показателей по полю за один проход по базе
+        
+        Returns:
+            Словарь с матрицами переходов и кривыми по группам и языкам
+        """
+        data = self.load_sequences(field)
+        result = {
+            'field': field,
+            'n_turns': int(len(data['state'])),
+            'n_participants': int(data['participant'].max()) + 1 if len(data['participant']) else 0,
+            'states': data['states']
+        }
+        for by in TRAJECTORY_DIMENSIONS:
+            result[by] = {
+                'transitions': self.transition_matrices(field, by, data),
+                'time_curves': self.time_curves(field, by, bin_seconds, max_seconds, data),
+                'turn_curves': self.turn_curves(field, by, data=data)
+            }
+        return result
@@ -0,0 +1,121 @@
+"""
+Параллельная обработка обновлений Telegram с порядком внутри пользователя
+Обновления разных пользователей обрабатываются одновременно, а обновления
+одного пользователя - строго по очереди, в порядке поступления
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+class _UserQueue:
+    """Очередь обновлений одного пользователя"""
+    
+    __slots__ = ('lock', 'depth')
+    
+    def __init__(self):
+        self.lock = asyncio.Lock()  # asyncio.Lock пропускает ожидающих по очереди (FIFO)
+        self.depth = 0
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обработчик обновлений с ограничением параллелизма и порядком по user_id
+    
+    Семафор базового класса захватывается до do_process_update, поэтому
+    ожидающие своей очереди обновления одного пользователя занимали бы его
+    слоты и блокировали остальных. Поэтому базовый лимит ограничивает только
+    число принятых обновлений (max_pending), а число одновременно
+    выполняемых (concurrency) ограничивает собственный семафор, который
+    берется уже после очереди пользователя.
+    """
+    
+    def __init__(self, concurrency: int, max_pending: int = None):
+        """
+        Args:
+            concurrency: Сколько обновлений выполнять одновременно
+            max_pending: Сколько обновлений принимать в обработку всего (с ожидающими)
+        """
+        super().__init__(max(max_pending or concurrency * 16, concurrency, 2))
+        self.concurrency = concurrency
+        self._slots = asyncio.Semaphore(concurrency)
+        self._queues: Dict[int, _UserQueue] = {}
+        
+        self.running = 0
+        self.waiting = 0
+        self.processed = 0
+        self.max_user_depth_seen = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    @staticmethod
+    def _user_key(update: object) -> Optional[int]:
+        """Ключ упорядочивания: пользователь, а для обновлений без пользователя - чат"""
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        self.waiting += 1
+        key = self._user_key(update)
+        if key is None:
+            await self._run(coroutine, time.monotonic())
+            return
+        
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = _UserQueue()
+        queue.depth += 1
+        self.max_user_depth_seen = max(self.max_user_depth_seen, queue.depth)
+        
+        received = time.monotonic()
+        try:
+            async with queue.lock:
+                await self._run(coroutine, received)
+        finally:
+            queue.depth -= 1
+            if queue.depth == 0:
+                del self._queues[key]
+    
+    async def _run(self, coroutine: Awaitable[Any], received: float):
+        async with self._slots:
+            self.waiting -= 1
+            wait = time.monotonic() - received
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.running += 1
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+                self.processed += 1
+    
+    async def initialize(self) -> None:
+        logger.info(f"Параллельная обработка обновлений: до {self.concurrency} одновременно")
+    
+    async def shutdown(self) -> None:
+        pass
+    
+    def get_stats(self) -> Dict:
+        """Возвращает нагрузку и глубину очередей пользователей"""
+        depths = sorted((queue.depth for queue in self._queues.values()), reverse=True)
+        return {
+            'concurrency': self.concurrency,
+            'running': self.running,
+            'waiting': self.waiting,
+            'active_users': len(depths),
+            'max_user_depth': depths[0] if depths else 0,
+            'users_with_backlog': sum(1 for depth in depths if depth > 1),
+            'max_user_depth_seen': self.max_user_depth_seen,
+            'processed': self.processed,
+            'avg_wait': self.total_wait / self.processed if self.processed else 0.0,
+            'max_wait': self.max_wait
+        }
@@ -6,8 +6,11 @@ import logging
 from typing import Optional, Dict, Any
 from datetime import datetime
 
+from utils.profiling import timed_methods
+
 logger = logging.getLogger(__name__)
 
+@timed_methods('validation')
 class InputValidator:
     """Класс для валидации пользовательского ввода"""
     